@@ -1 +1 @@
-#!/usr/bin/env python3# -*- coding: utf-8 -*-"""Created on Tue Apr 28 12:06:06 2020@author: albert"""import numpy as npimport matplotlib.pylab as pltimport subprocess as subprocessfrom astropy.io import fitsfrom scipy.stats import binned_statisticfrom scipy import ndimageimport os.pathdef webbpsf_return_listof(verbose=None, psf_path=None):        # Determine where the webbpsf PSFs reside    if psf_path == None:        # Try on Loic's laptop:        psf_path = '/Users/albert/NIRISS/SOSSpipeline/webbpsf_psfs/'        if os.path.exists(psf_path) is False:            # Try guessing assuming github install            psf_path = './psflibrary/'    if os.path.exists(psf_path) is False:        print('Pass the path where webbpsfs are to webbpsf_return_listof(psf_path=...)')        return(False)    # Spawn a shell ls command to get the list        commandstr = 'ls -1 '+psf_path+'SOSS_os10_128x128_*.fits'    ls = subprocess.getoutput(commandstr)    psfList = ls.split('\n')    wavelength,psfName = [],[]    for i in range(np.size(psfList)):        psfname = psfList[i]        hdu = fits.open(psfname)        hdr = hdu[0].header        wavelength.append(1e+6*hdr['WAVELEN'])        psfName.append(psfname)        if verbose is True:            print('Filename: {:}, Wavelength={:}'.format(psfname, 1e+6*hdr['WAVELEN']))    return(np.array(psfName),np.array(wavelength))def calc_com(x,fx):    # returns the x center of mass (or barycenter)    # of a f(x) function.        # put to zero the lowest fx value    fx_c = fx - np.min(fx)    com = np.sum(fx_c*x)/np.sum(fx_c)    return(com)def webbpsf_read_and_rotate(filename, angle, verbose=None):        hdu = fits.open(filename)    image = hdu[0].data*1    dim = np.shape(image)[0]    hdr = hdu[0].header    oversampling = hdr['OVERSAMP']    # Apply a rotation to the PSF image    empirical_rotation = angle*1.0    imagewarped = ndimage.rotate(image, empirical_rotation)        if verbose is True:        plt.figure(figsize=(10,10))        plt.imshow(np.log10(image[500:-500,:]),origin='bottom')                # Plot the PSF before/after rotation        plt.figure(figsize=(10,10))        plt.imshow(np.log10(imagewarped[500:-500]),origin='bottom')                ## Save the rotated PSF on disk        #hdu = fits.PrimaryHDU()        #hdu.data = imagewarped        #hdu.writeto(psfPath+'test.fits',overwrite=True)        return(imagewarped, oversampling, dim)def generate_kernel(output_path, verbose=None, psf_path=None, kernel_semi_width=None):    #verbose=False    # This is the function to call to generate the kernels.    # Others above are utility functions.    # Generate the spectral optics response of monochromatic light    # based on all webbpsf oversampled PSFs. That will be used in the     # optimal extraction alogirthm by Antoine Darveau-Bernier.        # This script will generate 10 matrices (10 images), each at a different    # pixel oversampling. Its long axis is the number of monochromatic    # wavelengths while its short axis is the spectral response kernel, an    # odd number, flux normalized to 1.        # For simplicity, each matrix is generated one by one, going through    # all webbpsf PSFs. That may not be cpu optimal but it is conceptually    # simpler.        # Determine where the webbpsf PSFs reside    if psf_path == None:        # Try on Loic's laptop:        psf_path = '/Users/albert/NIRISS/SOSSpipeline/webbpsf_psfs/'        if os.path.exists(psf_path) is False:            # Try guessing assuming github install            psf_path = './psflibrary/'    if os.path.exists(psf_path) is False:        print('Pass the path where webbpsfs are to generate_kernel(psf_path=...)')        return(False)    else:        print(psf_path)        # Call the function that looks on a predefined path for webbpsf fits files    # This will need editing when ran on a different machine or on a different    # set of files.    filename, lambdalist = webbpsf_return_listof(verbose=verbose,psf_path=psf_path)    # Define how wide the kernel should be in terms of native pixels.    # That is, this is the half-width of that kernel. The kernel will    # have size of ksw*2 + one element. in units of native pixels.    if kernel_semi_width == None:         ksw = kernel_semi_width = 7    else:        ksw = kernel_semi_width    # The core_semi_width is a pixel distance along the spatial axis that     # defines what region of the trace to keep in the analysis.    core_semi_width = 15            osmax = 10    for i in range(osmax):        osamp = i+1        # Initialize the matrix at that oversampling        kernel_matrix = np.zeros((osamp*2*ksw+1,np.size(lambdalist)))        wavelength_matrix = np.zeros((osamp*2*ksw+1,np.size(lambdalist)))        # The name of the output kernel matrix        matrix_name = '{:}/spectral_kernel_matrix_os_{:}_width_{:}pixels.fits'.format(output_path,osamp,ksw*2+1)        for n in range(np.size(lambdalist)):            # Read and apply a rotation to the original oversampled webbpsf image.            angle = -3.0 # That is the tilt angle empirically seen in webbpsf's PSFs            imagewarped, arg2, dim = webbpsf_read_and_rotate(filename[n],                                                            angle,                                                           verbose=verbose)            oversampling = arg2                        # Crunch along the spatial axis to get 1-d array            # Reduce the image to the trace profil width (only use pixels where            # the majority of the signal is.)            xmin = int(dim/2-core_semi_width*osamp)            xmax = int(dim/2+core_semi_width*osamp)            # leave the first 50 and last 50 rows out of the sum as the image             # was rotated and they may contain bogus values.            kernel_full = np.sum(np.array(imagewarped[50:-50,xmin:xmax]), axis=1)            if verbose is True: plt.plot(kernel_full)                        # Determine the barycenter            x = np.arange(np.size(kernel_full))                        cofm = calc_com(x,kernel_full)            if verbose is True: print(cofm)            if verbose is True: plt.axvline(x=cofm, color='red')            # Iterate once on centroid            cond1 = (x >= cofm - kernel_semi_width*oversampling - 0.5/oversampling)            cond2 = (x <= cofm + kernel_semi_width*oversampling + 0.5/oversampling)            ind = cond1 & cond2            cofm2 = calc_com(x[ind],kernel_full[ind])            if verbose is True: print(cofm2)            if verbose is True: plt.axvline(x=cofm2, color='black')            if verbose is True: plt.xlim((cofm2-kernel_semi_width*oversampling,cofm2+kernel_semi_width*oversampling))            if verbose is True: plt.show()                        # On the PSF oversampled grid:            x_psf_float = (x - cofm2)/oversampling # pixel position in units of native pixels (x_psf = 0 at center of mass)            k_psf_float = kernel_full*1.0          # kernel value associated with x_psf, not normalized yet.            # Sample extremely finely to minimize edge effect error in doing bins later            x_bin_os = np.linspace(-ksw-1,ksw+1,1000000)            k_bin_os = np.interp(x_bin_os,x_psf_float,k_psf_float)                        # Bin using binned_statistic            nbins = (2*ksw*osamp)+1            rangemin = -ksw-0.5/osamp            rangemax = ksw+0.5/osamp            k_bin, bin_edges, binnumber = binned_statistic(x_bin_os, k_bin_os,                                                            statistic='mean',                                                            bins=nbins,                                                            range=(rangemin,rangemax))            x_bin, bin_edges, binnumber = binned_statistic(x_bin_os, x_bin_os,                                                            statistic='mean',                                                            bins=nbins,                                                            range=(rangemin,rangemax))            # Normalize to one            k_bin = k_bin-np.min(k_bin) # put lower point at zero            k_bin = k_bin / (np.sum(k_bin))                        # Write to matrix            kernel_matrix[:,n] = k_bin            wavelength_matrix[:,n] = lambdalist[n]                        # recalculate center of mass for a check only            com = np.sum(k_bin*x_bin)/np.sum(k_bin)            if verbose is True: print('com=',com)                        # Show the compactness of the flux to see how well the tilt was guessed            half = (np.size(k_bin)-1)//2            #print('half = {:}, -os*1 = {:}'.format(half,half-os*1))            core = np.sum(k_bin[half-osamp*2:half+osamp*2])            if verbose is True: print('flux in core = {:}'.format(core))                        if verbose is True:                # plot kernel                plt.plot(x_bin,k_bin*osamp+0.04*n,marker='.',linestyle='-')                plt.axvline(x=0.0,color='red',zorder=-1)                plt.xlim((-ksw,ksw))                plt.xlabel('Native pixels')                plt.ylabel('Normalized Intensity (+ constant)')                        # print the kernel at each wavelength            print(n, k_bin)        # Save the rotated PSF on disk        hdu = fits.PrimaryHDU()        # Write the index of reddest end the monochromatic kernel         # That determines which direction the kernel goes with         # respect to your pixels.        #hdu.header['REDINDEX'], hdu.header['BLUINDEX'] = 0, np.size(k_bin)-1        hdu.header['REDINDEX'], hdu.header['BLUINDEX'] = np.size(k_bin)-1, 0        hdu.data = [kernel_matrix,wavelength_matrix]        hdu.writeto(matrix_name,overwrite=True)
\ No newline at end of file
+#!/usr/bin/env python3# -*- coding: utf-8 -*-"""Created on Tue Apr 28 12:06:06 2020@author: albert"""import numpy as npimport matplotlib.pylab as pltimport subprocess as subprocessfrom astropy.io import fitsfrom scipy import ndimageimport os.pathfrom concurrent.futures import ProcessPoolExecutordef webbpsf_return_listof(verbose=None, psf_path=None):        # Determine where the webbpsf PSFs reside    if psf_path == None:        # Try on Loic's laptop:        psf_path = '/Users/albert/NIRISS/SOSSpipeline/webbpsf_psfs/'        if os.path.exists(psf_path) is False:            # Try guessing assuming github install            psf_path = './psflibrary/'    if os.path.exists(psf_path) is False:        print('Pass the path where webbpsfs are to webbpsf_return_listof(psf_path=...)')        return(False)    # Spawn a shell ls command to get the list        commandstr = 'ls -1 '+psf_path+'SOSS_os10_128x128_*.fits'    ls = subprocess.getoutput(commandstr)    psfList = ls.split('\n')    wavelength,psfName = [],[]    for i in range(np.size(psfList)):        psfname = psfList[i]        hdu = fits.open(psfname)        hdr = hdu[0].header        wavelength.append(1e+6*hdr['WAVELEN'])        psfName.append(psfname)        if verbose is True:            print('Filename: {:}, Wavelength={:}'.format(psfname, 1e+6*hdr['WAVELEN']))    return(np.array(psfName),np.array(wavelength))def calc_com(x,fx):    # returns the x center of mass (or barycenter)    # of a f(x) function.        # put to zero the lowest fx value    fx_c = fx - np.min(fx)    com = np.sum(fx_c*x)/np.sum(fx_c)    return(com)def webbpsf_read_and_rotate(filename, angle, verbose=None):        hdu = fits.open(filename)    image = hdu[0].data*1    dim = np.shape(image)[0]    hdr = hdu[0].header    oversampling = hdr['OVERSAMP']    # Apply a rotation to the PSF image    empirical_rotation = angle*1.0    imagewarped = ndimage.rotate(image, empirical_rotation)        if verbose is True:        plt.figure(figsize=(10,10))        plt.imshow(np.log10(image[500:-500,:]),origin='bottom')                # Plot the PSF before/after rotation        plt.figure(figsize=(10,10))        plt.imshow(np.log10(imagewarped[500:-500]),origin='bottom')                ## Save the rotated PSF on disk        #hdu = fits.PrimaryHDU()        #hdu.data = imagewarped        #hdu.writeto(psfPath+'test.fits',overwrite=True)        return(imagewarped, oversampling, dim)def collapse_psf(image, oversampling, core_semi_width=15):    # Crunch a (rotated) PSF image along the spatial axis to get the 1-d    # spectral profile. Reduce the image to the trace profil width (only use    # pixels where the majority of the signal is), i.e. core_semi_width    # native pixels on each side of the image center.    dim = np.shape(image)[1]    xmin = int(dim/2-core_semi_width*oversampling)    xmax = int(dim/2+core_semi_width*oversampling)    # leave the first 50 and last 50 rows out of the sum as the image    # was rotated and they may contain bogus values.    kernel_full = np.sum(np.array(image[50:-50,xmin:xmax]), axis=1)    return(kernel_full)def integrate_linear(x, fx, edges):    # Returns the integral, from x[0] to each of the edges, of the linear    # interpolation of fx(x) (constant beyond the end points, like np.interp).    # The integral is exact, from the cumulative integral of the trapezes.    dx = np.diff(x)    cumint = np.concatenate([[0.], np.cumsum(0.5*(fx[1:]+fx[:-1])*dx)])    # Segment of each edge and position within the segment.    i = np.clip(np.searchsorted(x, edges, side='right')-1, 0, np.size(x)-2)    t = np.clip(edges-x[i], 0, dx[i])    slope = (fx[i+1]-fx[i])/dx[i]    integral = cumint[i] + fx[i]*t + 0.5*slope*t**2    # Constant extrapolation beyond the end points.    integral = integral + np.minimum(edges-x[0], 0)*fx[0]    integral = integral + np.maximum(edges-x[-1], 0)*fx[-1]    return(integral)def bin_kernel(x_psf, k_psf, osamp, ksw):    # Bin the profile k_psf(x_psf), with x_psf in native pixels (x_psf = 0    # at center of mass), to the kernel at oversampling osamp and of    # semi-width ksw native pixels. Each bin is the mean of the linearly    # interpolated profile over 1/osamp native pixel, computed analytically.    # Returns the kernel, flux normalized to 1, and the bin centers.    nbins = (2*ksw*osamp)+1    rangemin = -ksw-0.5/osamp    rangemax = ksw+0.5/osamp    bin_edges = np.linspace(rangemin, rangemax, nbins+1)    k_bin = np.diff(integrate_linear(x_psf, k_psf, bin_edges))*osamp    x_bin = 0.5*(bin_edges[1:]+bin_edges[:-1])    # Normalize to one    k_bin = k_bin-np.min(k_bin) # put lower point at zero    k_bin = k_bin / (np.sum(k_bin))    return(k_bin, x_bin)def kernels_from_profile(kernel_full, oversampling, oversamplings, semi_widths):    # Bin a collapsed PSF profile (see collapse_psf), sampled at the PSF    # oversampling, to every requested kernel oversampling and semi-width.    # Returns a dictionary of the kernels with (osamp, ksw) as keys.    # Determine the barycenter    x = np.arange(np.size(kernel_full))    cofm = calc_com(x,kernel_full)    kernels = {}    for ksw in semi_widths:        # Iterate once on centroid        cond1 = (x >= cofm - ksw*oversampling - 0.5/oversampling)        cond2 = (x <= cofm + ksw*oversampling + 0.5/oversampling)        ind = cond1 & cond2        cofm2 = calc_com(x[ind],kernel_full[ind])        # On the PSF oversampled grid:        x_psf_float = (x - cofm2)/oversampling # pixel position in units of native pixels (x_psf = 0 at center of mass)        k_psf_float = kernel_full*1.0          # kernel value associated with x_psf, not normalized yet.        for osamp in oversamplings:            k_bin, x_bin = bin_kernel(x_psf_float, k_psf_float, osamp, ksw)            kernels[(osamp, ksw)] = k_bin    return(kernels)def webbpsf_kernels(filename, angle, oversamplings, semi_widths,                    core_semi_width=15):    # Read and rotate a webbpsf PSF once, then generate its kernels at every    # requested oversampling and semi-width (see kernels_from_profile).    imagewarped, oversampling, dim = webbpsf_read_and_rotate(filename, angle)    kernel_full = collapse_psf(imagewarped, oversampling,                               core_semi_width=core_semi_width)    return(kernels_from_profile(kernel_full, oversampling, oversamplings,                                semi_widths))def library_kernels(library, wfe_index, wave_index, angle, oversamplings,                    semi_widths, core_semi_width=15):    # Same as webbpsf_kernels, for a PSF of a PSF library file (see    # build_psf_library in soss_generate_webbpsf.py). The library is    # memory-mapped so only that PSF is read.    with fits.open(library, memmap=True) as hdul:        oversampling = hdul[0].header['OVERSAMP']        image = np.array(hdul['PSF'].data[wfe_index, wave_index], dtype=float)    imagewarped = ndimage.rotate(image, angle*1.0)    kernel_full = collapse_psf(imagewarped, oversampling,                               core_semi_width=core_semi_width)    return(kernels_from_profile(kernel_full, oversampling, oversamplings,                                semi_widths))def generate_kernel(output_path, verbose=None, psf_path=None, kernel_semi_width=None,                    oversamplings=None, processes=1, library=None, wfe_real=None):    #verbose=False    # This is the function to call to generate the kernels.    # Others above are utility functions.    # Generate the spectral optics response of monochromatic light    # based on all webbpsf oversampled PSFs. That will be used in the    # optimal extraction alogirthm by Antoine Darveau-Bernier.    # This script will generate 10 matrices (10 images), each at a different    # pixel oversampling. Its long axis is the number of monochromatic    # wavelengths while its short axis is the spectral response kernel, an    # odd number, flux normalized to 1.    # Each webbpsf PSF is read, rotated and collapsed only once, then binned    # to all oversamplings (and kernel widths). The PSFs can be processed    # in parallel.    # kernel_semi_width: the kernel half-width(s), in native pixels. Either    #    one value or a list, in which case matrices are generated for each.    #    Default is 7.    # oversamplings: list of the pixel oversamplings of the matrices.    #    Default is 1 to 10.    # processes: the number of processes used to process the PSFs in    #    parallel. Default is 1 (no parallelization).    # library: a PSF library file (see build_psf_library in    #    soss_generate_webbpsf.py) to use instead of the webbpsf fits files    #    in psf_path.    # wfe_real: the WFE realization of the library to use. Default is None    #    (the default WFE realization).    if library is not None:        # Use all the wavelengths of the library.        lambdalist = 1e+6*fits.getdata(library, 'WAVELEN')        wfes = list(fits.getdata(library, 'WFE'))        done = fits.getdata(library, 'DONE')        wfe_index = wfes.index(-1 if wfe_real is None else wfe_real)        if np.all(done[wfe_index]) == False:            print('The PSF library is incomplete, run build_psf_library to resume it.')            return(False)        tasks = [(library_kernels, (library, wfe_index, n))                 for n in range(np.size(lambdalist))]    else:        # Determine where the webbpsf PSFs reside        if psf_path == None:            # Try on Loic's laptop:            psf_path = '/Users/albert/NIRISS/SOSSpipeline/webbpsf_psfs/'            if os.path.exists(psf_path) is False:                # Try guessing assuming github install                psf_path = './psflibrary/'        if os.path.exists(psf_path) is False:            print('Pass the path where webbpsfs are to generate_kernel(psf_path=...)')            return(False)        else:            print(psf_path)        # Call the function that looks on a predefined path for webbpsf fits files        # This will need editing when ran on a different machine or on a different        # set of files.        filename, lambdalist = webbpsf_return_listof(verbose=verbose,psf_path=psf_path)        tasks = [(webbpsf_kernels, (name,)) for name in filename]    # Define how wide the kernel should be in terms of native pixels.    # That is, this is the half-width of that kernel. The kernel will    # have size of ksw*2 + one element. in units of native pixels.    if kernel_semi_width is None:        kernel_semi_width = 7    semi_widths = np.atleast_1d(kernel_semi_width).astype(int)    if oversamplings is None:        osmax = 10        oversamplings = np.arange(osmax)+1    # The core_semi_width is a pixel distance along the spatial axis that    # defines what region of the trace to keep in the analysis.    core_semi_width = 15    # That is the tilt angle empirically seen in webbpsf's PSFs    angle = -3.0    # Read, rotate, crunch and bin each PSF once.    args = (angle, oversamplings, semi_widths, core_semi_width)    if processes > 1:        with ProcessPoolExecutor(max_workers=processes) as executor:            futures = [executor.submit(func, *targs, *args)                       for func, targs in tasks]            kernels = [future.result() for future in futures]    else:        kernels = [func(*targs, *args) for func, targs in tasks]    for ksw in semi_widths:        for osamp in oversamplings:            # The name of the output kernel matrix            matrix_name = '{:}/spectral_kernel_matrix_os_{:}_width_{:}pixels.fits'.format(output_path,osamp,ksw*2+1)            # Stack the kernels of all wavelengths            kernel_matrix = np.array([k[(osamp, ksw)] for k in kernels]).T            wavelength_matrix = np.zeros_like(kernel_matrix) + lambdalist            if verbose is True:                half = (np.shape(kernel_matrix)[0]-1)//2                x_bin = (np.arange(np.shape(kernel_matrix)[0])-half)/osamp                for n in range(np.size(lambdalist)):                    k_bin = kernel_matrix[:,n]                    # recalculate center of mass for a check only                    com = np.sum(k_bin*x_bin)/np.sum(k_bin)                    print('com=',com)                    # Show the compactness of the flux to see how well the tilt was guessed                    core = np.sum(k_bin[half-osamp*2:half+osamp*2])                    print('flux in core = {:}'.format(core))                    # print the kernel at each wavelength                    print(n, k_bin)                    # plot kernel                    plt.plot(x_bin,k_bin*osamp+0.04*n,marker='.',linestyle='-')                plt.axvline(x=0.0,color='red',zorder=-1)                plt.xlim((-ksw,ksw))                plt.xlabel('Native pixels')                plt.ylabel('Normalized Intensity (+ constant)')                plt.show()            # Save the rotated PSF on disk            hdu = fits.PrimaryHDU()            # Write the index of reddest end the monochromatic kernel            # That determines which direction the kernel goes with            # respect to your pixels.            #hdu.header['REDINDEX'], hdu.header['BLUINDEX'] = 0, np.size(k_bin)-1            hdu.header['REDINDEX'], hdu.header['BLUINDEX'] = np.shape(kernel_matrix)[0]-1, 0            hdu.data = [kernel_matrix,wavelength_matrix]            hdu.writeto(matrix_name,overwrite=True)
\ No newline at end of file
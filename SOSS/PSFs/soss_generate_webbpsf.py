@@ -6,11 +6,46 @@
 __author__ = "Loic Albert"
 
 
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import webbpsf
 import numpy as np
 from astropy.io import fits
 
 
+def niriss_instrument(wfe_real=None):
+    '''Utility function which sets up the WebbPSF NIRISS instrument for
+    SOSS mode observations.
+
+    Parameters
+    ----------
+    wfe_real : int
+        Index of wavefront realization to use for the PSF (if non-default
+        WFE realization is desired).
+
+    Returns
+    -------
+    niriss : webbpsf.NIRISS
+        The NIRISS instrument, with the CLEAR filter and GR700XD pupil.
+    '''
+
+    # Select the NIRISS instrument
+    niriss = webbpsf.NIRISS()
+
+    # Override the default minimum wavelength of 0.6 microns
+    niriss.SHORT_WAVELENGTH_MIN = 0.5e-6
+    # Set correct filter and pupil wheel components
+    niriss.filter = 'CLEAR'
+    niriss.pupil_mask = 'GR700XD'
+
+    # Change the WFE realization if desired
+    if wfe_real is not None:
+        niriss.pupilopd = ('OPD_RevW_ote_for_NIRISS_predicted.fits.gz',
+                           wfe_real)
+
+    return niriss
+
+
 def loicpsf(wavelist=None, wfe_real=None, save_to_disk=True):
     '''Utility function which calls the WebbPSF package to create monochromatic
     PSFs for NIRISS SOSS mode obserations.
@@ -42,18 +77,7 @@ def loicpsf(wavelist=None, wfe_real=None, save_to_disk=True):
     oversampling = 10
 
     # Select the NIRISS instrument
-    niriss = webbpsf.NIRISS()
-
-    # Override the default minimum wavelength of 0.6 microns
-    niriss.SHORT_WAVELENGTH_MIN = 0.5e-6
-    # Set correct filter and pupil wheel components
-    niriss.filter = 'CLEAR'
-    niriss.pupil_mask = 'GR700XD'
-
-    # Change the WFE realization if desired
-    if wfe_real is not None:
-        niriss.pupilopd = ('OPD_RevW_ote_for_NIRISS_predicted.fits.gz',
-                           wfe_real)
+    niriss = niriss_instrument(wfe_real)
 
     # Loop through all wavelengths to generate PSFs
     if save_to_disk is False:
@@ -75,3 +99,213 @@ def loicpsf(wavelist=None, wfe_real=None, save_to_disk=True):
         return psf_list
     else:
         return None
+
+
+def webbpsf_backend(wave, wfe_real=None, pixel=128, oversampling=10):
+    '''Default PSF backend of build_psf_library, which calls WebbPSF to
+    create one monochromatic SOSS PSF.
+    Any function with the same signature, returning an array of shape
+    (pixel*oversampling, pixel*oversampling), can be used as a backend.
+
+    Parameters
+    ----------
+    wave : float
+        Wavelength (in meters) of the PSF.
+    wfe_real : int
+        Index of wavefront realization to use for the PSF (None for the
+        default WFE realization).
+    pixel : int
+        Dimension of the PSF in native pixels.
+    oversampling : int
+        Pixel oversampling factor.
+
+    Returns
+    -------
+    psf : np.ndarray
+        The oversampled PSF.
+    '''
+
+    niriss = niriss_instrument(wfe_real)
+    psf = niriss.calc_psf(monochromatic=wave, fov_pixels=pixel,
+                          oversample=oversampling, display=False)
+
+    return psf[0].data
+
+
+def _library_offsets(filename):
+    '''Utility function which returns the header of the PSF cube of a PSF
+    library and the byte offsets of the PSF cube and DONE flags in the
+    file, so that they can be memory-mapped with numpy.
+    '''
+
+    with fits.open(filename, memmap=False, lazy_load_hdus=False) as hdul:
+        header = hdul['PSF'].header
+        psf_offset = hdul['PSF'].fileinfo()['datLoc']
+        done_offset = hdul['DONE'].fileinfo()['datLoc']
+
+    return header, psf_offset, done_offset
+
+
+def _create_psf_library(filename, wavelist, wfe_index, pixel, oversampling):
+    '''Utility function which creates an empty PSF library file. The PSF
+    cube is allocated on disk, without holding it in memory.
+    '''
+
+    nwave, nwfe = len(wavelist), len(wfe_index)
+    npix = pixel*oversampling
+
+    primary = fits.PrimaryHDU()
+    primary.header['PIXEL'] = (pixel, 'Dimension of the PSFs in native pixels')
+    primary.header['OVERSAMP'] = (oversampling, 'Pixel oversampling factor')
+    hdul = fits.HDUList([primary,
+                         fits.ImageHDU(np.asarray(wavelist, dtype=float),
+                                       name='WAVELEN'),
+                         fits.ImageHDU(np.asarray(wfe_index, dtype=np.int32),
+                                       name='WFE'),
+                         fits.ImageHDU(np.zeros((nwfe, nwave), dtype=np.uint8),
+                                       name='DONE')])
+    hdul.writeto(filename)
+
+    # Append the header of the PSF cube, then extend the file to its size.
+    header = fits.ImageHDU(np.zeros((1, 1, 1, 1), dtype=np.float32),
+                           name='PSF').header
+    header['NAXIS1'], header['NAXIS2'] = npix, npix
+    header['NAXIS3'], header['NAXIS4'] = nwave, nwfe
+    nbytes = nwfe*nwave*npix*npix*4
+    nbytes = -(-nbytes // 2880) * 2880  # FITS blocks are 2880 bytes.
+    with open(filename, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        f.write(header.tostring().encode('ascii'))
+        f.seek(nbytes - 1, os.SEEK_CUR)
+        f.write(b'\0')
+
+    return None
+
+
+def read_psf_library(filename, mode='r'):
+    '''Read a PSF library file created by build_psf_library. The PSFs are
+    memory-mapped, so only the PSFs that are used are read from disk.
+
+    The file contains the PSF cube, of shape (n_wfe, n_wave, npix, npix), in
+    the 'PSF' extension, the wavelengths (in meters) in the 'WAVELEN'
+    extension, the WFE realizations (-1 for the default one) in the 'WFE'
+    extension and flags indicating which PSFs were computed in the 'DONE'
+    extension.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the PSF library file.
+    mode : str
+        Mode of the memory-maps, 'r' (read-only) or 'r+' (read and write).
+
+    Returns
+    -------
+    psfs : np.memmap
+        The PSF cube, of shape (n_wfe, n_wave, npix, npix).
+    wavelist : np.ndarray
+        Wavelengths (in meters) of the PSFs.
+    wfe_index : np.ndarray
+        WFE realizations of the PSFs (-1 for the default one).
+    done : np.memmap
+        Flags of shape (n_wfe, n_wave), 1 where the PSF was computed.
+    '''
+
+    wavelist = fits.getdata(filename, 'WAVELEN')
+    wfe_index = fits.getdata(filename, 'WFE')
+    header, psf_offset, done_offset = _library_offsets(filename)
+
+    shape = (header['NAXIS4'], header['NAXIS3'], header['NAXIS2'],
+             header['NAXIS1'])
+    psfs = np.memmap(filename, dtype='>f4', mode=mode, offset=psf_offset,
+                     shape=shape)
+    done = np.memmap(filename, dtype=np.uint8, mode=mode, offset=done_offset,
+                     shape=shape[:2])
+
+    return psfs, wavelist, wfe_index, done
+
+
+def build_psf_library(filename, wavelist=None, wfe_reals=None, backend=None,
+                      processes=1, pixel=128, oversampling=10):
+    '''Create a library of monochromatic SOSS PSFs, for several wavelengths
+    and WFE realizations, stored in a single file (see read_psf_library).
+    The PSFs are computed in parallel over a process pool, and each one is
+    written to the file as soon as it is done. PSFs already present in the
+    file are skipped, so an interrupted run can be resumed by calling this
+    function again with the same arguments.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the PSF library file.
+    wavelist : list
+        List of wavelengths (in meters) for which to generate PSFs.
+        Defaults to 95 wavelengths between 0.5 and 5.2 microns.
+    wfe_reals : list
+        List of indices of the wavefront realizations (None for the default
+        WFE realization). Defaults to [None].
+    backend : callable
+        Function computing one PSF, with the signature of webbpsf_backend
+        (the default). It must be defined at the top level of a module to
+        be used with processes > 1.
+    processes : int
+        Number of processes used to compute the PSFs in parallel.
+        Defaults to 1 (no parallelization).
+    pixel : int
+        Dimension of the PSFs in native pixels.
+    oversampling : int
+        Pixel oversampling factor.
+
+    Returns
+    -------
+    None : NoneType
+        PSFs are written to disk.
+    '''
+
+    if wavelist is None:
+        # List of wavelengths to generate PSFs for
+        wavelist = np.linspace(0.5, 5.2, 95) * 1e-6
+    if wfe_reals is None:
+        wfe_reals = [None]
+    if backend is None:
+        backend = webbpsf_backend
+    wfe_index = [-1 if E is None else E for E in wfe_reals]
+
+    # Create the library, or check that the existing one matches.
+    if os.path.exists(filename) is False:
+        _create_psf_library(filename, wavelist, wfe_index, pixel, oversampling)
+    psfs, waves, wfes, done = read_psf_library(filename, mode='r+')
+    if (np.shape(waves) != np.shape(wavelist)
+            or not np.allclose(waves, wavelist, rtol=1e-10, atol=0)
+            or not np.array_equal(wfes, wfe_index)
+            or psfs.shape[-1] != pixel*oversampling):
+        raise ValueError('The PSF library {} was created with different '
+                         'wavelengths, WFE realizations or dimensions.'
+                         .format(filename))
+
+    # Only compute the missing PSFs.
+    todo = [(e, w) for e in range(len(wfe_reals))
+            for w in range(len(wavelist)) if done[e, w] == 0]
+    print('Computing {0:d} of {1:d} PSFs.'.format(len(todo), done.size))
+
+    def store(e, w, psf):
+        # The flag is only set once the PSF is on disk.
+        psfs[e, w] = psf
+        psfs.flush()
+        done[e, w] = 1
+        done.flush()
+
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(backend, wavelist[w], wfe_reals[e],
+                                       pixel, oversampling): (e, w)
+                       for e, w in todo}
+            for future in as_completed(futures):
+                e, w = futures.pop(future)
+                store(e, w, future.result())
+    else:
+        for e, w in todo:
+            store(e, w, backend(wavelist[w], wfe_reals[e], pixel,
+                                oversampling))
+
+    return None
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy.stats import binned_statistic
+
+import soss_generate_convolution_kernel as kernel
+
+OVERSAMPLING = 10
+OVERSAMPLINGS = np.arange(10) + 1
+SEMI_WIDTHS = [3, 7]
+
+
+def histogram_kernel(kernel_full, oversampling, osamp, ksw):
+    # Previous binning of generate_kernel: mean of the profile,
+    # linearly interpolated on 1e6 points, in each bin.
+    x = np.arange(np.size(kernel_full))
+    cofm = kernel.calc_com(x, kernel_full)
+    ind = ((x >= cofm - ksw*oversampling - 0.5/oversampling)
+           & (x <= cofm + ksw*oversampling + 0.5/oversampling))
+    cofm2 = kernel.calc_com(x[ind], kernel_full[ind])
+    x_psf = (x - cofm2)/oversampling
+    x_fine = np.linspace(-ksw-1, ksw+1, 1000000)
+    k_fine = np.interp(x_fine, x_psf, kernel_full)
+    nbins = (2*ksw*osamp)+1
+    k_bin, _, _ = binned_statistic(x_fine, k_fine, statistic='mean',
+                                   bins=nbins,
+                                   range=(-ksw-0.5/osamp, ksw+0.5/osamp))
+    k_bin = k_bin-np.min(k_bin)
+
+    return k_bin/np.sum(k_bin)
+
+
+@pytest.fixture(scope='module')
+def gaussian_kernels():
+    # Gaussian spectral profile, off-center, on the PSF oversampled grid
+    x = np.arange(1280)
+    kernel_full = np.exp(-0.5*((x - 643.7)/(1.5*OVERSAMPLING))**2)
+    kernels = kernel.kernels_from_profile(kernel_full, OVERSAMPLING,
+                                          OVERSAMPLINGS, SEMI_WIDTHS)
+
+    return kernel_full, kernels
+
+
+@pytest.mark.parametrize('ksw', SEMI_WIDTHS)
+@pytest.mark.parametrize('osamp', OVERSAMPLINGS)
+def test_kernels_from_profile(gaussian_kernels, osamp, ksw):
+    kernel_full, kernels = gaussian_kernels
+    k_bin = kernels[(osamp, ksw)]
+
+    # Size and unit normalization
+    assert k_bin.shape == (2*ksw*osamp+1,)
+    assert np.sum(k_bin) == pytest.approx(1., abs=1e-12)
+
+    # Centered on 0
+    x_bin = (np.arange(k_bin.size) - ksw*osamp)/osamp
+    assert np.sum(k_bin*x_bin) == pytest.approx(0., abs=1e-3)
+
+    # Same as the previous histogram binning
+    expected = histogram_kernel(kernel_full, OVERSAMPLING, osamp, ksw)
+    np.testing.assert_allclose(k_bin, expected, rtol=0, atol=1e-5)
@@ -11,6 +11,7 @@ Created on Wed Jun 17 14:02:42 2020
 
 import sys
 sys.path.insert(0, "trace/")
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import tracepol as tp
 import matplotlib.pyplot as plt
@@ -52,6 +53,70 @@ def tilt_vs_spectralpixel(wavelength_micron, order):
         stop
     return(tilt_degrees)
      
+# Cache of the tilt tables, per order and tilt table file.
+_tilt_tables = {}
+
+def get_tilt_table(order, tilt_table=None, nwave=5001):
+    # Return the monochromatic tilt table of a spectral order (1 or 2),
+    # computed once and cached: the wavelengths (in microns) of a uniform
+    # grid, the tilt (in degrees) and the slope of the tilt at these
+    # wavelengths.
+    # tilt_table: the name of the 3-column table describing the tilt (see
+    #    make_2D_wavemap) or the table itself, an array of shape (n, 3). If
+    #    None, the tilt_vs_spectralpixel() function above is tabulated.
+    #    A table already tabulated by this function is returned as is.
+    # nwave: the number of wavelengths of the uniform grid.
+
+    if isinstance(tilt_table, tuple):
+        return(tilt_table)
+
+    # Tables given as arrays are not cached, so resample them once (for
+    # example in make_2D_wavemap) and pass the tabulated table instead.
+    key = None
+    if isinstance(tilt_table, str) or tilt_table is None:
+        key = (order, tilt_table, nwave)
+        if key in _tilt_tables:
+            return(_tilt_tables[key])
+
+    if tilt_table is None:
+        wavelength = np.linspace(0.5, 5.5, nwave)
+        tilt = tilt_vs_spectralpixel(wavelength, order=order)
+    else:
+        if isinstance(tilt_table, str):
+            tilt_table = np.loadtxt(tilt_table)
+        # Resample the table on a uniform grid.
+        tilt_table = np.asarray(tilt_table, dtype=float)
+        isort = np.argsort(tilt_table[:,0])
+        wavelength = np.linspace(tilt_table[isort[0],0],
+                                 tilt_table[isort[-1],0], nwave)
+        tilt = np.interp(wavelength, tilt_table[isort,0],
+                         tilt_table[isort,order])
+    slope = np.diff(tilt)/np.diff(wavelength)
+    table = (wavelength, tilt, slope)
+
+    if key is not None:
+        _tilt_tables[key] = table
+
+    return(table)
+
+def tilt_interp(wavelength_micron, order, tilt_table=None):
+    # Return the monochromatic tilt (in degrees) for an array of wavelengths
+    # (in microns), linearly interpolated in the cached tilt table of that
+    # order (see get_tilt_table). As the table is uniform in wavelength,
+    # the interval of each wavelength is found directly, without a search.
+    # The tilt is constant beyond the ends of the table.
+    # This function can also be given as the tilt of tracepol's
+    # wavelength_map_2d(), which calls it as tilt(wavelength, m).
+
+    wavelength, tilt, slope = get_tilt_table(order, tilt_table=tilt_table)
+    step = (wavelength[-1]-wavelength[0])/(np.size(wavelength)-1)
+    wavelength_micron = np.clip(wavelength_micron, wavelength[0],
+                                wavelength[-1])
+    i = ((wavelength_micron-wavelength[0])/step).astype(int)
+    i = np.minimum(i, np.size(wavelength)-2)
+
+    return(tilt[i] + (wavelength_micron-wavelength[i])*slope[i])
+
 def image_native_to_DMS(image):
     # This function converts from ds9 (native) to DMS coordinates.
     # x_dms = y_native, y_dms = 2048-x_native
@@ -71,8 +136,56 @@ def image_native_to_DMS(image):
 
 
 
+def wavelength_search(x_queried, y_queried, x, y, lba, order,
+                      tilt_constant=None, gain=-1.0, niter=5, tilt_table=None):
+    # Find the wavelength of pixels (x_queried, y_queried), arrays of any
+    # shape, by projecting them back to the trace center iteratively along
+    # the monochromatic tilt. All pixels are processed at once.
+    # x, y: the trace center positions (native pixels) at wavelengths lba.
+    # gain: the gain of the iterative approach to finding the wavelength.
+    # niter: the number of iterations.
+    # tilt_table: the tilt table used if tilt_constant is None (see
+    #    get_tilt_table).
+
+    delta_y = np.zeros(np.broadcast(x_queried, y_queried).shape)
+    for iter in range(niter):
+        # Assume all x have same lambda
+        lba_queried = np.interp(y_queried+gain*delta_y, y, lba)
+        # Monochromatic tilt at that wavelenength is:
+        if tilt_constant is not None:
+            tilt_tmp = np.copy(tilt_constant)
+        else:
+            tilt_tmp = tilt_interp(lba_queried, order,
+                                   tilt_table=tilt_table)
+        # Plug the lambda to spit out the x,y
+        x_estimate = np.interp(lba_queried, lba, x)
+        y_estimate = np.interp(lba_queried, lba, y)
+        # Project that back to requested x assuming a tilt of tilt_degree
+        y_iterated = y_estimate + \
+            (x_queried-x_estimate) * \
+            np.tan(np.deg2rad(tilt_tmp))
+        # Measure error between requested and iterated position
+        delta_y = delta_y + (y_iterated-y_queried)
+
+    return lba_queried
+
+
+def _wavemap_chunk(i_range, dimy, xpad, ypad, os, x, y, lba, order,
+                   tilt_constant, gain, tilt_table):
+    # Wavelengths of the columns i_range (the spatial axis) of the map,
+    # for all pixels of the spectral axis. Called by make_2D_wavemap.
+
+    x_queried = np.arange(*i_range)/os-xpad
+    y_queried = np.arange((dimy+2*ypad)*os)/os-ypad
+
+    return wavelength_search(x_queried[None, :], y_queried[:, None], x, y,
+                             lba, order, tilt_constant=tilt_constant,
+                             gain=gain, tilt_table=tilt_table)
+
+
 def make_2D_wavemap(subarray_name, coordinate_system, fitsmap_name,
-                    tilt_table, tilt_constant=None, oversampling=1):
+                    tilt_table, tilt_constant=None, oversampling=1,
+                    nchunk=64, processes=1):
 
     # This script generates and writes on disk the reference file that
     # describes the wavelength at the center of each pixel in the subarray.
@@ -84,12 +197,17 @@ def make_2D_wavemap(subarray_name, coordinate_system, fitsmap_name,
     # tilt_table: the name of the 3-column table describing the monochromatic
     #    tilt as a function of wavelength (in microns). Interpolation will be 
     #    made from that table. Col 1 = microns, col 2 = first order, col 3 = 
-    #    second order.
+    #    second order. If None, the tilt_vs_spectralpixel() function above
+    #    is used. Either is tabulated once per order (see get_tilt_table).
     # tilt_constant: if that is set then its value is the monochromatic tilt
     #    in degrees whose value is constant for all wavelengths. It then
     #    bypasses the tilt described in the tilt_table.
     # The convention for the tilt sign is described in the 
     # tilt_vs_spectralpixel() function above.
+    # nchunk: the number of (oversampled) spatial columns computed at once,
+    #    which bounds the memory used by the search.
+    # processes: the number of processes used to compute the chunks in
+    #    parallel. Default is 1 (no parallelization).
     
     
     # Assuming that tracepol is oriented in the ds9 (native detector) coordinates,
@@ -119,62 +237,52 @@ def make_2D_wavemap(subarray_name, coordinate_system, fitsmap_name,
     xpad = 0 # not required
     ypad = 0 # not required
     # The oversampling is an integer number that will scale the output 2D map
-    os = np.copy(oversampling)
+    os = int(oversampling)
     lambda_map = np.zeros((2,(dimy+2*ypad)*os,(dimx+2*xpad)*os))
     
     # The gain is for the iterative appraoch to finding the wavelength
     gain = -1.0
     
-    for m in range(1): # repeat for each order
-    
+    # Get the trace parameters, function found in tracepol imported above
+    trace_file = './trace/NIRISS_GR700_trace_extended.csv'
+    tracepars = tp.get_tracepars(trace_file)
+
+    # Chunks of spatial columns.
+    ncols = (dimx+2*xpad)*os
+    chunks = [(i, min(i+nchunk, ncols)) for i in range(0, ncols, nchunk)]
+
+    for m in range(2): # repeat for each order
+
         order = m+1
         # First, query the x,y for order m+1 (so order 1 or 2)
-        # Get the trace parameters, function found in tracepol imported above
-        trace_file = './trace/NIRISS_GR700_trace_extended.csv'
-        tracepars = tp.get_tracepars(trace_file)
         # Get wavelength (in um) of first and last pixel of the Order m trace
         lba = np.linspace(0.6,3.0,2401)
-        x, y, mask = tp.wavelength2xy(lba, tracepars, m=order)
-        # WARNING WARNING WARNING
-        # As of this writing (June 29 2020), tracepol was using the old Jason
-        # coordinate system for its traces. Until that is corrected such that
-        # we can call tracepol with a coordinate_system option (DS9 or DMS or JASON)
-        # then we need to resort to the following axis flip.
-        # END OF WARNING    
-        xtmp = np.copy(x)
-        x = np.copy(y)
-        y = np.copy(xtmp)
-        # REMOVE THE ABOVE LINES WHEN tracepol has been fixed and a call is made
-        # with the DS9 coordinate system.    
-    
-        # Loop over spectral order (m), spatial axis (x) and spectral axis (y)
+        # In the native (ds9) frame of tracepol, the spectral axis is along
+        # y and the spatial axis along x.
+        y, x, mask = tp.wavelength_to_pix(lba, tracepars, m=order,
+                                          frame='nat')
+
+        # Tabulate the tilt of this order only once for all chunks.
+        if tilt_constant is None:
+            tilt = get_tilt_table(order, tilt_table=tilt_table)
+        else:
+            tilt = None
+
         # For each pixel, project back to trace center iteratively to
-        # recover the wavelength.
-        for i in range((dimx+2*xpad)*os): # the spatial axis
-            print(i)
-            for j in range((dimy+2*ypad)*os): # the spectral axis
-                x_queried = np.float(i)/os-xpad
-                y_queried = np.float(j)/os-ypad
-                delta_y = 0.0
-                for iter in range(5):
-                    # Assume all x have same lambda
-                    lba_queried = np.interp(y_queried+gain*delta_y,y,lba)
-                    # Monochromatic tilt at that wavelenength is:
-                    if tilt_constant != None:
-                        tilt_tmp = np.copy(tilt_constant)
-                    else:
-                        tilt_tmp = tilt_vs_spectralpixel(lba_queried,order=order)                   
-                    # Plug the lambda to spit out the x,y
-                    x_estimate = np.interp(lba_queried, lba, x)
-                    y_estimate = np.interp(lba_queried, lba, y)
-                    # Project that back to requested x assuming a tilt of tilt_degree
-                    #x_iterated = np.copy(x_queried) not used?
-                    y_iterated = y_estimate + \
-                        (x_queried-x_estimate) * \
-                        np.tan(np.deg2rad(tilt_tmp))
-                    # Measure error between requested and iterated position
-                    delta_y = delta_y + (y_iterated-y_queried)
-                lambda_map[m,j,i] = lba_queried
+        # recover the wavelength. All pixels of a chunk of spatial
+        # columns (x) are processed at once.
+        args = (dimy, xpad, ypad, os, x, y, lba, order, tilt_constant, gain,
+                tilt)
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(_wavemap_chunk, i_range, *args)
+                           for i_range in chunks]
+                for i_range, future in zip(chunks, futures):
+                    lambda_map[m, :, i_range[0]:i_range[1]] = future.result()
+        else:
+            for i_range in chunks:
+                lambda_map[m, :, i_range[0]:i_range[1]] = \
+                    _wavemap_chunk(i_range, *args)
 
     # Crop or expand to the appropriate size for the subarray.
     if subarray_name == 'SUBSTRIP96':
@@ -11,9 +11,11 @@ interpolated trace in the overlap region for SOSS order 1.
 
 import warnings
 warnings.filterwarnings('ignore')
+from concurrent.futures import ProcessPoolExecutor
 import webbpsf
 import numpy as np
 from astropy.io import fits
+from scipy.optimize import least_squares
 import matplotlib.pyplot as plt
 import emcee
 import corner
@@ -27,38 +29,145 @@ def chromescale(wave, profile, invert=False):
     ''' Utility function to remove the lambda/D chromatic PSF
     scaling by interpolating a monochromatic PSF function onto
     a standard axis.
+    Many profiles can be rescaled at once by passing an array of
+    wavelengths and a stack of profiles.
 
     Parameters
     ----------
-    wave : float
-        Wavelength corresponding to the input 1D PSF profile.
+    wave : float or array of floats
+        Wavelength corresponding to the input 1D PSF profile, or
+        wavelengths of each profile of the stack.
     profile : list of floats
-        1D PSF profile to be rescaled.
+        1D PSF profile to be rescaled, or stack of profiles of shape
+        (len(wave), npix). The profiles are centered on pixel npix//2
+        (49 pixels in the trace model).
     invert : bool
         If True, add back the lambda/D scaling instead of removing it.
 
     Returns
     -------
     new : list of floats
-        Rescaled 1D PSF profile.
+        Rescaled 1D PSF profile, or stack of rescaled profiles.
     '''
 
-    # Create the standard axis
-    rnge = np.linspace(0, round(49*(2.5/wave), 0) - 1, 49)
-    offset = rnge[24] - 24
+    wave = np.asarray(wave, dtype=float)
+    profile = np.asarray(profile, dtype=float)
+    npix = profile.shape[-1]
+    center = npix // 2
+
+    # Create the standard axis (np.linspace(0, stop, npix) for each wavelength).
+    stop = np.round(npix*(2.5/np.atleast_1d(wave)), 0) - 1
+    rnge = np.arange(npix) * (stop / (npix - 1))[:, None]
+    rnge[:, -1] = stop
+    offset = rnge[:, center:center+1] - center
 
     # Interpolate the profile onto the standard axis.
     if invert is False:
-        new = np.interp(np.arange(49), rnge - offset, profile)
+        new = _interp_rows(np.arange(npix), rnge - offset, profile)
     # Or interpolate the profile from the standard axis to re-add
     # the lambda/D scaling.
     else:
-        new = np.interp(rnge - offset, np.arange(49), profile)
+        new = _interp_rows(rnge - offset, np.arange(npix), profile)
+
+    # A single profile.
+    if wave.ndim == 0 and profile.ndim == 1:
+        new = new[0]
 
     return new
 
 
-def derive_model(make_psfs=False, doplot=True, F277W=True, filepath=''):
+def _get_wfe_profiles(wfe_real, wave_range, make_psfs=False, filepath=''):
+    ''' Utility function to read (or generate) the monochromatic PSFs of
+    one WFE realization and collapse them into 1D profiles. Called by
+    derive_model.
+
+    Parameters
+    ----------
+    wfe_real : int
+        Index of the WFE realization.
+    wave_range : array of floats
+        Wavelengths (in µm) of the monochromatic PSFs.
+    make_psfs : bool
+        Whether or not WebbPSF will have to generate the PSFs.
+    filepath : str
+        Path to directory containing the WebbPSF monochromatic PSF fits
+        files, or the directory to which they will be stored when made.
+
+    Returns
+    -------
+    profiles : numpy array
+        1D PSF profiles, of shape (len(wave_range), 1280).
+    '''
+
+    # Create the PSFs if user has indicated to.
+    if make_psfs is True:
+        loicpsf(wavelist=wave_range*1e-6, wfe_real=wfe_real, filepath=filepath)
+
+    profiles = []
+    for w in wave_range:
+        fname = '{0:s}SOSS_os10_128x128_{1:.6f}_{2:.0f}.fits'.format(filepath, w, wfe_real)
+        try:
+            psf = fits.getdata(fname, 0)
+        # Generate missing PSFs if necessary.
+        except FileNotFoundError:
+            print('No monochromatic PSF found for {0:.1f}µm and WFE realization {1:.0f}.'
+                  .format(w, wfe_real))
+            loicpsf(wavelist=[w*1e-6], wfe_real=wfe_real, filepath=filepath)
+            psf = fits.getdata(fname, 0)
+        profiles.append(np.sum(psf[600:700, :], axis=0))
+
+    return np.array(profiles)
+
+
+def _get_library_profiles(library, wave_range, wfe_reals):
+    ''' Utility function to read the 1D profiles of the monochromatic PSFs
+    from a PSF library file (see build_psf_library in
+    SOSS/PSFs/soss_generate_webbpsf.py). The PSF cube is memory-mapped, so
+    only the rows used for the profiles are read. Called by derive_model.
+
+    Parameters
+    ----------
+    library : str
+        Name of the PSF library file.
+    wave_range : array of floats
+        Wavelengths (in µm) of the monochromatic PSFs.
+    wfe_reals : list of int
+        Indices of the WFE realizations.
+
+    Returns
+    -------
+    profiles : numpy array
+        1D PSF profiles, of shape (len(wfe_reals), len(wave_range), 1280).
+    '''
+
+    with fits.open(library, memmap=True) as hdul:
+        waves = hdul['WAVELEN'].data*1e6
+        wfes = list(hdul['WFE'].data)
+        done = hdul['DONE'].data
+
+        # Indices of the requested PSFs in the library.
+        iw = [np.argmin(np.abs(waves - w)) for w in wave_range]
+        if not np.allclose(waves[iw], wave_range, rtol=0, atol=1e-6):
+            raise ValueError('Not all wavelengths are in the PSF library {}.'
+                             .format(library))
+        try:
+            ie = [wfes.index(E) for E in wfe_reals]
+        except ValueError:
+            raise ValueError('Not all WFE realizations are in the PSF library {}.'
+                             .format(library))
+        if not np.all(done[np.ix_(ie, iw)]):
+            raise ValueError('The PSF library {} is incomplete, run '
+                             'build_psf_library to resume it.'.format(library))
+
+        psfs = hdul['PSF'].data
+        profiles = np.array([[np.sum(psfs[e, w, 600:700, :], axis=0, dtype=float)
+                              for w in iw] for e in ie])
+
+    return profiles
+
+
+def derive_model(make_psfs=False, doplot=True, F277W=True, filepath='',
+                 processes=1, library=None):
     ''' Function to derive the interpolation coefficients necessary to
     interpolate a monochromatic PSF profile at any wavelength between
     the two 1D PSF anchor profiles.
@@ -80,6 +189,14 @@ def derive_model(make_psfs=False, doplot=True, F277W=True, filepath=''):
         Path to directory containing the WebbPSF monochromatic PSF fits
         files, or the directory to which they will be stored when made.
         Defaults to the current directory.
+    processes : int
+        Number of processes used to read (or generate) the PSFs of the
+        WFE realizations in parallel. Defaults to 1 (no parallelization).
+    library : str
+        Name of a PSF library file (see build_psf_library in
+        SOSS/PSFs/soss_generate_webbpsf.py). If given, the profiles are read
+        from the library instead of the individual PSF fits files, and
+        make_psfs and filepath are ignored.
 
     Returns
     -------
@@ -98,85 +215,50 @@ def derive_model(make_psfs=False, doplot=True, F277W=True, filepath=''):
     else:
         wave_range = np.linspace(2.2, 2.5, 7)
 
-    # Read in monochromatic PSFs generated by WebbPSF.
-    PSFs = []
-    # Loop over all 10 available WFE realizations.
-    for i in range(10):
-        psf_run = []
-        # Create the PSF if user has indicated to.
-        if make_psfs is True:
-            loicpsf(wavelist=wave_range*1e-6, wfe_real=i)
-        # If user already has PSFs generated.
-        for w in wave_range:
-            try:
-                psf_run.append(fits.open('{0:s}SOSS_os10_128x128_{1:.6f}_{2:.0f}.fits'
-                                         .format(filepath, w, i))[0].data)
-            # Generate missing PSFs if necessary.
-            except FileNotFoundError:
-                print('No monochromatic PSF found for {0:.1f}µm and WFE realization {1:.0f}.'
-                      .format(w, i))
-                loicpsf(wavelist=[w*1e-6], wfe_real=i, filepath=filepath)
-                psf_run.append(fits.open('{0:s}SOSS_os10_128x128_{1:.6f}_{2:.0f}.fits'
-                                         .format(filepath, w, i))[0].data)
-        PSFs.append(psf_run)
-
-    # Determine interpolation coefficients for all WFEs
-    wb, wr = [], []
-
-    for E in range(10):
-        # Generate the blue wavelength anchor.
-        # The width of the 1D PSF has lambda/D dependence, so rescale all
-        # profiles to a common wavelength to remove these chromatic effects.
-        rnge2 = np.linspace(0, round(1280*(2.5/2.2), 0) - 1, 1280)
-        offset2 = rnge2[640] - 640
-        new2 = np.interp(np.arange(1280), rnge2 - offset2,
-                         np.sum(PSFs[E][0][600:700, :], axis=0))
-
-        # Generate the red wavelength anchor.
-        if F277W is False:
-            # Use 2.8µm for CLEAR.
-            rnger = np.linspace(0, round(1280*(2.5/2.8), 0) - 1, 1280)
-        else:
-            # Or 2.5µm for F277W.
-            rnger = np.linspace(0, round(1280*(2.5/2.5), 0) - 1, 1280)
-        offsetr = rnger[640] - 640
-        # Remove lambda/D scaling.
-        newr = np.interp(np.arange(1280), rnger - offsetr,
-                         np.sum(PSFs[E][6][600:700, :], axis=0))
-
-        # Loop over all monochrmatic PSFs to determine interpolation coefs.
-        for f, wave in enumerate(wave_range):
-            # Lists for running counts of indicies and model residuals.
-            resid, II, JJ = [], [], []
-
-            # Rescale monochrmotic PSF to remove lambda/D.
-            newrnge = np.linspace(0, round(1280*(2.5/wave), 0) - 1, 1280)
-            newoffset = newrnge[640] - 640
-            newpsf = np.interp(np.arange(1280), newrnge - newoffset,
-                               np.sum(PSFs[E][f][600:700, :], axis=0))
-
-            # Brute force the coefficient determination.
-            # It should only take a minute or so.
-            for i in range(1, 100):
-                for j in range(1, 100):
-                    I = i / 10
-                    J = j / 10
-                    # Create a test profile which is a mix of the two anchors.
-                    mix = (I*new2 + J*newr) / (I + J)
-
-                    # Save current iteration in running counts.
-                    resid.append(np.sum(np.abs(newpsf - mix)[450:820]))
-                    II.append(I)
-                    JJ.append(J)
-
-            # Determine which combination of indices minimizes model residuals.
-            ind = np.where(resid == np.min(resid))[0][0]
-            # Save the normalized indices for this wavelength.
-            wb.append(II[ind] / (II[ind] + JJ[ind]))
-            wr.append(JJ[ind] / (II[ind] + JJ[ind]))
-
-    wb = np.reshape(wb, (10, 7))
-    wr = np.reshape(wr, (10, 7))
+    # Read in the 1D profiles of the monochromatic PSFs generated by WebbPSF,
+    # for all 10 available WFE realizations.
+    wfe_reals = range(10)
+    if library is not None:
+        PSFs = _get_library_profiles(library, wave_range, wfe_reals)
+    elif processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_get_wfe_profiles, E, wave_range,
+                                       make_psfs, filepath) for E in wfe_reals]
+            PSFs = np.array([future.result() for future in futures])
+    else:
+        PSFs = np.array([_get_wfe_profiles(E, wave_range, make_psfs, filepath)
+                         for E in wfe_reals])
+
+    # The width of the 1D PSF has lambda/D dependence, so rescale all
+    # profiles to a common wavelength to remove these chromatic effects.
+    waves = np.broadcast_to(wave_range, PSFs.shape[:2])
+    newpsfs = chromescale(waves.ravel(), PSFs.reshape(-1, PSFs.shape[-1]))
+    newpsfs = newpsfs.reshape(PSFs.shape)
+
+    # The blue (2.2µm) and red (2.8µm for CLEAR, or 2.5µm for F277W)
+    # wavelength anchors.
+    new2 = newpsfs[:, :1, 450:820]
+    newr = newpsfs[:, -1:, 450:820]
+
+    # Each profile is modelled as a mix of the two anchors,
+    # mix = wb*new2 + (1 - wb)*newr, which is linear in the blue weight wb.
+    # The sum of the absolute residuals, sum(|diff_psf - wb*diff_anch|),
+    # is then minimized by the median of diff_psf/diff_anch weighted by
+    # |diff_anch|, so the weights of all wavelengths and WFE realizations
+    # are obtained at once, without a grid search.
+    diff_anch = np.broadcast_to(new2 - newr, newpsfs[:, :, 450:820].shape)
+    diff_psf = newpsfs[:, :, 450:820] - newr
+    weight = np.abs(diff_anch)
+    ratio = np.divide(diff_psf, diff_anch, out=np.zeros_like(diff_psf),
+                      where=weight > 0)
+    isort = np.argsort(ratio, axis=-1)
+    ratio = np.take_along_axis(ratio, isort, axis=-1)
+    cumweight = np.cumsum(np.take_along_axis(weight, isort, axis=-1), axis=-1)
+    imed = np.argmax(cumweight >= cumweight[..., -1:]/2, axis=-1)
+    wb = np.take_along_axis(ratio, imed[..., None], axis=-1)[..., 0]
+    # Keep the mix between the two anchors.
+    wb = np.clip(wb, 0, 1)
+    wr = 1 - wb
 
     # Fit a second order polynomial to the mean of the interpolation indices.
     pb = np.polyfit(wave_range, np.mean(wb, axis=0), 2)
@@ -189,10 +271,12 @@ def derive_model(make_psfs=False, doplot=True, F277W=True, filepath=''):
     return pb, pr, wb, wr
 
 
-def do_emcee(xOM, yOM, xCV, yCV):
+def do_emcee(xOM, yOM, xCV, yCV, initial=None, nsteps=5000, pool=None):
     ''' Utility function which calls the emcee package to preform
     an MCMC determination of the best fitting rotation angle/center to
-    map the OM onto the data.
+    map the OM onto the data. The log-probabilities of all walkers are
+    evaluated at once (see log_probability_walkers), unless a pool is
+    given to distribute the walkers.
 
     Parameters
     ----------
@@ -202,6 +286,14 @@ def do_emcee(xOM, yOM, xCV, yCV):
     xCV, yCV : array of floats
         X and Y trace centroids determined from the data, for example:
         returned by get_data_centroids.
+    initial : array of floats
+        Initial guess of the parameters (angle, X and Y rotation center),
+        for example: returned by fit_om2det.
+    nsteps : int
+        Number of MCMC steps.
+    pool : object
+        Pool with a map method (e.g. multiprocessing.Pool) used to evaluate
+        the walkers in parallel, instead of the vectorized evaluation.
 
     Returns
     -------
@@ -210,128 +302,406 @@ def do_emcee(xOM, yOM, xCV, yCV):
     '''
 
     # Set up the MCMC run.
-    initial = np.array([1, 1577, 215])  # Initial guess parameters
+    if initial is None:
+        initial = np.array([1, 1577, 215])  # Initial guess parameters
     pos = initial + 0.5*np.random.randn(32, 3)
     nwalkers, ndim = pos.shape
 
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, log_probability,
-                                    args=[xOM, yOM, xCV, yCV])
+    if pool is None:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, log_probability_walkers,
+                                        args=[xOM, yOM, xCV, yCV],
+                                        vectorize=True)
+    else:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, log_probability,
+                                        args=[xOM, yOM, xCV, yCV], pool=pool)
     # Run the MCMC for 5000 steps - it has generally converged
     # within ~3000 steps in trial runs.
-    sampler.run_mcmc(pos, 5000, progress=False)
+    sampler.run_mcmc(pos, nsteps, progress=False)
 
     return sampler
 
 
-def get_data_centroids(stack, atthesex=None):
+def fit_om2det(xOM, yOM, xCV, yCV):
+    ''' Deterministic determination of the best fitting rotation
+    angle/center to map the OM onto the data (see rot_om2det), with the
+    same residuals as log_likelihood.
+    The rigid transformation (rotation and translation) is first solved in
+    closed form (Procrustes), then refined by Levenberg-Marquardt, which
+    also gives the covariance of the parameters.
+
+    Parameters
+    ----------
+    xOM, yOM : array of floats
+        X and Y trace centroids respectively in the optics model system,
+        for example: returned by get_om_centroids.
+    xCV, yCV : array of floats
+        X and Y trace centroids determined from the data, for example:
+        returned by get_data_centroids.
+
+    Returns
+    -------
+    params : numpy array of floats
+        Best fitting angle, X and Y rotation center.
+    cov : numpy array of floats
+        Covariance matrix of the parameters, scaled by the reduced chi2
+        of the residuals.
+    '''
+
+    # Centroids compared by log_likelihood.
+    xom, yom, xcv, ycv = _om2det_pairs(xOM, yOM, xCV, yCV)
+
+    # The known rotation of the OM onto the detector
+    # (no rotation in the detector frame for ang = -0.95).
+    xb, yb = rot_om2det(-0.95, 0, 0, xom, yom)
+
+    # Closed form rigid transformation (2D Procrustes).
+    xbc, ybc = xb - np.mean(xb), yb - np.mean(yb)
+    xcc, ycc = xcv - np.mean(xcv), ycv - np.mean(ycv)
+    t = np.arctan2(np.sum(xbc*ycc - ybc*xcc), np.sum(xbc*xcc + ybc*ycc))
+    R = np.array([[np.cos(t), -np.sin(t)], [np.sin(t), np.cos(t)]])
+    trans = (np.array([np.mean(xcv), np.mean(ycv)])
+             - R @ np.array([np.mean(xb), np.mean(yb)]))
+    # The rotation center giving the same translation. I - R is singular
+    # for a null rotation, so the default center (see do_emcee) is kept
+    # if the rotation is too small or the center outside of the priors.
+    initial = np.array([np.degrees(t) - 0.95, 1577., 215.])
+    if np.abs(t) > 1e-6:
+        cen = np.linalg.solve(np.eye(2) - R, trans)
+        if np.isfinite(log_prior([initial[0], cen[0], cen[1]])):
+            initial[1:] = cen
+
+    # Refine with Levenberg-Marquardt.
+    def residuals(theta):
+        modelx, modely = rot_om2det(theta[0], theta[1], theta[2], xom, yom)
+        return np.concatenate([xcv - modelx, ycv - modely])
+
+    result = least_squares(residuals, initial, method='lm')
+    params = result.x
+
+    # Covariance of the parameters.
+    dof = max(result.fun.size - params.size, 1)
+    chi2 = np.sum(result.fun**2) / dof
+    cov = np.linalg.pinv(result.jac.T @ result.jac) * chi2
+
+    if not np.isfinite(log_prior(params)):
+        warnings.warn('The rotation parameters are outside of the prior range.')
+
+    return params, cov
+
+
+def _interp_rows(x, xp, fp):
+    ''' Utility function to linearly interpolate many rows at once,
+    equivalent to np.interp(x[k], xp[k], fp[k]) for each row k.
+
+    Parameters
+    ----------
+    x : numpy array of floats
+        Coordinates where to interpolate, of shape (n, m) or (m,).
+    xp : numpy array of floats
+        Increasing coordinates of the data points, of shape (n, p) or (p,).
+    fp : numpy array of floats
+        Values of the data points, of shape (n, p) or (p,).
+
+    Returns
+    -------
+    f : numpy array of floats
+        The interpolated values, of shape (n, m).
+    '''
+
+    x, xp, fp = np.atleast_2d(x, xp, fp)
+    nrows = max(len(x), len(xp), len(fp))
+    npts = xp.shape[-1]
+    x = np.broadcast_to(x, (nrows, x.shape[-1]))
+    xp = np.broadcast_to(xp, (nrows, npts))
+    fp = np.broadcast_to(fp, (nrows, npts))
+
+    # Search all rows at once, by shifting each row after the previous one.
+    shift = np.max(xp) - np.min(xp) + np.max(x) - np.min(x) + 1
+    shift = shift * np.arange(nrows)[:, None]
+    index = np.searchsorted((xp + shift).ravel(), (x + shift).ravel(), side='right')
+    index = index.reshape(x.shape) - npts * np.arange(nrows)[:, None]
+    index = np.clip(index, 1, npts - 1)
+
+    # Linear interpolation between the closest points.
+    x0 = np.take_along_axis(xp, index - 1, axis=1)
+    x1 = np.take_along_axis(xp, index, axis=1)
+    f0 = np.take_along_axis(fp, index - 1, axis=1)
+    f1 = np.take_along_axis(fp, index, axis=1)
+    f = f0 + (f1 - f0) / (x1 - x0) * (x - x0)
+
+    # Constant outside the data points.
+    f = np.where(x < xp[:, :1], fp[:, :1], f)
+    f = np.where(x >= xp[:, -1:], fp[:, -1:], f)
+
+    return f
+
+
+def _nanpercentile_rows(values, q):
+    ''' Utility function equivalent to np.nanpercentile(values, q, axis=-2)
+    (with linear interpolation), but vectorized over the columns instead of
+    looping on them. Called by get_data_centroids.
+
+    Parameters
+    ----------
+    values : numpy array of floats
+        Pixel values, of shape (..., rows, columns).
+    q : float
+        Percentile to compute.
+
+    Returns
+    -------
+    percentile : numpy array of floats
+        Percentile of each column, of shape (..., columns).
+    '''
+
+    # Sorted columns (the NaNs are at the end) and number of finite values.
+    values = np.sort(values, axis=-2)
+    nvalid = np.sum(np.isfinite(values), axis=-2)
+
+    # Linear interpolation between the closest ranks.
+    rank = (nvalid - 1) * (q / 100)
+    below = np.clip(np.floor(rank), 0, None).astype(int)
+    above = np.minimum(below + 1, np.maximum(nvalid - 1, 0))
+    frac = rank - below
+    a = np.take_along_axis(values, below[..., None, :], axis=-2)[..., 0, :]
+    b = np.take_along_axis(values, above[..., None, :], axis=-2)[..., 0, :]
+    diff = b - a
+    percentile = np.where(frac < 0.5, a + diff*frac, b - diff*(1 - frac))
+
+    return np.where(nvalid > 0, percentile, np.nan)
+
+
+def _window_centroids(values, lower, upper):
+    ''' Utility function to compute the center-of-mass of all columns at
+    once, using only the finite pixels of the rows lower <= row < upper.
+    Called by get_data_centroids.
+
+    Parameters
+    ----------
+    values : numpy array of floats
+        Pixel values, of shape (..., rows, columns).
+    lower, upper : numpy array of ints
+        First and last (excluded) rows of the window of each column,
+        of shape (..., columns).
+
+    Returns
+    -------
+    centroids : numpy array of floats
+        Y centroid of each column, of shape (..., columns).
+    '''
+
+    row = np.arange(values.shape[-2])[:, None]
+    inwindow = (row >= lower[..., None, :]) & (row < upper[..., None, :])
+    vals = np.where(inwindow & np.isfinite(values), values, 0)
+
+    return np.sum(row*vals, axis=-2) / np.sum(vals, axis=-2)
+
+
+def get_data_centroids(stack, atthesex=None, nframes=16):
     ''' Determine the x, y positions of the order 1 trace centroids from an
     exposure using a center-of-mass analysis.
     This is an adaptation of Loïc's get_order1_centroids which can better
     deal with a bright second order.
+    All columns are processed at once, and a cube of frames (for example
+    the integrations of a TSO) can be passed to get the trace positions of
+    each frame in one call.
 
     Parameters
     ----------
     stack : numpy array of floats
-        Data frame.
+        Data frame, or cube of data frames of shape (frames, rows, columns).
     atthesex : list of floats
         Pixel x values at which to extract the trace centroids.
+    nframes : int
+        Number of frames of a cube processed at once (limits the memory).
 
     Returns
     -------
     tracexbest : list of floats
         Best estimate data x centroid.
     traceybest : list of floats
-        Best estimate data y centroids.
+        Best estimate data y centroids. For a cube, the centroids of
+        each frame, of shape (frames, columns).
+    '''
+
+    stack = np.asarray(stack)
+
+    # A single frame.
+    if stack.ndim == 2:
+        return _get_data_centroids(stack)
+
+    # Process a cube of frames in chunks.
+    traceys = []
+    for k in range(0, stack.shape[0], nframes):
+        tracex_best, tracey = _get_data_centroids(stack[k:k + nframes])
+        traceys.append(tracey)
+
+    return tracex_best, np.concatenate(traceys)
+
+
+def _get_data_centroids(stack):
+    ''' Vectorized centroiding of get_data_centroids, for a frame or
+    a cube of frames (frames, rows, columns).
     '''
 
     # Dimensions of the subarray.
-    dimx = np.shape(stack)[1]
-    dimy = np.shape(stack)[0]
+    dimx = np.shape(stack)[-1]
+    dimy = np.shape(stack)[-2]
 
     # Identify the floor level of all 2040 working pixels to subtract it first.
-    floorlevel = np.nanpercentile(stack, 10, axis=0)
+    floorlevel = _nanpercentile_rows(stack, 10)
     backsubtracted = stack*1
-    for i in range(dimx-8):
-        backsubtracted[:, i] = stack[:, i] - floorlevel[i]
+    backsubtracted[..., :, :dimx-8] = (stack[..., :, :dimx-8]
+                                       - floorlevel[..., None, :dimx-8])
+
+    # Only the working columns are used.
+    tracex_best = np.arange(4, dimx - 4)
+    columns = backsubtracted[..., :, 4:dimx-4]
+    shape = columns.shape[:-2] + columns.shape[-1:]
 
     # Find centroid - first pass, use all pixels in the column.
-    tracex = []
-    tracey = []
-    row = np.arange(dimy)
-    for i in range(dimx - 8):
-        val = backsubtracted[:, i + 4] / np.nanmax(backsubtracted[:, i + 4])
-        ind = np.where(np.isfinite(val))
-        thisrow = row[ind]
-        thisval = val[ind]
-        cx = np.sum(thisrow * thisval) / np.sum(thisval)
-        tracex.append(i + 4)
-        tracey.append(cx)
-
-    # Adopt these trace values as best
-    tracex_best = np.array(tracex) * 1
-    tracey_best = np.array(tracey) * 1
+    tracey_best = _window_centroids(columns, np.zeros(shape, dtype=int),
+                                    np.full(shape, dimy))
 
     # Second pass, find centroid on a subset of pixels
     # from an area around the centroid determined earlier.
-    tracex = []
-    tracey = []
-    row = np.arange(dimy)
     w = 30
-    for i in range(dimx - 8):
-        miny = np.int(np.nanmax([np.around(tracey_best[i] - w), 0]))
-        maxy = np.int(np.nanmax([np.around(tracey_best[i] + w), dimy - 1]))
-        val = backsubtracted[miny:maxy, i + 4] / np.nanmax(backsubtracted[:, i + 4])
-        ind = np.where(np.isfinite(val))
-        thisrow = (row[miny:maxy])[ind]
-        thisval = val[ind]
-        cx = np.sum(thisrow * thisval) / np.sum(thisval)
-
-        # For a bright second order, it is likely that the centroid at this
-        # point will be somewhere in between the first and second order.
-        # If this is the case (i.e. the pixel value of the centroid is very low
-        # compared to the column average), restrict the range of pixels
-        # considered to be above the current centroid.
-        if backsubtracted[int(cx)][i+4] < np.nanmean(backsubtracted[(int(cx) - w):(int(cx)+w), i+4]):
-            miny = np.int(np.nanmax([np.around(cx), 0]))
-            maxy = np.int(np.nanmin([np.around(cx + 2*w), dimy - 1]))
-            val = backsubtracted[miny:maxy, i + 4] / np.nanmax(backsubtracted[:, i + 4])
-            ind = np.where(np.isfinite(val))
-            thisrow = (row[miny:maxy])[ind]
-            thisval = val[ind]
-            cx = np.sum(thisrow * thisval) / np.sum(thisval)
-
-            tracex.append(i + 4)
-            tracey.append(cx)
-
-        else:
-            tracex.append(i + 4)
-            tracey.append(cx)
+    miny = np.maximum(np.around(tracey_best - w), 0).astype(int)
+    maxy = np.maximum(np.around(tracey_best + w), dimy - 1).astype(int)
+    cx = _window_centroids(columns, miny, maxy)
+
+    # For a bright second order, it is likely that the centroid at this
+    # point will be somewhere in between the first and second order.
+    # If this is the case (i.e. the pixel value of the centroid is very low
+    # compared to the column average), restrict the range of pixels
+    # considered to be above the current centroid.
+    icx = np.trunc(cx).astype(int)
+    value = np.take_along_axis(columns, (icx % dimy)[..., None, :], axis=-2)[..., 0, :]
+    # Mean in the rows int(cx) - w to int(cx) + w (as a python slice).
+    start = np.where(icx - w < 0, icx - w + dimy, icx - w)
+    row = np.arange(dimy)[:, None]
+    inwindow = (row >= start[..., None, :]) & (row < (icx + w)[..., None, :])
+    inwindow &= np.isfinite(columns)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (np.sum(np.where(inwindow, columns, 0), axis=-2)
+                / np.sum(inwindow, axis=-2))
+    contaminated = value < mean
+
+    miny = np.maximum(np.around(cx), 0).astype(int)
+    maxy = np.minimum(np.around(cx + 2*w), dimy - 1).astype(int)
+    cx_above = _window_centroids(columns, miny, maxy)
 
     # Adopt these trace values as best.
-    tracex_best = np.array(tracex) * 1
-    tracey_best = np.array(tracey) * 1
+    tracey_best = np.where(contaminated, cx_above, cx)
 
     # Third pass - fine tuning.
-    tracex = []
-    tracey = []
-    row = np.arange(dimy)
     w = 16
-    for i in range(dimx - 8):
-        miny = np.int(np.nanmax([np.around(tracey_best[i] - w), 0]))
-        maxy = np.int(np.nanmax([np.around(tracey_best[i] + w), dimy - 1]))
-        val = backsubtracted[miny:maxy, i + 4] / np.nanmax(backsubtracted[:, i + 4])
-        ind = np.where(np.isfinite(val))
-        thisrow = (row[miny:maxy])[ind]
-        thisval = val[ind]
-        cx = np.sum(thisrow * thisval) / np.sum(thisval)
+    miny = np.maximum(np.around(tracey_best - w), 0).astype(int)
+    maxy = np.maximum(np.around(tracey_best + w), dimy - 1).astype(int)
+    tracey_best = _window_centroids(columns, miny, maxy)
 
-        tracex.append(i + 4)
-        tracey.append(cx)
+    return tracex_best, tracey_best
 
-    tracex_best = np.array(tracex)
-    tracey_best = np.array(tracey)
 
-    return tracex_best, tracey_best
+def get_interp_profiles(tp2, Banch, Ranch, pb, pr, start, rlen):
+    ''' Create the interpolated 1D PSF profiles of order 1 at rlen
+    consecutive spectral pixels, from the blue and red anchor profiles.
+    These only depend on the optics model, so they can be put on the
+    detector for any rotation with place_profiles. Called by makemod.
+
+    Parameters
+    ----------
+    tp2 : dict
+        Trace polynomial coefficients, for example: as returned by
+        get_om_centroids.
+    Banch, Ranch : array of floats
+        Blue and red anchor profiles (49 pixels), without the lambda/D
+        scaling.
+    pb, pr : list of floats
+        Polynomial coefficients of the interpolation indices of the blue
+        and red anchors respectively.
+    start : float
+        First spectral pixel (OM frame) of the interpolation.
+    rlen : int
+        Number of spectral pixels to interpolate.
+
+    Returns
+    -------
+    cenx_int, ceny_int : array of floats
+        X and Y centroids of the profiles in the OM frame.
+    newmint : array of floats
+        Interpolated profiles, of shape (rlen, 49).
+    '''
+
+    # Wavelength and Y centroid at each X centroid.
+    cenx_int = start + np.arange(rlen)
+    lmbd = tp.specpix_to_wavelength(cenx_int, tp2, 1)[0]
+    ceny_int = 256 - tp.wavelength_to_pix(lmbd, tp2, 1)[1]
+
+    # Evaluate the interpolation polynomials at the correct wavelengths
+    # and construct the interpolated 1D PSFs.
+    wbi = np.polyval(pb, lmbd)
+    wri = np.polyval(pr, lmbd)
+    mixint = wbi[:, None]*Banch + wri[:, None]*Ranch
+
+    # Re-add the lambda/D scaling to the interpolated profiles.
+    newmint = chromescale(lmbd, mixint, invert=True)
+
+    return cenx_int, ceny_int, newmint
+
+
+def place_profiles(newmint, cenx_int, ceny_int, ang, xanch, yanch):
+    ''' Put the interpolated 1D PSF profiles (see get_interp_profiles) on
+    the detector, given the transformation from the OM to the detector.
+    Called by makemod.
+
+    Parameters
+    ----------
+    newmint : array of floats
+        Interpolated profiles, of shape (n, 49).
+    cenx_int, ceny_int : array of floats
+        X and Y centroids of the profiles in the OM frame.
+    ang : float
+        The rotation angle in degrees CCW (see rot_om2det).
+    xanch, yanch : float
+        The X and Y rotation center (see rot_om2det).
+
+    Returns
+    -------
+    map2D : numpy array of floats
+        Detector frame (256, 2048) with the profiles, NaN elsewhere.
+    rend, bend : int
+        Detector X coordinates of the red and blue edges of the profiles.
+    '''
+
+    # Transform the OM centroids onto the detector.
+    cenx, ceny = rot_om2det(ang, xanch, yanch, cenx_int, ceny_int)
+    cols = cenx.astype(int)
+
+    # Put the interpolated profiles on the detector.
+    # For whatever reason in the news tracepols implementation all the Y
+    # centroids shifted up by ~1 pixel. So subtract 1 to cancel this until
+    # the root cause can be determined.
+    axis = np.linspace(-24, 24, 49) + ceny[:, None] - 1
+    # Only use the profile inside the detector, the values outside are
+    # replaced by the closest value inside (as np.interp extrapolates).
+    inside = (axis < 256) & (axis >= 0)
+    first = np.argmax(inside, axis=1)
+    last = 48 - np.argmax(inside[:, ::-1], axis=1)
+    index = np.clip(np.arange(49), first[:, None], last[:, None])
+    profiles = np.take_along_axis(newmint, index, axis=1)
+    bear = _interp_rows(np.arange(256.), axis, profiles)
+
+    # Subtract the noisy wing edges.
+    bear = bear - _nanpercentile_rows(bear.T, 2.5)[:, None]
+
+    map2D = np.zeros((256, 2048))*np.nan
+    map2D[:, cols] = bear.T
+
+    # Detector coordinates of the edges of the interpolated region.
+    rend, bend = cols[0], cols[-1]
+
+    return map2D, rend, bend
 
 
 def get_om_centroids(atthesex=None):
@@ -366,13 +736,27 @@ def get_om_centroids(atthesex=None):
     return xOM, yOM[::-1], tp2
 
 
+def _om2det_pairs(xOM, yOM, xCV, yCV):
+    ''' Utility function which returns the OM and data centroids compared
+    by log_likelihood and fit_om2det (OM centroids 4 to 1004 against the
+    first 1000 data centroids), where all of them are finite.
+    '''
+
+    xom, yom = np.asarray(xOM)[4:1004], np.asarray(yOM)[4:1004]
+    xcv, ycv = np.asarray(xCV)[:1000], np.asarray(yCV)[:1000]
+    good = np.isfinite(xom) & np.isfinite(yom) & np.isfinite(xcv) & np.isfinite(ycv)
+
+    return xom[good], yom[good], xcv[good], ycv[good]
+
+
 def log_likelihood(theta, xvals, yvals, xCV, yCV):
     ''' Definition of the log likelihood. Called by do_emcee.
     '''
     ang, orx, ory = theta
-    modelx, modely = rot_om2det(ang, orx, ory, xvals, yvals)
+    xom, yom, xcv, ycv = _om2det_pairs(xvals, yvals, xCV, yCV)
+    modelx, modely = rot_om2det(ang, orx, ory, xom, yom)
 
-    return -0.5 * np.sum(((xCV[:1000] - modelx[4:1004])**2 + (yCV[:1000] - modely[4:1004])**2)
+    return -0.5 * np.sum(((xcv - modelx)**2 + (ycv - modely)**2)
                          - 0.5 * np.log(2 * np.pi * 1))
 
 
@@ -397,6 +781,26 @@ def log_probability(theta, xvals, yvals, xCV, yCV):
     return lp + log_likelihood(theta, xvals, yvals, xCV, yCV)
 
 
+def log_probability_walkers(thetas, xvals, yvals, xCV, yCV):
+    ''' Vectorized log_probability of all walkers (thetas of shape
+    (walkers, 3)). Called by do_emcee.
+    '''
+    ang, orx, ory = np.asarray(thetas).T
+
+    # Same transformation as rot_om2det, for all walkers at once.
+    xom, yom, xcv, ycv = _om2det_pairs(xvals, yvals, xCV, yCV)
+    modelx, modely = _rot_om2det_samples(ang, orx, ory, xom, yom)
+
+    lnlike = -0.5 * np.sum(((xcv - modelx)**2 + (ycv - modely)**2)
+                           - 0.5 * np.log(2 * np.pi * 1), axis=1)
+
+    # Same priors as log_prior.
+    inprior = ((-15 <= ang) & (ang < 15) & (-4048 < orx) & (orx < 4048)
+               & (-456 < ory) & (ory < 456))
+
+    return np.where(inprior, lnlike - 1, -np.inf)
+
+
 def loicpsf(wavelist=None, wfe_real=None, filepath=''):
     ''' Utility function which calls the WebbPSF package to create
     monochromatic PSFs for NIRISS SOSS obserations and save them to disk.
@@ -456,7 +860,7 @@ def loicpsf(wavelist=None, wfe_real=None, filepath=''):
     return None
 
 
-def makemod(clear, F277, do_plots=False, filename=None):
+def makemod(clear, F277, do_plots=False, filename=None, use_mcmc=False):
     ''' This creates the full order 1 trace profile model. The region
     contaminated by the second order is interpolated from the CLEAR and F277W
     exposures, or just from the CLEAR exposure and a standard red anchor if
@@ -474,6 +878,9 @@ def makemod(clear, F277, do_plots=False, filename=None):
         Whether to show the diagnostic plots.
     filename : str
         Name of file to which to write the trace model.
+    use_mcmc : bool
+        If True, determine the rotation between the optics model and the
+        data with MCMC (do_emcee) instead of the deterministic fit_om2det.
 
     Returns
     -------
@@ -492,17 +899,19 @@ def makemod(clear, F277, do_plots=False, filename=None):
     if do_plots is True:
         plot_centroid(clear, xCV, yCV)
 
-    # Use MCMC to brute force find the best fitting angle and rotation center
-    # necessary to transform the OM coordinates into the data frame.
-    ang_samp = do_emcee(xOM, yOM, xCV, yCV)
-    # Show the MCMC results in a corner plot if necessary.
-    if do_plots is True:
-        plot_corner(ang_samp)
-    # The MCMC results have been well behaved in all test cases.
-    flat_samples = ang_samp.get_chain(discard=500, thin=15, flat=True)
-    ang = np.percentile(flat_samples[:, 0], 50)
-    xanch = np.percentile(flat_samples[:, 1], 50)
-    yanch = np.percentile(flat_samples[:, 2], 50)
+    # Find the best fitting angle and rotation center necessary
+    # to transform the OM coordinates into the data frame.
+    params, cov = fit_om2det(xOM, yOM, xCV, yCV)
+    # Or use MCMC, starting from the deterministic solution.
+    if use_mcmc is True:
+        ang_samp = do_emcee(xOM, yOM, xCV, yCV, initial=params)
+        # Show the MCMC results in a corner plot if necessary.
+        if do_plots is True:
+            plot_corner(ang_samp)
+        # The MCMC results have been well behaved in all test cases.
+        flat_samples = ang_samp.get_chain(discard=500, thin=15, flat=True)
+        params = np.percentile(flat_samples, 50, axis=0)
+    ang, xanch, yanch = params
 
     # Determine the anchor profiles - blue anchor.
     # Note that the X-value returned from the optics model are inverted
@@ -565,8 +974,6 @@ def makemod(clear, F277, do_plots=False, filename=None):
         pb = [2.04327661, -12.90780135, 19.50319999]
         pr = [-2.04327661, 12.90780135, -18.50319999]
 
-    # Create the interpolated order 1 PSF.
-    map2D = np.zeros((256, 2048))*np.nan
     # Pixel coordinate at which to start and end the interpolation in OM frame.
     # I would be suprised if these are robust long term and should probably
     # be improved in some way.
@@ -577,39 +984,11 @@ def makemod(clear, F277, do_plots=False, filename=None):
         start = 307.5
         rlen = 303
     # Create an interpolated 1D PSF at each required position.
-    for i in range(rlen):
-        cenx_int = start + i
-        lmbd = tp.specpix_to_wavelength(cenx_int, tp2, 1)[0]  # Wavelength at each centroid
-        ceny_int = 256 - tp.wavelength_to_pix(lmbd, tp2, 1)[1]  # Y centroid at each X
-
-        # Transform the OM centroids onto the detector.
-        cenx, ceny = rot_om2det(ang, xanch, yanch, cenx_int, ceny_int)
-
-        # Evaluate the interpolation polynomials at the correct wavelength
-        # and construct the interpolated 1D PSF.
-        wbi = np.polyval(pb, lmbd)
-        wri = np.polyval(pr, lmbd)
-        mixint = (wbi*Banch + wri*Ranch)
-
-        # Re-add the lambda/D scaling to the interpolated profile.
-        newmint = chromescale(lmbd, mixint, invert=True)
-
-        # Put the interpolated profile on the detector.
-        # For whatever reason in the news tracepols implementation all the Y
-        # centroids shifted up by ~1 pixel. So subtract 1 to cancel this until
-        # the root cause can be determined.
-        axis = np.linspace(-24, 24, 49) + ceny - 1
-        inds = np.where((axis < 256) & (axis >= 0))[0]
-        bear = np.interp(np.arange(256), axis[inds], newmint[inds])
-
-        # Subtract the noisy wing edges.
-        map2D[:, int(cenx)] = bear - np.nanpercentile(bear, 2.5)
-
-        # Note detector coordinates of the edges of the interpolated region.
-        if i == rlen - 1:
-            bend = int(cenx)
-        elif i == 0:
-            rend = int(cenx)
+    cenx_int, ceny_int, newmint = get_interp_profiles(tp2, Banch, Ranch, pb, pr,
+                                                      start, rlen)
+    # Put them on the detector.
+    map2D, rend, bend = place_profiles(newmint, cenx_int, ceny_int, ang,
+                                       xanch, yanch)
 
     # Stitch together the interpolation and data to make the complete
     # order 1 PSF.
@@ -627,7 +1006,7 @@ def makemod(clear, F277, do_plots=False, filename=None):
     newmap = newmap / np.nanmax(newmap, axis=0)
     # Create a mask to remove the influence of the second order
     # in the CLEAR data.
-    O1frame = mask_order1(newmap, flat_samples, xOM, yOM)
+    O1frame = mask_order1(newmap, params, xOM, yOM)
 
     # Write the trace model to disk if requested.
     if filename is not None:
@@ -640,7 +1019,58 @@ def makemod(clear, F277, do_plots=False, filename=None):
         return O1frame
 
 
-def mask_order1(frame, flat_samples, xOM, yOM):
+def get_order1_mask(params, xOM, yOM):
+    ''' Utility function to create the pixel mask of the first order
+    trace: the pixels of each column between 21 pixels below and 20 pixels
+    above the trace centroid, over the extent of the trace. The mask is
+    computed at once from the distances of all pixels to the trace, for one
+    or several sets of transformation parameters.
+
+    Parameters
+    ----------
+    params : numpy array of floats
+        Angle, X and Y rotation center of the optics model to detector
+        transformation, of shape (3,), or of shape (n, 3) for n sets of
+        parameters (e.g. MCMC samples, or one set per integration).
+    xOM, yOM : numpy array of floats
+        X and Y centroids coordinates respectively in the optics
+        model coordinate frame.
+
+    Returns
+    -------
+    mask : numpy array of bool
+        The mask, of shape (256, 2048), or (n, 256, 2048) for n sets of
+        parameters.
+    '''
+
+    params = np.asarray(params, dtype=float)
+    thetas = np.atleast_2d(params)
+
+    # Get trace centroids in the detector frame, sorted along X.
+    xMod, yMod = _rot_om2det_samples(thetas[:, 0], thetas[:, 1],
+                                     thetas[:, 2], xOM, yOM)
+    isort = np.argsort(xMod, axis=1)
+    xMod = np.take_along_axis(xMod, isort, axis=1)
+    yMod = np.take_along_axis(yMod, isort, axis=1)
+
+    # Trace centroid at each detector column, within the extent of the trace.
+    cols = np.arange(2048)
+    ytrace = _interp_rows(cols, xMod, yMod).astype(int)
+    extent = ((cols >= xMod[:, :1].astype(int))
+              & (cols <= xMod[:, -1:].astype(int)))
+
+    # Distance of every pixel to the trace centroid of its column.
+    dist = np.arange(256)[:, None] - ytrace[:, None, :]
+    mask = (dist >= -21) & (dist < 20) & extent[:, None, :]
+
+    # A single set of parameters.
+    if params.ndim == 1:
+        mask = mask[0]
+
+    return mask
+
+
+def mask_order1(frame, params, xOM, yOM, per_sample=False):
     ''' Utility function to create a pixel mask to remove the second
     order trace from the CLEAR exposure once it has been stitched into
     the full order 1 trace model.
@@ -648,36 +1078,37 @@ def mask_order1(frame, flat_samples, xOM, yOM):
     Parameters
     ----------
     frame : numpy array of floats
-        Data frame.
-    flat_samples : numpy array of floats
-        MCMC samples from which the optics model to detector transformation
-        are determined. For example: as returned by do_emcee.
+        Data frame, or stack of frames of shape (n, 256, 2048) if
+        per_sample is True.
+    params : numpy array of floats
+        Angle, X and Y rotation center of the optics model to detector
+        transformation. For example: as returned by fit_om2det. MCMC
+        samples (as returned by do_emcee) are also accepted, in which
+        case their median is used.
     xOM, yOM : numpy array of floats
         X and Y centroids coordinates respectively in the optics
         model coordinate frame.
+    per_sample : bool
+        If True, params of shape (n, 3) are n sets of parameters (e.g. one
+        per integration) and a mask is made for each, applied to the
+        corresponding frame of the stack (or to the same frame).
 
     Returns
     -------
     O1frame : numpy array of floats
         The input data frame, with all pixels not within
-        the first order trace profile masked.
+        the first order trace profile masked. A stack of frames of shape
+        (n, 256, 2048) if per_sample is True.
     '''
 
-    mask = np.zeros([256, 2048])
-
-    # Get trace centroids in the detctor frame.
-    xMod, yMod = rot_om2det(np.percentile(flat_samples[:, 0], 50),
-                            np.percentile(flat_samples[:, 1], 50),
-                            np.percentile(flat_samples[:, 2], 50), xOM, yOM)
-    xx = xMod.astype(int)
-    yy = yMod.astype(int)
-    xr = np.linspace(np.min(xx), np.max(xx), np.max(xx)+1).astype(int)
+    # Use the median of the MCMC samples.
+    if np.ndim(params) == 2 and per_sample is False:
+        params = np.percentile(params, 50, axis=0)
 
     # Set all pixels within the extent of the order 1 trace to 1 in the mask.
-    for xxx, yyy in zip(xr, yy):
-        mask[(yyy-21):(yyy+20), xxx] = 1
+    mask = get_order1_mask(params, xOM, yOM).astype(float)
 
-    O1frame = (mask * frame) / np.nanmax(mask*frame, axis=0)
+    O1frame = (mask * frame) / np.nanmax(mask*frame, axis=-2, keepdims=True)
 
     return O1frame
 
@@ -803,3 +1234,18 @@ def rot_om2det(ang, cenx, ceny, xval, yval):
     # inds = [(b2[0]>=0) & (b2[0]<=2047)]
 
     return rot_pix[0], rot_pix[1]
+
+
+def _rot_om2det_samples(ang, cenx, ceny, xval, yval):
+    ''' Vectorized rot_om2det, for n sets of transformation parameters
+    at once (ang, cenx and ceny of shape (n,)). Returns the X and Y
+    detector coordinates, of shape (n, len(xval)).
+    '''
+
+    xb, yb = rot_om2det(-0.95, 0, 0, xval, yval)
+    t = (ang[:, None]+0.95)*np.pi / 180
+    dx, dy = xb - cenx[:, None], yb - ceny[:, None]
+    xdet = np.cos(t)*dx - np.sin(t)*dy + cenx[:, None]
+    ydet = np.sin(t)*dx + np.cos(t)*dy + ceny[:, None]
+
+    return xdet, ydet
@@ -0,0 +1,340 @@
+"""
+Benchmarks of the extraction tools.
+Each `bench_*` function compares the current implementation
+with a reference (usually the previous, loop-based, implementation
+kept here) and returns a dictionnary with the timings in seconds.
+"""
+from timeit import repeat
+
+import numpy as np
+from scipy.sparse import diags, random as sparse_random
+
+# Local imports
+from .convolution import cut_ker, sparse_c
+from .solvers import SOLVERS, solve
+from .utils import oversample_grid, uneven_grid
+
+
+def time_it(fct, *args, n_repeat=5, number=1, **kwargs):
+    """
+    Return the best execution time of `fct(*args, **kwargs)`
+    over `n_repeat` repetitions of `number` calls.
+    """
+    times = repeat(lambda: fct(*args, **kwargs),
+                   repeat=n_repeat, number=number)
+
+    return np.min(times) / number
+
+
+def cut_ker_loop(ker, n_out=None, thresh=None):
+    """
+    Reference implementation of `convolution.cut_ker`,
+    looping over the kernel columns.
+    """
+    # Assign kernel length and number of kernels
+    n_ker, n_k_c = ker.shape
+
+    # Assign half-length of the kernel
+    h_len = (n_ker - 1) // 2
+
+    # Determine n_out with thresh if not given
+    if n_out is None:
+        if thresh is None:
+            return ker
+        else:
+            i_left = np.where(ker[:, 0] >= thresh)[0][0]
+            i_right = np.where(ker[:, -1] >= thresh)[0][-1]
+            i_left = np.min([i_left, h_len])
+            i_right = np.max([i_right, h_len])
+    else:
+        try:
+            i_left, i_right = n_out
+        except TypeError:
+            i_left, i_right = n_out, n_out
+        i_left = np.max([h_len - i_left, 0])
+        i_right = np.min([h_len + i_right, n_ker - 1])
+
+    # Apply the cut
+    for i_k in range(0, i_left):
+        if i_k < n_k_c:
+            ker[:i_left-i_k, i_k] = 0
+    for i_k in range(i_right + 1 - n_ker, 0):
+        if -i_k <= n_k_c:
+            ker[i_right-n_ker-i_k:, i_k] = 0
+
+    return ker
+
+
+def sparse_c_diags(ker, n_k, i_zero=0):
+    """
+    Reference implementation of `convolution.sparse_c`,
+    passing each diagonal to `scipy.sparse.diags`.
+    """
+    # Assign kernel length and convolved axis length
+    n_ker, n_k_c = ker.shape
+
+    # Assign half-length
+    h_len = (n_ker - 1) // 2
+
+    # Define each diagonal of the sparse convolution matrix
+    diag_val, offset = [], []
+    for i_ker, i_k_c in enumerate(range(-h_len, h_len+1)):
+        i_k = i_zero + i_k_c
+        if i_k < 0:
+            diag_val.append(ker[i_ker, -i_k:])
+        else:
+            diag_val.append(ker[i_ker, :])
+        offset.append(i_k)
+
+    # Build convolution matrix
+    return diags(diag_val, offset, shape=(n_k_c, n_k), format="csr")
+
+
+def bench_c_matrix(n_k=40000, n_ker=201, i_zero=100, n_out=50,
+                   n_repeat=5):
+    """
+    Compare `cut_ker` and `sparse_c` with their loop-based
+    reference implementations on a random compact kernel.
+
+    Parameters
+    ----------
+    n_k: int, optional
+        length of the (non-convolved) grid. Default is 40000,
+        which is typical of a highly oversampled SOSS grid.
+    n_ker: int, optional
+        length of the kernel (odd). Default is 201.
+    i_zero: int, optional
+        position of the first element of the convolved grid
+        in the original grid.
+    n_out: int, optional
+        number of kernel's grid point to keep on the boundaries.
+    n_repeat: int, optional
+        number of repetitions for the timings.
+    Output
+    ------
+    dictionnary of the timings and of the maximum absolute difference
+    between the matrices.
+    """
+    # Random compact kernel (N_ker, N_k_convolved)
+    n_k_c = n_k - 2 * i_zero
+    ker = np.random.rand(n_ker, n_k_c)
+
+    # Check that both implementations give the same results
+    ker_ref = cut_ker_loop(ker.copy(), n_out=n_out)
+    ker_new = cut_ker(ker.copy(), n_out=n_out)
+    c_ref = sparse_c_diags(ker_ref, n_k, i_zero)
+    c_new = sparse_c(ker_new, n_k, i_zero)
+    max_diff = abs(c_ref - c_new).max()
+
+    # Timings
+    out = {'max_diff': max_diff}
+    args = {'n_repeat': n_repeat}
+    out['cut_ker_loop'] = time_it(cut_ker_loop, ker.copy(),
+                                  n_out=n_out, **args)
+    out['cut_ker'] = time_it(cut_ker, ker.copy(), n_out=n_out, **args)
+    out['sparse_c_diags'] = time_it(sparse_c_diags, ker_ref,
+                                    n_k, i_zero, **args)
+    out['sparse_c'] = time_it(sparse_c, ker_new, n_k, i_zero, **args)
+
+    return out
+
+
+def get_test_system(n_k=5000, n_band=50, density=0.5, seed=None, lsq=False):
+    """
+    Generate a random symmetric positive definite banded system A.x = b,
+    similar to the normal equations built by the extraction.
+    A = B_T.B and b = B_T.data, where B is a random banded matrix.
+
+    Parameters
+    ----------
+    n_k: int, optional
+        length of the grid (so A has the shape (n_k, n_k)).
+    n_band: int, optional
+        half-width of the band of the matrix.
+    density: float, optional
+        density of non-zero elements inside the band.
+    seed: int, optional
+        seed of the random generator.
+    lsq: bool, optional
+        If True, return the least-squares system B.x = data instead
+        (same system as the normal equations A.x = b).
+    Output
+    ------
+    a_mat (sparse csr matrix), b_vec (1d array)
+    or b_mat (sparse csr matrix), data (1d array) if `lsq` is True.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Random banded matrix B, so A = B_T.B is SPD
+    b_mat = sparse_random(n_k, n_k, density=density * n_band / n_k,
+                          random_state=rng, format='csr')
+    offsets = np.arange(-n_band, n_band + 1)
+    band = diags(np.ones(len(offsets)), offsets, shape=(n_k, n_k))
+    b_mat = (b_mat.multiply(band) + diags(np.ones(n_k))).tocsr()
+    a_mat = (b_mat.T.dot(b_mat)).tocsr()
+
+    # Right hand side from a random solution
+    data = b_mat.dot(rng.random(n_k))
+    if lsq:
+        return b_mat, data
+
+    b_vec = b_mat.T.dot(data)
+
+    return a_mat, b_vec
+
+
+def bench_solvers(a_mat=None, b_vec=None, solvers=None,
+                  n_repeat=3, **kwargs):
+    """
+    Compare the sparse solvers of `solvers.SOLVERS`.
+
+    Parameters
+    ----------
+    a_mat: matrix-like object (2d), optional
+        matrix A in the system to solve A.x = b.
+        Default is a random system from `get_test_system`.
+    b_vec: vector-like object (1d), optional
+        vector b in the system to solve A.x = b
+    solvers: list of str, optional
+        Names of the solvers to compare. Default is all solvers.
+    n_repeat: int, optional
+        number of repetitions for the timings.
+    kwargs:
+        passed to `get_test_system` if `a_mat` is not given.
+    Output
+    ------
+    dictionnary with the timing and the relative residual
+    ||A.x - b|| / ||b|| for each solver.
+    """
+    if a_mat is None:
+        a_mat, b_vec = get_test_system(**kwargs)
+
+    if solvers is None:
+        solvers = list(SOLVERS.keys())
+
+    out = {}
+    for name in solvers:
+        sln = solve(a_mat, b_vec, solver=name)
+        res = np.linalg.norm(a_mat.dot(sln) - b_vec)
+        res /= np.linalg.norm(b_vec)
+        out[name] = {'time': time_it(solve, a_mat, b_vec, solver=name,
+                                     n_repeat=n_repeat),
+                     'residual': res}
+
+    return out
+
+
+def oversample_grid_loop(lam_grid, n_os=1):
+    """
+    Reference implementation of `utils.oversample_grid`,
+    looping over the oversampling and sorting the output.
+    """
+    # Convert n_os to array
+    n_os = np.array(n_os)
+
+    # n_os needs to have the dimension:
+    # len(lam_grid) - 1
+    if n_os.ndim == 0:
+        n_os = np.repeat(n_os, len(lam_grid)-1)
+
+    # Grid intervals
+    d_lam = np.diff(lam_grid)
+    # Init grid for output
+    new_grid = lam_grid.copy()
+    # Iterate to generate nodes
+    for i_os in range(1, n_os.max()):
+        # Compute only nodes that need to be computed
+        index = (n_os > i_os)
+        # Compute the next node in each grid intervals
+        sub_grid = (lam_grid[:-1][index]
+                    + i_os * d_lam[index] / n_os[index])
+        # Add to ouput grid
+        new_grid = np.concatenate([new_grid, sub_grid])
+
+    # Return sorted and unique
+    return np.unique(new_grid)
+
+
+def uneven_grid_loop(lam_grid, n_os=1, space=None):
+    """
+    Reference implementation of `utils.uneven_grid`,
+    using a list comprehension.
+    """
+    if space is None:
+        space = 1/n_os
+
+    if n_os > 1:
+        d_lam = np.diff(lam_grid) * space
+        sub_grid = [lam_grid[:-1] + (-1)**(i-1) * ((i+1)//2) * d_lam
+                    for i in range(1, n_os)]
+        new_grid = np.concatenate([lam_grid, *sub_grid])
+        return np.unique(new_grid)
+    else:
+        return lam_grid
+
+
+def bench_grids(n_grid=(2048, 4096, 8192), n_os=(2, 5, 10),
+                n_max=5, n_repeat=5):
+    """
+    Compare `oversample_grid` and `uneven_grid` with their
+    reference implementations, on grids typical of
+    the SOSS extraction (one or two orders of 2048 columns).
+
+    Parameters
+    ----------
+    n_grid: list of int, optional
+        lengths of the grids to test.
+    n_os: list of int, optional
+        oversampling values to test (same for all intervals).
+    n_max: int, optional
+        maximum of the random oversampling in each intervals,
+        like the grids of `get_adapt_grid`.
+    n_repeat: int, optional
+        number of repetitions for the timings.
+    Output
+    ------
+    dictionnary of the timings and of the maximum absolute difference
+    between the grids, for each (n_grid, n_os) combination. The
+    random oversampling is given by n_os='random'.
+    """
+    args = {'n_repeat': n_repeat}
+
+    out = {}
+    for n_k in n_grid:
+        lam_grid = np.linspace(0.6, 2.9, n_k)
+
+        # Same oversampling in each interval and random oversampling
+        n_os_list = [*n_os, 'random']
+        for i_os in n_os_list:
+            if i_os == 'random':
+                os_val = np.random.randint(1, n_max + 1, n_k - 1)
+            else:
+                os_val = i_os
+
+            # Check that both implementations give the same results
+            grid_ref = oversample_grid_loop(lam_grid, n_os=os_val)
+            grid_new = oversample_grid(lam_grid, n_os=os_val)
+            res = {'max_diff': np.abs(grid_ref - grid_new).max()}
+
+            # Timings
+            res['oversample_grid_loop'] = time_it(oversample_grid_loop,
+                                                  lam_grid, n_os=os_val,
+                                                  **args)
+            res['oversample_grid'] = time_it(oversample_grid, lam_grid,
+                                             n_os=os_val, **args)
+
+            # uneven_grid only takes a scalar n_os
+            if i_os != 'random':
+                grid_ref = uneven_grid_loop(lam_grid, n_os=os_val)
+                grid_new = uneven_grid(lam_grid, n_os=os_val)
+                max_diff = np.abs(grid_ref - grid_new).max()
+                res['max_diff'] = max(res['max_diff'], max_diff)
+                res['uneven_grid_loop'] = time_it(uneven_grid_loop,
+                                                  lam_grid, n_os=os_val,
+                                                  **args)
+                res['uneven_grid'] = time_it(uneven_grid, lam_grid,
+                                             n_os=os_val, **args)
+
+            out[(n_k, i_os)] = res
+
+    return out
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.sparse import diags
+from scipy.sparse import csr_matrix
 from scipy.interpolate import RectBivariateSpline, interp1d
 from astropy.io import fits
 import matplotlib.pyplot as plt
@@ -167,17 +167,21 @@ def cut_ker(ker, n_out=None, thresh=None):
         i_left = np.max([h_len - i_left, 0])
         i_right = np.min([h_len + i_right, n_ker - 1])
 
-    # Apply the cut
-    for i_k in range(0, i_left):
-        # Add condition in case the kernel is larger
-        # than the grid where it's projected.
-        if i_k < n_k_c:
-            ker[:i_left-i_k, i_k] = 0
-    for i_k in range(i_right + 1 - n_ker, 0):
-        # Add condition in case the kernel is larger
-        # than the grid where it's projected.
-        if -i_k <= n_k_c:
-            ker[i_right-n_ker-i_k:, i_k] = 0
+    # Apply the cut. In the compact form, the element (i_ker, i_k_c)
+    # is associated to the position i_k_c + i_ker - h_len on the
+    # grid, so the cut is a condition on i_ker + i_k_c for each wing.
+    # Only the columns close to the boundaries can be affected.
+    # (Note that it also works if the kernel is larger
+    # than the grid where it's projected.)
+    i_ker = np.arange(n_ker)[:, None]
+    # Left wing
+    n_left = min(i_left, n_k_c)
+    i_k_c = np.arange(n_left)[None, :]
+    ker[:, :n_left][i_ker + i_k_c < i_left] = 0
+    # Right wing
+    n_right = min(n_ker - 1 - i_right, n_k_c)
+    i_k_c = np.arange(n_k_c - n_right, n_k_c)[None, :]
+    ker[:, n_k_c-n_right:][i_ker + i_k_c >= i_right + n_k_c] = 0
 
     return ker
 
@@ -207,18 +211,24 @@ def sparse_c(ker, n_k, i_zero=0):
     # Assign half-length
     h_len = (n_ker - 1) // 2
 
-    # Define each diagonal of the sparse convolution matrix
-    diag_val, offset = [], []
-    for i_ker, i_k_c in enumerate(range(-h_len, h_len+1)):
-        i_k = i_zero + i_k_c
-        if i_k < 0:
-            diag_val.append(ker[i_ker, -i_k:])
-        else:
-            diag_val.append(ker[i_ker, :])
-        offset.append(i_k)
+    # Position of each element of the compact kernel
+    # on the original grid (columns of the sparse matrix).
+    # Transpose to have the convolved axis first, so the
+    # flattened arrays are already sorted by rows.
+    i_ker, i_k_c = np.indices((n_ker, n_k_c))
+    col = (i_zero + i_k_c + i_ker - h_len).T.ravel()
+    data = ker.T.ravel()
+
+    # Keep only non-zero elements that fall on the grid
+    valid = (col >= 0) & (col < n_k) & (data != 0)
+    col, data = col[valid], data[valid]
+
+    # Number of elements in each row gives the row pointers
+    n_per_row = valid.reshape(n_k_c, n_ker).sum(axis=-1)
+    indptr = np.concatenate([[0], np.cumsum(n_per_row)])
 
     # Build convolution matrix
-    return diags(diag_val, offset, shape=(n_k_c, n_k), format="csr")
+    return csr_matrix((data, col, indptr), shape=(n_k_c, n_k))
 
 
 def to_2d(kernel, grid, grid_range):
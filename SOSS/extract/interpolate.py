@@ -3,9 +3,36 @@ from .custom_numpy import is_sorted
 
 
 class SegmentedLagrangeX():
+    """
+    Segmented lagrange interpolation (x part only).
+    Each interval of the grid has its own segment of `order` + 1
+    grid points used to build the lagrange polynomials.
+    Gives the lagrange coefficients (weights of the grid values)
+    and the index of the grid points for any x.
+    """
 
     def __init__(self, grid, order, extrapolate=False,
                  assume_sorted=False, mode='left', adjust_order=True):
+        """
+        Parameters
+        ----------
+        grid: 1d array
+            Grid of the interpolation (sorted and unique).
+        order: int
+            Order of the lagrange polynomials.
+        extrapolate: bool, optional
+            If False, raise an error for values out of the grid.
+            Otherwise, use the first or last segment. Default is False.
+        assume_sorted: bool, optional
+            Not used anymore; the values to interpolate
+            do not need to be sorted. Kept for compatibility.
+        mode: str, optional
+            'left' or 'right'. Side where the extra point of
+            the segments is taken for even orders. Default is 'left'.
+        adjust_order: bool, optional
+            If True, the order is reduced at the grid ends,
+            so the segments stay centered. Default is True.
+        """
 
         # Specification
         self.extrapolate = extrapolate
@@ -36,21 +63,40 @@ class SegmentedLagrangeX():
         # x
         self.x_seg = self._get_segments(grid)
 
+        # Denominators of the lagrange coefficients, x_j - x_i,
+        # for each segments (shape (n_j, n_i, n_segments)).
+        self.x_den = self.x_seg[:, None, :] - self.x_seg[None, :, :]
+
+        # Valid terms of the lagrange coefficients
+        # (i != j and no padded values in the segments)
+        self.valid = np.isfinite(self.x_den) & (self.x_den != 0)
+
+        # Weights of the lagrange coefficients,
+        # w_j = 1 / prod_i(x_j - x_i), only with valid terms
+        self.w_seg = 1 / np.prod(np.where(self.valid, self.x_den, 1.), axis=1)
+
     def _get_segments(self, grid, fill_value=np.nan, bad_index=-1):
 
         # Get needed attributes
         index = self.index
 
-        # Get values for each segments
-        seg = grid[index]
+        # Get values for each segments (the last axis is the grid),
+        # so the output has the shape (n, ..., n_segments)
+        seg = np.moveaxis(np.asarray(grid)[..., index], -2, 0)
 
         # Change invalid index
-        seg[index==bad_index] = fill_value
+        bad = (index == bad_index)
+        bad = bad.reshape(bad.shape[:1] + (1,) * (seg.ndim - 2) + (-1,))
+        seg = np.where(bad, fill_value, seg)
 
         # Convert to array and return
         return np.array(seg)
 
     def get_index(self, x):
+        """
+        Return the index of the segment (so the grid interval)
+        used for each value of x.
+        """
 
         # Needed attributes
         grid = self.grid
@@ -79,34 +125,34 @@ class SegmentedLagrangeX():
 
         return index
 
-    def get_coeffs(self, x):
-
-        # Needed attributes
-        x_seg = self.x_seg
-        n = self.n
-
-        # Check if sorted if assume_sorted is False
-        if not self.sorted:
-            # If not sorted, sort it!
-            if not is_sorted(x):
-                x = np.sort(x)
+    def get_coeffs(self, x, index=None):
+        """
+        Return the lagrange coefficients (n, len(x)) for each value
+        of x, given the segments `index` (see `get_index`).
+        x does not need to be sorted.
+        """
 
         # Which segment of the grid should be used
         # for each value of x
-        index = self.get_index(x)
+        if index is None:
+            index = self.get_index(x)
+
+        # Needed attributes
+        x_seg, valid, n = self.x_seg, self.valid, self.n
 
-        # Assign value
-        n_x = len(x)
-        coeffs = np.zeros((n, n_x))
+        # Compute c_j = w_j * prod_i(x - x_i) for all x at once,
+        # where the product is only over the valid terms (i != j).
+        num = x - x_seg[:, index]
+        coeffs = self.w_seg[:, index].copy()
         for j in range(n):
-            c_j = np.ones(n_x)
             for i in range(n):
-                if i!=j:
-                    c_ij = (x - x_seg[i,index])
-                    c_ij /= (x_seg[j,index] - x_seg[i,index])
-                    igood = np.isfinite(c_ij)
-                    c_j[igood] *= c_ij[igood]
-            coeffs[j] = c_j
+                if i == j:
+                    continue
+                # Invalid terms only at the grid ends (if any)
+                if valid[j, i].all():
+                    coeffs[j] *= num[i]
+                else:
+                    coeffs[j] *= np.where(valid[j, i, index], num[i], 1.)
 
         return coeffs
 
@@ -140,9 +186,15 @@ class SegmentedLagrangeX():
         return np.array(seg, dtype=int)
 
 
-
-
 class SegmentedLagrange(SegmentedLagrangeX):
+    """
+    Segmented lagrange interpolation of `f_grid` (see `SegmentedLagrangeX`).
+    The polynomial of each segment is converted to coefficients
+    in powers of (x - x_0), where x_0 is the center of the segment,
+    so the evaluation is a vectorised Horner scheme.
+    `f_grid` can have multiple rows (..., len(grid)) to interpolate
+    many functions on the same grid at once.
+    """
 
     def __init__(self, grid, f_grid, order, **kwargs):
 
@@ -152,34 +204,68 @@ class SegmentedLagrange(SegmentedLagrangeX):
         # y
         self.y_seg = self._get_segments(f_grid, fill_value=0.)
 
+        # Polynomial coefficients of each segment
+        self.x_ref, self.poly = self._get_poly()
+
+    def _get_poly(self):
+        """
+        Return the reference x of each segment and the coefficients
+        (n, ..., n_segments) of the polynomials in powers of (x - x_ref),
+        ordered from the highest power.
+        """
+        # Needed attributes
+        x_seg, y_seg, n = self.x_seg, self.y_seg, self.n
+        x_den, valid = self.x_den, self.valid
+
+        # Reference (center of each segment, for numerical stability)
+        x_ref = np.nanmean(x_seg, axis=0)
+        t_seg = x_seg - x_ref
+
+        # Sum of the lagrange polynomials (in powers of t = x - x_ref)
+        poly = np.zeros((n,) + y_seg.shape[1:])
+        for j in range(n):
+            # Polynomial of the lagrange basis j
+            basis = np.zeros((n, x_seg.shape[-1]))
+            basis[-1] = 1.
+            for i in range(n):
+                # Skip the invalid terms (as in `get_coeffs`)
+                if i == j or not valid[j, i].any():
+                    continue
+                # Multiply by (t - t_i) / (x_j - x_i) where valid
+                new = np.zeros_like(basis)
+                new[:-1] = basis[1:]
+                new -= t_seg[i] * basis
+                new /= x_den[j, i]
+                basis = np.where(valid[j, i], new, basis)
+            # Add y_j times basis j (y is zero for invalid values)
+            basis = basis.reshape((n,) + (1,) * (y_seg.ndim - 2) + (-1,))
+            poly += y_seg[j] * basis
+
+        return x_ref, poly
 
     def __call__(self, x):
+        """
+        Interpolate at x (any shape, does not need to be sorted).
+        The output has the shape (..., *x.shape), where (...) are the
+        extra dimensions of f_grid.
+        """
 
         # Needed attributes
-        x_seg = self.x_seg
-        y_seg = self.y_seg
-        n = self.n
+        x_ref, poly = self.x_ref, self.poly
 
-        # Check if sorted if assume_sorted is False
-        if not self.sorted:
-            # If not sorted, sort it!
-            if not is_sorted(x):
-                x = np.sort(x)
+        # Work on 1d array
+        x = np.asarray(x, dtype=float)
+        shape = x.shape
+        x = x.ravel()
 
         # Which segment of the grid should be used
         # for each value of x
-        index = self._get_index(x)
+        index = self.get_index(x)
 
-        # Assign value
-        y = np.zeros_like(x)
-        for j in range(n):
-            c_j = np.ones_like(x)
-            for i in range(n):
-                if i!=j:
-                    c_ij = (x - x_seg[i,index])
-                    c_ij /= (x_seg[j,index] - x_seg[i,index])
-                    igood = np.isfinite(c_ij)
-                    c_j[igood] *= c_ij[igood]
-            y += y_seg[j,index] * c_j
-
-        return y
+        # Evaluate with Horner's method
+        t_x = x - x_ref[index]
+        y = poly[0][..., index]
+        for coeff in poly[1:]:
+            y = y * t_x + coeff[..., index]
+
+        return y.reshape(y.shape[:-1] + shape)
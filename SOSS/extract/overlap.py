@@ -3,7 +3,6 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.sparse import find, issparse, csr_matrix, diags
-from scipy.sparse.linalg import spsolve
 from scipy.interpolate import interp1d, Akima1DInterpolator
 from scipy.optimize import minimize_scalar
 
@@ -11,10 +10,13 @@ from scipy.optimize import minimize_scalar
 from .custom_numpy import arange_2d
 from .interpolate import SegmentedLagrangeX
 from .convolution import get_c_matrix, WebbKer
-from .utils import (get_lam_p_or_m, get_n_nodes, grid_from_map,
-                    oversample_grid, _grid_from_map, get_soss_grid)
+from .utils import (get_lam_p_or_m, get_romberg_nodes, grid_from_map,
+                    oversample_grid, _grid_from_map, get_soss_grid,
+                    array_key)
 from .throughput import ThroughputSOSS
-from .regularisation import Tikhonov, tikho_solve, get_nyquist_matrix
+from .regularisation import (Tikhonov, TikhonovLsq, tikho_solve,
+                             tikho_lsq_solve, get_nyquist_matrix)
+from .solvers import solve, DEFAULT_LSQ_SOLVER
 
 
 class _BaseOverlap:
@@ -527,6 +529,25 @@ class _BaseOverlap:
         ------
         A and b from Ax = b beeing the system to solve.
         """
+        # Build the matrix B and the data vector
+        b_matrix, data = self.build_lsq_sys(data=data, sig=sig, **kwargs)
+
+        # (B_T * B) * f = (data/sig)_T * B
+        # (matrix ) * f = result
+        matrix = b_matrix.T.dot(b_matrix)
+        result = csr_matrix(data.T).dot(b_matrix)
+
+        return matrix, result.toarray().squeeze()
+
+    def build_lsq_sys(self, data=None, sig=True, **kwargs):
+        """
+        Build the (rectangular) least-squares system B * f = data/sig,
+        before forming the normal equations of `build_sys`.
+        Same parameters as `build_sys`.
+        Output
+        ------
+        B (sparse matrix) and data/sig (1d array) for the valid pixels.
+        """
         ##### Input management ######
 
         # Use data from object as default
@@ -563,20 +584,16 @@ class _BaseOverlap:
             # Get sparse b_n
             b_matrix += self.get_b_n(i_ord, sig=sig, quick=quick)
 
-        # Build system
         # Fisrt get `sig` which have been update`
         # when calling `get_b_n`
         sig = self.sig
         # Take only valid pixels and apply `sig`on data
         data = data[~mask] / sig[~mask]
-        # (B_T * B) * f = (data/sig)_T * B
-        # (matrix ) * f = result
-        matrix = b_matrix.T.dot(b_matrix)
-        result = csr_matrix(data.T).dot(b_matrix)
 
-        return matrix, result.toarray().squeeze()
+        return b_matrix, data
 
-    def extract(self, tikhonov=False, tikho_kwargs=None, factor=None, **kwargs):
+    def extract(self, tikhonov=False, tikho_kwargs=None, factor=None,
+                solver=None, normal_eq=True, **kwargs):
         """
         Extract underlying flux on the detector.
         All parameters are passed to `build_sys` method.
@@ -591,6 +608,30 @@ class _BaseOverlap:
             Default is False.
         tikho_kwargs : dictionnary or None, optional
             Arguments passed to `tikho_solve`.
+        factor : float or str, optional
+            Tikhonov scale factor. If str, it is the criterion
+            ('gcv', 'curvature', 'lcurve' or 'discrepancy') used to
+            find the best factor with `get_tikho_factor` (with the
+            same `tikho_kwargs`). The least-squares system used to
+            compute the criteria is then solved with the best factor
+            (see regularisation.TikhonovLsq.solve), so `normal_eq`
+            is not used.
+        solver : str or callable, optional
+            Sparse solver used to solve the system
+            (see `solvers.get_solver`). Default is 'spsolve',
+            or `solvers.DEFAULT_LSQ_SOLVER` if `normal_eq` is False
+            (the direct sparse QR 'qr' if PySPQR is installed,
+            else 'lsmr').
+        normal_eq : bool, optional
+            Only used for tikhonov extraction. If False, the
+            regularised least-squares system is solved directly
+            without building the normal equations
+            (see regularisation.tikho_lsq_solve function).
+            The condition number is not squared, so it is more
+            accurate for ill-conditioned systems, but slower:
+            without PySPQR, the iterative 'lsmr' solver is used.
+            Note that the scale of `factor` is then different.
+            Default is True.
         data : (N, M) array_like, optional
             A 2-D array of real values representing the detector image.
             Default is the object attribute `data`.
@@ -610,8 +651,38 @@ class _BaseOverlap:
         -----
         f_k: solution of the linear system
         """
+        # Find the best factor automatically if a criterion is given.
+        # The factor is defined for the least-squares system, which is
+        # built only once and then solved with the best factor.
+        if tikhonov and isinstance(factor, str):
+            if tikho_kwargs is None:
+                tikho_kwargs = {}
+            tikho_kwargs = tikho_kwargs.copy()
+            estimate = tikho_kwargs.pop('estimate', None)
+            if solver is not None:
+                tikho_kwargs.setdefault('solver', solver)
+            factor = self.get_tikho_factor(criterion=factor,
+                                           estimate=estimate,
+                                           tikho_kwargs=tikho_kwargs,
+                                           **kwargs)
+            f_k = np.ones(self.n_k) * np.nan
+            f_k[self.tikho.index] = self.tikho.solve(factor, estimate)
+            return f_k
+
+        # Least-squares system only used with tikhonov
+        lsq = tikhonov and not normal_eq
+
+        # Default solver
+        if solver is None:
+            solver = DEFAULT_LSQ_SOLVER if lsq else 'spsolve'
+
         # Build the system to solve
-        matrix, result = self.build_sys(**kwargs)
+        if lsq:
+            matrix, data = self.build_lsq_sys(**kwargs)
+            # Right side of the normal equations, to get valid index
+            result = matrix.T.dot(data)
+        else:
+            matrix, result = self.build_sys(**kwargs)
 
         # Get index of `lam_grid` convered by the pixel.
         # `lam_grid` may cover more then the pixels.
@@ -626,26 +697,26 @@ class _BaseOverlap:
         if tikhonov:
             if factor is None:
                 raise ValueError("Please specify tikhonov `factor`.")
-            t_mat = self.get_tikho_matrix()
-            default_kwargs = {'grid': self.lam_grid,
-                              'index': i_grid,
-                              't_mat': t_mat,
-                               'factor': factor}
-            if tikho_kwargs is None:
-                tikho_kwargs = {}
-            tikho_kwargs = {**default_kwargs, **tikho_kwargs}
-            f_k[i_grid] = self._solve_tikho(matrix, result, **tikho_kwargs)
+            tikho_kwargs = self._get_tikho_kwargs(i_grid, tikho_kwargs,
+                                                  factor=factor,
+                                                  solver=solver)
+            if lsq:
+                f_k[i_grid] = tikho_lsq_solve(matrix, data, **tikho_kwargs)
+            else:
+                f_k[i_grid] = self._solve_tikho(matrix, result,
+                                                **tikho_kwargs)
         else:
-            f_k[i_grid] = self._solve(matrix, result, index=i_grid)
+            f_k[i_grid] = self._solve(matrix, result,
+                                      index=i_grid, solver=solver)
 
         return f_k
 
-    def _solve(self, matrix, result, index=slice(None)):
+    def _solve(self, matrix, result, index=slice(None), solver='spsolve'):
         """
-        Simply pass `matrix` and `result`
-        to `scipy.spsolve` and apply index.
+        Simply pass `matrix` and `result` to the
+        sparse `solver` (see `solvers.get_solver`) and apply index.
         """
-        return spsolve(matrix[index, :][:, index], result[index])
+        return solve(matrix[index, :][:, index], result[index], solver=solver)
 
     def _solve_tikho(self, matrix, result, index=slice(None), **kwargs):
         """Solve system using Tikhonov regularisation"""
@@ -705,6 +776,52 @@ class _BaseOverlap:
         # Set attribute
         self.tikho_mat = t_mat
 
+        # Reset t_mat_T.t_mat (see `get_tikho_matrix_2`)
+        self._tikho_mat_2 = {}
+
+    def get_tikho_matrix_2(self, index=slice(None)):
+        """
+        Return t_mat_T.t_mat, where t_mat is the tikhonov matrix
+        (see `get_tikho_matrix`) restricted to `index`.
+        It does not depend on the data or the factor, so it is
+        saved for each `index` and only computed once.
+        """
+        t_mat = self.get_tikho_matrix()
+        try:
+            self._tikho_mat_2
+        except AttributeError:
+            self._tikho_mat_2 = {}
+
+        # Key given by the valid index of the grid
+        key = array_key(np.arange(t_mat.shape[-1])[index])
+        try:
+            t_mat_2 = self._tikho_mat_2[key]
+        except KeyError:
+            t_mat = t_mat[index, :][:, index]
+            t_mat_2 = t_mat.T.dot(t_mat)
+            self._tikho_mat_2[key] = t_mat_2
+
+        return t_mat_2
+
+    def _get_tikho_kwargs(self, i_grid, tikho_kwargs=None, **kwargs):
+        """
+        Return the arguments to init a Tikhonov object: the default
+        `grid`, `index` and `t_mat`, `kwargs`, and then `tikho_kwargs`.
+        The default tikhonov matrix (see `get_tikho_matrix`) and its
+        t_mat_T.t_mat are only used if `t_mat` is not in `tikho_kwargs`.
+        """
+        if tikho_kwargs is None:
+            tikho_kwargs = {}
+
+        default_kwargs = {'grid': self.lam_grid, 'index': i_grid, **kwargs}
+        if 't_mat' not in tikho_kwargs:
+            default_kwargs['t_mat'] = self.get_tikho_matrix()
+            # Re-use t_mat_T.t_mat if the default index is used
+            if 'index' not in tikho_kwargs:
+                default_kwargs['t_mat_2'] = self.get_tikho_matrix_2(i_grid)
+
+        return {**default_kwargs, **tikho_kwargs}
+
     def get_i_grid(self, d):
         """ Return the index of the grid that are well defined, so d != 0 """
         try:
@@ -785,11 +902,13 @@ class _BaseOverlap:
 
             # Estimate the flux at this order
             f_k_c = self.c_list[i_ord].dot(f_k)
-            # Interpolate with a cubic spline
-            fct = interp1d(grid_ord, f_k_c, kind='cubic')
+            # Interpolate with a cubic spline. The function evaluations
+            # are cached, so they are re-used if called again
+            # with the same flux (with different tolerances for example).
+            romberg = get_romberg_nodes(grid_ord, f_k_c, kind='cubic')
 
             # Find number of nodes to reach the precision
-            n_oversample = get_n_nodes(grid_ord, fct, **kwargs)
+            n_oversample = romberg.get_n_nodes(**kwargs)
 
             # Make sure n_oversample is not greater than
             # user's define `n_max`
@@ -817,7 +936,7 @@ class _BaseOverlap:
         return np.unique(os_grid)
 
     def get_tikho_tests(self, factors, tikho=None, estimate=None,
-                        tikho_kwargs=None, **kwargs):
+                        tikho_kwargs=None, normal_eq=True, **kwargs):
         """
         Test different factors for Tikhonov regularisation.
 
@@ -834,6 +953,10 @@ class _BaseOverlap:
         tikho_kwargs:
             passed to init Tikhonov object. Possible options
             are `t_mat`, `grid` and `verbose`
+        normal_eq: bool, optional
+            If False and `tikho` is not given, use a `TikhonovLsq`
+            object, so the normal equations are not built.
+            Default is True.
         data : (N, M) array_like, optional
             A 2-D array of real values representing the detector image.
             Default is the object attribute `data`.
@@ -855,20 +978,22 @@ class _BaseOverlap:
         """
 
         # Build the system to solve
-        matrix, result = self.build_sys(**kwargs)
+        if normal_eq:
+            matrix, result = self.build_sys(**kwargs)
+        else:
+            matrix, data = self.build_lsq_sys(**kwargs)
+            # Right side of the normal equations, to get valid index
+            result = matrix.T.dot(data)
 
         # Get valid grid index
         i_grid = self.get_i_grid(result)
 
         if tikho is None:
-            t_mat = self.get_tikho_matrix()
-            default_kwargs = {'grid': self.lam_grid,
-                              'index': i_grid,
-                              't_mat': t_mat}
-            if tikho_kwargs is None:
-                tikho_kwargs = {}
-            tikho_kwargs = {**default_kwargs, **tikho_kwargs}
-            tikho = Tikhonov(matrix, result, **tikho_kwargs)
+            tikho_kwargs = self._get_tikho_kwargs(i_grid, tikho_kwargs)
+            if normal_eq:
+                tikho = Tikhonov(matrix, result, **tikho_kwargs)
+            else:
+                tikho = TikhonovLsq(matrix, data, **tikho_kwargs)
             self.tikho = tikho
 
         # Test all factors
@@ -889,6 +1014,60 @@ class _BaseOverlap:
 
         return tikho.test
 
+    def get_tikho_factor(self, factors=None, criterion='gcv',
+                         estimate=None, n_probe=20, seed=None,
+                         tikho_kwargs=None, **kwargs):
+        """
+        Find the best factor for Tikhonov regularisation
+        using an automatic criterion computed on the least-squares
+        system (see regularisation.TikhonovLsq.get_criteria).
+        The `TikhonovLsq` object is saved as the attribute `tikho`.
+
+        Parameters
+        ----------
+        factors: 1D list or array-like, optional
+            Factors to be tested. Default is np.logspace(-8, 0, 17).
+        criterion: str, optional
+            'gcv', 'curvature' (or 'lcurve') or 'discrepancy'.
+            Default is 'gcv'.
+        estimate: 1D array-like, optional
+            Estimate of the flux projected on the wavelength grid.
+        n_probe: int, optional
+            number of random vectors used to estimate
+            the trace of the influence matrix. Default is 20.
+        seed: int, optional
+            seed of the random generator.
+        tikho_kwargs:
+            passed to init TikhonovLsq object. Possible options
+            are `t_mat`, `grid` and `verbose`
+        kwargs:
+            passed to `build_lsq_sys` (`data`, `sig`, `p_list`, `t_list`)
+        Output
+        ------
+        Best factor (float)
+        """
+        # Default factors
+        if factors is None:
+            factors = np.logspace(-8, 0, 17)
+
+        # Build the system to solve
+        matrix, data = self.build_lsq_sys(**kwargs)
+
+        # Get valid grid index
+        i_grid = self.get_i_grid(matrix.T.dot(data))
+
+        # Init TikhonovLsq object
+        tikho_kwargs = self._get_tikho_kwargs(i_grid, tikho_kwargs,
+                                              verbose=self.verbose)
+        tikho = TikhonovLsq(matrix, data, **tikho_kwargs)
+        self.tikho = tikho
+
+        # Compute criteria
+        tikho.get_criteria(factors, estimate=estimate,
+                           n_probe=n_probe, seed=seed)
+
+        return tikho.best_factor(criterion)
+
     def bin_to_pixel(self, i_ord=0, grid_pix=None, grid_f_k=None, f_k_c=None,
                      f_k=None, bounds_error=False, throughput=None, **kwargs):
         """
@@ -1445,8 +1624,8 @@ class LagrangeOverlap(_BaseOverlap):
         w_n = np.ones((order+1, n_i)) * np.nan
         k_n = np.ones((order+1, n_i), dtype=int) * -1
         # Compute values in grid range
-        w_n[:, ~ma] = interp.get_coeffs(lam[~ma])
         i_segment = interp.get_index(lam[~ma])
+        w_n[:, ~ma] = interp.get_coeffs(lam[~ma], index=i_segment)
         k_n[:, ~ma] = interp.index[:, i_segment]
 
         # Include delta lambda in the weights
@@ -1518,11 +1697,9 @@ class TrpzOverlap(_BaseOverlap):
         """
         # Get wavelength at the boundary of each pixel
         # TODO? Could also be an input??
-        lam_p, lam_m = [], []
-        for lam in lam_list:  # For each order
-            lp, lm = get_lam_p_or_m(lam)  # Lambda plus or minus
-            lam_p.append(lp), lam_m.append(lm)
-        self.lam_p, self.lam_m = lam_p, lam_m  # Save values
+        # (all orders at once)
+        lam_p, lam_m = get_lam_p_or_m(np.array(lam_list))
+        self.lam_p, self.lam_m = list(lam_p), list(lam_m)  # Save values
 
         # Init upper class
         super().__init__(p_list, lam_list, **kwargs)
@@ -1,12 +1,15 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.sparse import diags, identity
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import diags, identity, vstack
+from scipy.sparse.linalg import splu
+from warnings import warn
 # Local imports
-from .utils import grid_from_map, oversample_grid
+from .utils import grid_from_map, oversample_grid, memoize
 from .convolution import get_c_matrix, WebbKer, NyquistKer
+from .solvers import solve, LSQ_SOLVERS, DEFAULT_LSQ_SOLVER
 
 
+@memoize()
 def finite_diff(x):
     """
     Returns the finite difference matrix operator based on x.
@@ -25,6 +28,7 @@ def finite_diff(x):
     return diff_matrix
 
 
+@memoize()
 def finite_second_d(grid):
     """
     Returns the second derivative operator based on grid
@@ -56,6 +60,7 @@ def finite_second_d(grid):
     return second_d
 
 
+@memoize()
 def finite_first_d(grid):
     """
     Returns the first derivative operator based on grid
@@ -82,14 +87,16 @@ def finite_first_d(grid):
     return first_d
 
 
+@memoize()
 def finite_zeroth_d(grid):
     """
     Gives the zeroth derivative operator on the function
     f(grid), so simply returns the identity matrix... XD
     """
-    return identity(len(grid))
+    return identity(len(grid), format="csr")
 
 
+@memoize()
 def get_nyquist_matrix(grid, integrate=True, n_sampling=2,
                        thresh=1e-5, **kwargs):
     """
@@ -137,6 +144,94 @@ def get_nyquist_matrix(grid, integrate=True, n_sampling=2,
     return t_mat
 
 
+
+def hutchinson_trace(op, n, n_probe=20, seed=None):
+    """
+    Estimate the trace of a linear operator M with
+    the Hutchinson method: tr(M) ~ mean(z_T.M.z), where
+    z are random vectors of +1 and -1 (Rademacher).
+
+    Parameters
+    ----------
+    op: callable
+        Function returning M.z, given z a (n, n_probe) array.
+    n: int
+        size of the (square) operator.
+    n_probe: int, optional
+        number of random vectors used. Default is 20.
+    seed: int, optional
+        seed of the random generator. Using the same seed
+        gives the same random vectors.
+
+    Output
+    ------
+    Estimate of the trace (float)
+    """
+    rng = np.random.default_rng(seed)
+    z_vec = rng.choice([-1., 1.], size=(n, n_probe))
+
+    return np.mean(np.sum(z_vec * op(z_vec), axis=0))
+
+
+def l_curve_curvature(factors, err_norm, reg_norm):
+    """
+    Curvature of the L-curve (log(err_norm), log(reg_norm))
+    parametrized by log(factors). The corner of the L-curve
+    is given by the maximum curvature.
+
+    Parameters
+    ----------
+    factors: 1d array
+        factors tested (sorted, at least 3 values).
+    err_norm: 1d array
+        squared norm of the error ||A.x - b||^2 for each factors.
+    reg_norm: 1d array
+        squared norm of the regularisation term ||gamma.x||^2.
+
+    Output
+    ------
+    curvature for each factors (1d array)
+    """
+    # Log space
+    t_val = np.log(factors)
+    x_val, y_val = np.log(err_norm), np.log(reg_norm)
+
+    # First and second derivatives with respect to log(factor)
+    dx, dy = np.gradient(x_val, t_val), np.gradient(y_val, t_val)
+    ddx, ddy = np.gradient(dx, t_val), np.gradient(dy, t_val)
+
+    return (dx * ddy - ddx * dy) / (dx**2 + dy**2)**1.5
+
+
+@memoize()
+def get_tikho_conv_matrix(grid, wv_map, psf, n_os=2, thresh=1e-5):
+    """
+    Build the tikhonov regularisation matrix used by `TikhoConvMatrix`
+    (convolution matrix minus identity). The output is cached,
+    so the WebbKer and the convolution matrix are not rebuilt when
+    called again with the same grid, maps and parameters.
+    See `TikhoConvMatrix` for the description of the parameters.
+    """
+    # Generate a fake wv_map to cover all wv_range with a
+    # resolution `t_mat_n_os` times the resolution
+    # of wv_map (generally order 2).
+    wv_range = [grid.min(), grid.max()]
+    wv_map = grid_from_map(wv_map, psf, wv_range=wv_range, n_os=n_os)
+    # Build convolution matrix
+    conv_ord2 = get_c_matrix(WebbKer(wv_map[None, :]),
+                             grid, thresh=thresh)
+    # Build tikhonov matrix
+    t_mat = conv_ord2 - identity(conv_ord2.shape[0])
+
+    # The grid may not be evenly spaced, so
+    # add an integration weight
+    d_grid = np.diff(grid)
+    d_grid = np.concatenate([d_grid, [d_grid[-1]]])
+    t_mat = diags(np.sqrt(d_grid)).dot(t_mat)
+
+    return t_mat
+
+
 class TikhoConvMatrix:
     """
     Convolution matrix to be used as
@@ -182,24 +277,8 @@ class TikhoConvMatrix:
         gargs = ['wv_map', 'psf', 'n_os', 'thresh']
         wv_map, psf, n_os, thresh = self.getattrs(*gargs)
 
-        # Generate a fake wv_map to cover all wv_range with a
-        # resolution `t_mat_n_os` times the resolution
-        # of wv_map (generally order 2).
-        wv_range = [grid.min(), grid.max()]
-        wv_map = grid_from_map(wv_map, psf, wv_range=wv_range, n_os=n_os)
-        # Build convolution matrix
-        conv_ord2 = get_c_matrix(WebbKer(wv_map[None, :]),
-                                 grid, thresh=thresh)
-        # Build tikhonov matrix
-        t_mat = conv_ord2 - identity(conv_ord2.shape[0])
-
-        # The grid may not be evenly spaced, so
-        # add an integration weight
-        d_grid = np.diff(grid)
-        d_grid = np.concatenate([d_grid, [d_grid[-1]]])
-        t_mat = diags(np.sqrt(d_grid)).dot(t_mat)
-
-        return t_mat
+        return get_tikho_conv_matrix(grid, wv_map, psf,
+                                     n_os=n_os, thresh=thresh)
 
     def getattrs(self, *args):
         """
@@ -213,8 +292,9 @@ class TikhoConvMatrix:
         return [getattr(self, arg) for arg in args]
 
 
-def tikho_solve(a_mat, b_vec, t_mat=None, grid=None,
-                verbose=True, factor=1.0, estimate=None, index=None):
+def tikho_solve(a_mat, b_vec, t_mat=None, grid=None, verbose=True,
+                factor=1.0, estimate=None, index=None, solver='spsolve',
+                t_mat_2=None):
     """
     Tikhonov solver to use as a function instead of a class.
 
@@ -237,13 +317,64 @@ def tikho_solve(a_mat, b_vec, t_mat=None, grid=None,
         Estimate oof the solution of the system.
     index: indexable, optional
         index of the valid row of the b_vec.
+    solver: str or callable, optional
+        Sparse solver used (see `solvers.get_solver`).
+        Default is 'spsolve'.
+    t_mat_2: matrix-like object (2d), optional
+        Pre-computed t_mat_T.t_mat (after applying `index`).
+
+    Output
+    ------
+    Solution of the system (1d array)
+    """
+    tikho = Tikhonov(a_mat, b_vec, t_mat=t_mat, grid=grid,
+                     verbose=verbose, index=index, solver=solver,
+                     t_mat_2=t_mat_2)
+
+    return tikho.solve(factor=factor, estimate=estimate)
+
+
+
+def tikho_lsq_solve(b_mat, data, t_mat=None, grid=None, verbose=True,
+                    factor=1.0, estimate=None, index=None,
+                    solver=None, **kwargs):
+    """
+    Tikhonov solver working on the least-squares system B.x = data
+    (not on the normal equations) to use as a function instead of a class.
+
+    Parameters
+    ----------
+    b_mat: matrix-like object (2d)
+        matrix B (N_data, N_k) in the system B.x = data
+    data: vector-like object (1d)
+        vector data (N_data) in the system B.x = data
+    t_mat: matrix-like object (2d), optional
+        Tikhonov regularisation matrix to be applied on x.
+        Default is the default of the Tikhonov class. (Identity matrix)
+    grid: array-like 1d, optional
+        grid on which x is projected. Used to compute derivative
+    verbose: bool
+        Print details or not
+    factor: float, optional
+        multiplicative constant of the regularisation matrix
+    estimate: vector-like object (1d)
+        Estimate oof the solution of the system.
+    index: indexable, optional
+        index of the valid columns of b_mat.
+    solver: str or callable, optional
+        Least-squares solver used (see `solvers.LSQ_SOLVERS`).
+        Default is `solvers.DEFAULT_LSQ_SOLVER`, the direct sparse
+        QR ('qr') if PySPQR is installed, else 'lsmr'.
+    kwargs:
+        passed to the solver.
 
     Output
     ------
     Solution of the system (1d array)
     """
-    tikho = Tikhonov(a_mat, b_vec, t_mat=t_mat,
-                     grid=grid, verbose=verbose, index=index)
+    tikho = TikhonovLsq(b_mat, data, t_mat=t_mat, grid=grid,
+                        verbose=verbose, index=index,
+                        solver=solver, **kwargs)
 
     return tikho.solve(factor=factor, estimate=estimate)
 
@@ -261,8 +392,8 @@ class Tikhonov:
                    'first': finite_first_d,
                    'second': finite_second_d}
 
-    def __init__(self, a_mat, b_vec, t_mat=None,
-                 grid=None, verbose=True, index=None):
+    def __init__(self, a_mat, b_vec, t_mat=None, grid=None,
+                 verbose=True, index=None, solver='spsolve', t_mat_2=None):
         """
         Parameters
         ----------
@@ -279,25 +410,22 @@ class Tikhonov:
             Print details or not
         index: indexable, optional
             index of the valid row of the b_vec.
+        solver: str or callable, optional
+            Sparse solver used (see `solvers.get_solver`).
+            Default is 'spsolve'.
+        t_mat_2: matrix-like object (2d), optional
+            Pre-computed t_mat_T.t_mat (after applying `index`).
+            Computed when needed if not given.
         """
-        # Take the identity matrix as default (zeroth derivative)
-        if t_mat is None:
-            t_mat = 'zeroth'
-
         # b_vec will be passed to default_mat functions
         # if grid not given.
-        if grid is None and t_mat is 'zeroth':
+        zeroth = (t_mat is None) or (isinstance(t_mat, str)
+                                     and t_mat == 'zeroth')
+        if grid is None and zeroth:
             grid = b_vec
 
-        # If string, search in the default Tikhonov matrix
-        if isinstance(t_mat, str):
-            self.type = t_mat
-            t_mat = self.default_mat[t_mat](grid)
-        elif callable(t_mat):
-            t_mat = t_mat(grid)
-            self.type = 'custom'
-        else:
-            self.type = 'custom'
+        # Get the regularisation matrix
+        t_mat = self._get_t_mat(t_mat, grid)
 
         # Take all indices by default
         if index is None:
@@ -308,6 +436,46 @@ class Tikhonov:
         self.t_mat = t_mat[index, :][:, index]
         self.index = index
         self.verbose = verbose
+        self.solver = solver
+        if t_mat_2 is not None:
+            self._t_2 = t_mat_2
+
+    def _get_squared(self):
+        """
+        Return A_T.A and t_mat_T.t_mat. They do not depend
+        on the factor, so they are only computed once.
+        """
+        try:
+            a_2 = self._a_2
+        except AttributeError:
+            a_2 = self._a_2 = self.a_mat.T.dot(self.a_mat)
+        try:
+            t_2 = self._t_2
+        except AttributeError:
+            t_2 = self._t_2 = self.t_mat.T.dot(self.t_mat)
+
+        return a_2, t_2
+
+    def _get_t_mat(self, t_mat, grid):
+        """
+        Return the Tikhonov matrix given by `t_mat` (matrix, callable
+        or key of `default_mat`) and set the attribute `type`.
+        """
+        # Take the identity matrix as default (zeroth derivative)
+        if t_mat is None:
+            t_mat = 'zeroth'
+
+        # If string, search in the default Tikhonov matrix
+        if isinstance(t_mat, str):
+            self.type = t_mat
+            t_mat = self.default_mat[t_mat](grid)
+        elif callable(t_mat):
+            t_mat = t_mat(grid)
+            self.type = 'custom'
+        else:
+            self.type = 'custom'
+
+        return t_mat
 
     def solve(self, factor=1.0, estimate=None):
         """
@@ -329,22 +497,21 @@ class Tikhonov:
         # Get needed attributes
         a_mat = self.a_mat
         b_vec = self.b_vec
-        t_mat = self.t_mat
         index = self.index
 
-        # Matrix gamma (with scale factor)
-        gamma = factor * self.t_mat
+        # Squared matrices (computed only once)
+        a_2, t_2 = self._get_squared()
 
         # Build system
-        gamma_2 = (gamma.T).dot(gamma)  # Gamma square
-        matrix = a_mat.T.dot(a_mat) + gamma_2
+        gamma_2 = factor**2 * t_2  # Gamma square
+        matrix = a_2 + gamma_2
         result = (a_mat.T).dot(b_vec.T)
         # Include solution estimate if given
         if estimate is not None:
             result += gamma_2.dot(estimate[index].T)
 
         # Solve
-        return spsolve(matrix, result)
+        return solve(matrix, result, solver=self.solver)
 
     def test_factors(self, factors, estimate=None):
         """
@@ -547,3 +714,330 @@ class Tikhonov:
         """ Print if verbose """
         if self.verbose:
             print(*args, **kwargs)
+
+
+class TikhonovLsq(Tikhonov):
+    """
+    Tikhonov regularisation of the system B.x = data, where B
+    is rectangular (for example, the extraction matrix before
+    forming the normal equations). The equation
+    ||B.x - data||^2 + ||gamma.x||^2
+    is minimized by solving the augmented system
+    [B; gamma].x = [data; gamma.estimate]
+    in the least-squares sense (see `solve`). The normal equations
+    are not used to solve the system, so the condition number is not
+    squared. They are only factorized to compute the criteria used to
+    choose the factor (see `factorize` and `get_criteria`).
+    """
+    def __init__(self, b_mat, data, t_mat=None, grid=None, verbose=True,
+                 index=None, solver=None, precond=True, t_mat_2=None,
+                 **kwargs):
+        """
+        Parameters
+        ----------
+        b_mat: matrix-like object (2d)
+            matrix B (N_data, N_k) in the system B.x = data
+        data: vector-like object (1d)
+            vector data (N_data) in the system B.x = data
+        t_mat: matrix-like object (2d), optional
+            Tikhonov regularisation matrix to be applied on x.
+            Default is the default of the Tikhonov class. (Identity matrix)
+        grid: array-like 1d, optional
+            grid on which x is projected. Used to compute derivative.
+        verbose: bool
+            Print details or not
+        index: indexable, optional
+            index of the valid columns of b_mat.
+        solver: str or callable, optional
+            Least-squares solver used (see `solvers.LSQ_SOLVERS`).
+            Default is `solvers.DEFAULT_LSQ_SOLVER`, the direct sparse
+            QR ('qr') if PySPQR is installed, else 'lsmr'.
+        precond: bool, optional
+            If True, scale the columns of the augmented system to unit
+            norm before solving. It speeds up the convergence of the
+            iterative solvers. Default is True.
+        t_mat_2: matrix-like object (2d), optional
+            Pre-computed t_mat_T.t_mat (after applying `index`).
+            Only used by the direct factorization (see `factorize`).
+        kwargs:
+            passed to the solver. Default for lsmr and lsqr
+            is atol=btol=1e-10.
+        """
+        if solver is None:
+            solver = DEFAULT_LSQ_SOLVER
+
+        # Check if the solver can deal with rectangular matrices
+        if isinstance(solver, str) and solver not in LSQ_SOLVERS:
+            message = "`solver`={} is not a least-squares solver."
+            message += " Choose from {}."
+            raise ValueError(message.format(solver, LSQ_SOLVERS))
+
+        # Use the index of the columns if grid not given
+        if grid is None:
+            grid = np.arange(b_mat.shape[-1])
+
+        # Get the regularisation matrix
+        t_mat = self._get_t_mat(t_mat, grid)
+
+        # Take all indices by default
+        if index is None:
+            index = slice(None)
+
+        # Default tolerance for iterative solvers
+        if solver in ['lsmr', 'lsqr']:
+            kwargs = {'atol': 1e-10, 'btol': 1e-10, **kwargs}
+
+        # Use the same attributes name as `Tikhonov`
+        # so the tests and plots methods can be used.
+        self.a_mat = b_mat[:, index]
+        self.b_vec = data
+        self.t_mat = t_mat[index, :][:, index]
+        self.index = index
+        self.verbose = verbose
+        self.solver = solver
+        self.precond = precond
+        self.solver_kwargs = kwargs
+        if t_mat_2 is not None:
+            self._t_2 = t_mat_2
+
+    def solve(self, factor=1.0, estimate=None):
+        """
+        Minimize the equation ||B.x - data||^2 + ||gamma.x||^2
+        by solving [B; gamma].x = [data; gamma.estimate]
+        in the least-squares sense.
+        gamma is the Tikhonov matrix multiplied by a scale factor
+
+        Parameters
+        ----------
+        factor: float, optional
+            multiplicative constant of the regularisation matrix
+        estimate: vector-like object (1d)
+            Estimate oof the solution of the system.
+
+        Output
+        ------
+        Solution of the system (1d array)
+        """
+        # Get needed attributes
+        b_mat = self.a_mat
+        data = self.b_vec
+        index = self.index
+
+        # Matrix gamma (with scale factor)
+        gamma = factor * self.t_mat
+
+        # Build augmented system
+        matrix = vstack([b_mat, gamma]).tocsr()
+        result = np.zeros(matrix.shape[0])
+        result[:len(data)] = data
+        # Include solution estimate if given
+        if estimate is not None:
+            result[len(data):] = gamma.dot(estimate[index])
+
+        # Scale columns to unit norm (diagonal preconditioning)
+        if self.precond:
+            scale = np.sqrt(matrix.multiply(matrix).sum(axis=0)).A1
+            scale[scale == 0] = 1.
+            matrix = matrix.dot(diags(1. / scale))
+        else:
+            scale = 1.
+
+        # Solve
+        sln = solve(matrix, result, solver=self.solver, **self.solver_kwargs)
+
+        return sln / scale
+
+    def factorize(self, factor):
+        """
+        Return the LU factorization (scipy.sparse.linalg.splu)
+        of the normal equations B_T.B + gamma_T.gamma, where gamma
+        is the Tikhonov matrix multiplied by `factor`. Only used by
+        `get_criteria`, where the solution and the trace of the
+        influence matrix are needed for many factors.
+        """
+        # B_T.B and t_mat_T.t_mat (computed only once)
+        b_2, t_2 = self._get_squared()
+
+        # The matrix is symmetric, so use a symmetric ordering
+        matrix = (b_2 + factor**2 * t_2).tocsc()
+
+        return splu(matrix, permc_spec='MMD_AT_PLUS_A')
+
+    def get_criteria(self, factors, estimate=None, n_probe=20,
+                     seed=None, tau=1.):
+        """
+        Compute criteria to choose the best factor, using a direct
+        factorization for each factor (see `factorize`).
+        The trace of the influence matrix is estimated with
+        `hutchinson_trace`, so no dense inverse is needed.
+        The criteria are:
+        - 'gcv': generalized cross-validation, to minimize
+            n_data * ||B.x - data||^2 / (n_data - trace)^2
+        - 'curvature' (or 'lcurve'): curvature of the L-curve
+            (||B.x - data||^2, ||gamma.(x - estimate)||^2), to maximize.
+        - 'discrepancy': ||B.x - data||^2 / n_data - tau,
+            the best factor is the largest where it is <= 0.
+            It assumes that `data` is normalized by its error.
+
+        Parameters
+        ----------
+        factors: 1d array-like
+            factors to test (sorted in increasing order)
+        estimate: vector-like object (1d), optional
+            Estimate of the solution of the system.
+        n_probe: int, optional
+            number of random vectors for `hutchinson_trace`.
+        seed: int, optional
+            seed of the random generator. The same random
+            vectors are used for all factors.
+        tau: float, optional
+            Safety factor of the discrepancy principle. Default is 1.
+
+        Output
+        ------
+        dictionnary of the criteria (also saved as the
+        attribute `criteria`), with the same keys as `test_factors`
+        """
+        self.v_print('Computing criteria...')
+
+        # Get relevant attributes
+        b_mat, b_vec, t_mat = self.a_mat, self.b_vec, self.t_mat
+        index = self.index
+        n_data, n_k = b_mat.shape
+        factors = np.array(factors)
+
+        # Use the same random vectors for all factors
+        seed = np.random.default_rng(seed).integers(2**32)
+
+        # Right side of the normal equations
+        rhs_0 = b_mat.T.dot(b_vec)
+        b_2, t_2 = self._get_squared()
+
+        # The regularisation term is gamma.(x - estimate)
+        if estimate is None:
+            x_0 = 0.
+        else:
+            x_0 = estimate[index]
+
+        # Init outputs
+        sln, err, reg, trace = [], [], [], []
+        for i_fac, factor in enumerate(factors):
+            # Factorize
+            lu_fac = self.factorize(factor)
+            # Solution
+            rhs = rhs_0.copy()
+            if estimate is not None:
+                rhs += factor**2 * t_2.dot(x_0)
+            sln.append(lu_fac.solve(rhs))
+            # Error B.x - data and regularisation term
+            err.append(b_mat.dot(sln[-1]) - b_vec)
+            reg.append(t_mat.dot(sln[-1] - x_0))
+            # Trace of the influence matrix:
+            # tr(B.M^-1.B_T) = tr(M^-1.B_T.B)
+            def op(z_vec):
+                return lu_fac.solve(b_2.dot(z_vec))
+            trace.append(hutchinson_trace(op, n_k, n_probe, seed))
+            # Print
+            message = '{}/{}'.format(i_fac, len(factors))
+            self.v_print(message, end='\r')
+        # Final print
+        self.v_print('{}/{}'.format(i_fac + 1, i_fac + 1))
+
+        # Convert to arrays
+        sln, err, reg = np.array(sln), np.array(err), np.array(reg)
+        trace = np.array(trace)
+
+        # Criteria
+        err_norm = (err**2).sum(axis=-1)
+        reg_norm = (reg**2).sum(axis=-1)
+        gcv = n_data * err_norm / (n_data - trace)**2
+        if len(factors) > 2:
+            curvature = l_curve_curvature(factors, err_norm, reg_norm)
+        else:
+            curvature = np.full(len(factors), np.nan)
+        discrepancy = err_norm / n_data - tau
+
+        # Save in a dictionnary
+        self.criteria = {'factors': factors,
+                         'solution': sln,
+                         'error': err,
+                         'reg': reg,
+                         'trace': trace,
+                         'gcv': gcv,
+                         'curvature': curvature,
+                         'discrepancy': discrepancy}
+
+        return self.criteria
+
+    def best_factor(self, criterion='gcv', criteria=None,
+                    interpolate=True, **kwargs):
+        """
+        Return the best factor given a criterion
+        (see `get_criteria`).
+
+        Parameters
+        ----------
+        criterion: str, optional
+            'gcv', 'curvature' (or 'lcurve') or 'discrepancy'.
+            Default is 'gcv'.
+        criteria: dictionnary, optional
+            Output of `get_criteria`. Default is the
+            attribute `criteria`. If not computed yet,
+            kwargs are passed to `get_criteria`.
+        interpolate: bool, optional
+            If True, refine the factor by interpolating the criterion
+            between the tested factors (in log space). Default is True.
+
+        Output
+        ------
+        Best factor (float)
+        """
+        # Use pre-computed criteria if not given
+        if criteria is None:
+            try:
+                criteria = self.criteria
+            except AttributeError:
+                criteria = self.get_criteria(**kwargs)
+
+        # Log space
+        log_fac = np.log10(criteria['factors'])
+
+        if criterion == 'discrepancy':
+            disc = criteria['discrepancy']
+            # Largest factor below the discrepancy target
+            i_good = np.where(disc <= 0)[0]
+            if len(i_good) == 0:
+                warn("Discrepancy principle not satisfied"
+                     + " for any factor. Taking the smallest factor.")
+                return criteria['factors'][0]
+            i_best = i_good[-1]
+            # Linear interpolation of the root if possible
+            if interpolate and i_best < len(disc) - 1:
+                x_1, x_2 = log_fac[i_best:i_best+2]
+                y_1, y_2 = disc[i_best:i_best+2]
+                return 10.**(x_1 - y_1 * (x_2 - x_1) / (y_2 - y_1))
+            return criteria['factors'][i_best]
+
+        elif criterion == 'gcv':
+            # Minimum of log(gcv)
+            y_val = np.log10(criteria['gcv'])
+        elif criterion in ['curvature', 'lcurve']:
+            # Maximum of curvature
+            y_val = -criteria['curvature']
+        else:
+            message = "`criterion`={} is not a valid option."
+            raise ValueError(message.format(criterion))
+
+        # Extremum on the grid
+        i_best = np.nanargmin(y_val)
+
+        # Refine with the vertex of the parabola passing through
+        # the extremum and its neighbours
+        if interpolate and 0 < i_best < len(y_val) - 1:
+            x_3 = log_fac[i_best-1:i_best+2]
+            y_3 = y_val[i_best-1:i_best+2]
+            coeffs = np.polyfit(x_3, y_3, 2)
+            if coeffs[0] > 0:
+                return 10.**(-coeffs[1] / (2 * coeffs[0]))
+
+        return criteria['factors'][i_best]
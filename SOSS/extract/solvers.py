@@ -0,0 +1,183 @@
+"""
+Sparse linear solvers for the extraction systems of the form A.x = b.
+All solvers have the same signature `solver(a_mat, b_vec, **kwargs)`
+and return the solution x (1d array). They can be selected by name
+with `get_solver` (see the `SOLVERS` dictionnary).
+The solvers listed in `LSQ_SOLVERS` also accept a rectangular
+matrix A and return the least-squares solution.
+"""
+from warnings import warn
+
+import numpy as np
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import (spsolve, splu, factorized,
+                                 cg, lsqr, lsmr, minres)
+
+# Optional CHOLMOD backend (from scikit-sparse)
+try:
+    from sksparse.cholmod import cholesky as _cholmod_cholesky
+except ImportError:
+    _cholmod_cholesky = None
+
+# Optional sparse QR backend (SuiteSparseQR, from PySPQR)
+try:
+    from sparseqr import solve as _spqr_solve
+except ImportError:
+    _spqr_solve = None
+
+
+def solve_spsolve(a_mat, b_vec, **kwargs):
+    """ Direct solver using `scipy.sparse.linalg.spsolve` """
+    return spsolve(a_mat, b_vec, **kwargs)
+
+
+def solve_splu(a_mat, b_vec, **kwargs):
+    """
+    Direct solver using the LU decomposition
+    `scipy.sparse.linalg.splu`. kwargs are passed to `splu`.
+    """
+    return splu(csc_matrix(a_mat), **kwargs).solve(b_vec)
+
+
+def solve_factorized(a_mat, b_vec, **kwargs):
+    """
+    Direct solver using `scipy.sparse.linalg.factorized`.
+    kwargs are passed to the solve function returned by `factorized`.
+    """
+    return factorized(csc_matrix(a_mat))(np.asarray(b_vec), **kwargs)
+
+
+def solve_cg(a_mat, b_vec, **kwargs):
+    """
+    Iterative solver using conjugate gradient.
+    `a_mat` must be symmetric positive definite.
+    kwargs are passed to `scipy.sparse.linalg.cg`.
+    """
+    x, info = cg(a_mat, b_vec, **kwargs)
+    _check_info('cg', info)
+
+    return x
+
+
+def solve_minres(a_mat, b_vec, **kwargs):
+    """
+    Iterative solver using MINRES. `a_mat` must be symmetric.
+    kwargs are passed to `scipy.sparse.linalg.minres`.
+    """
+    x, info = minres(a_mat, b_vec, **kwargs)
+    _check_info('minres', info)
+
+    return x
+
+
+def solve_lsqr(a_mat, b_vec, **kwargs):
+    """
+    Iterative least-squares solver using LSQR.
+    kwargs are passed to `scipy.sparse.linalg.lsqr`.
+    """
+    return lsqr(a_mat, b_vec, **kwargs)[0]
+
+
+def solve_lsmr(a_mat, b_vec, **kwargs):
+    """
+    Iterative least-squares solver using LSMR.
+    kwargs are passed to `scipy.sparse.linalg.lsmr`.
+    """
+    return lsmr(a_mat, b_vec, **kwargs)[0]
+
+
+def solve_qr(a_mat, b_vec, **kwargs):
+    """
+    Direct least-squares solver using the sparse QR decomposition
+    from SuiteSparseQR (PySPQR). Fall back to `solve_lsmr` (with
+    tight tolerances) if PySPQR is not installed.
+    kwargs are passed to `sparseqr.solve`.
+    """
+    if _spqr_solve is None:
+        warn("PySPQR (sparseqr) is not installed."
+             + " Using `lsmr` instead of `qr`.")
+        return solve_lsmr(a_mat, b_vec, atol=1e-12, btol=1e-12)
+
+    return np.asarray(_spqr_solve(a_mat, b_vec, **kwargs)).squeeze()
+
+
+def solve_cholmod(a_mat, b_vec, **kwargs):
+    """
+    Direct solver using the sparse Cholesky decomposition from CHOLMOD
+    (scikit-sparse). `a_mat` must be symmetric positive definite.
+    Fall back to `solve_splu` if scikit-sparse is not installed.
+    kwargs are passed to `sksparse.cholmod.cholesky`.
+    """
+    if _cholmod_cholesky is None:
+        warn("scikit-sparse is not installed."
+             + " Using `splu` instead of `cholmod`.")
+        return solve_splu(a_mat, b_vec)
+
+    return _cholmod_cholesky(csc_matrix(a_mat), **kwargs)(b_vec)
+
+
+def _check_info(name, info):
+    """ Warn if an iterative solver did not converge. """
+    if info > 0:
+        warn("`{}` did not converge after {} iterations.".format(name, info))
+    elif info < 0:
+        raise ValueError("Illegal input or breakdown in `{}`.".format(name))
+
+
+SOLVERS = {'spsolve': solve_spsolve,
+           'splu': solve_splu,
+           'factorized': solve_factorized,
+           'cg': solve_cg,
+           'minres': solve_minres,
+           'lsqr': solve_lsqr,
+           'lsmr': solve_lsmr,
+           'qr': solve_qr,
+           'cholmod': solve_cholmod}
+
+# Solvers that can be used on rectangular systems (least-squares)
+LSQ_SOLVERS = ['lsqr', 'lsmr', 'qr']
+
+# Default least-squares solver: the direct sparse QR if available
+DEFAULT_LSQ_SOLVER = 'lsmr' if _spqr_solve is None else 'qr'
+
+
+def get_solver(solver='spsolve'):
+    """
+    Return a solver function.
+
+    Parameters
+    ----------
+    solver: str or callable, optional
+        Name of the solver (a key of `SOLVERS`) or directly a callable
+        with the signature `solver(a_mat, b_vec)`. Default is 'spsolve'.
+    """
+    if callable(solver):
+        return solver
+
+    try:
+        return SOLVERS[solver]
+    except KeyError:
+        message = "`solver`={} is not a valid option. Choose from {}."
+        raise ValueError(message.format(solver, list(SOLVERS.keys())))
+
+
+def solve(a_mat, b_vec, solver='spsolve', **kwargs):
+    """
+    Solve A.x = b with a given solver.
+
+    Parameters
+    ----------
+    a_mat: matrix-like object (2d)
+        matrix A in the system to solve A.x = b
+    b_vec: vector-like object (1d)
+        vector b in the system to solve A.x = b
+    solver: str or callable, optional
+        Solver to use (see `get_solver`). Default is 'spsolve'.
+    kwargs:
+        passed to the solver.
+
+    Output
+    ------
+    Solution of the system (1d array)
+    """
+    return np.asarray(get_solver(solver)(a_mat, b_vec, **kwargs))
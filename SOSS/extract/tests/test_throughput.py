@@ -0,0 +1,51 @@
+import numpy as np
+from astropy.io import fits
+from scipy.interpolate import interp1d
+
+from ..throughput import FILE_SOSS, get_throughput_poly, ThroughputSOSS
+
+
+def write_table(path, lam_nm, trans):
+    """
+    Write a throughput table with the same layout as FILE_SOSS.
+    """
+    cols = [fits.Column(name='LAMBDA', format='{}D'.format(lam_nm.size),
+                        array=lam_nm[None, :]),
+            fits.Column(name='SOSS_order1', format='{}D'.format(lam_nm.size),
+                        array=trans[None, :])]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+
+
+def test_throughput_descending_table(tmp_path):
+    # Table with wavelengths in decreasing order
+    lam_nm = np.linspace(2900., 600., 120)
+    trans = np.exp(-0.5 * ((lam_nm - 1500.) / 500.) ** 2)
+    write_table(tmp_path / 'descending.fits', lam_nm, trans)
+
+    poly = get_throughput_poly(1, filename='descending.fits',
+                               path=str(tmp_path) + '/')
+
+    # Same as interp1d(kind='cubic'), which sorts the table
+    wv = np.linspace(0.61, 2.89, 1001)
+    expected = interp1d(lam_nm / 1000., trans, kind='cubic')(wv)
+    np.testing.assert_allclose(poly(wv), expected, rtol=1e-10, atol=1e-12)
+
+
+def test_throughput_soss(tmp_path):
+    # The callable is zero out of the table, even if not sorted
+    lam_nm = np.linspace(2900., 600., 120)
+    trans = np.exp(-0.5 * ((lam_nm - 1500.) / 500.) ** 2)
+    write_table(tmp_path / FILE_SOSS, lam_nm, trans)
+
+    class Throughput(ThroughputSOSS):
+        path = str(tmp_path) + '/'
+
+    thrpt = Throughput(order=1)
+    wv = np.array([0.5, 0.6, 1.5, 2.9, 3.0])
+    out = thrpt(wv)
+
+    assert out[0] == 0. and out[-1] == 0.
+    np.testing.assert_allclose(out[[1, 3]], [trans[-1], trans[0]],
+                               rtol=1e-10)
+    np.testing.assert_allclose(out[2], 1., rtol=1e-4)
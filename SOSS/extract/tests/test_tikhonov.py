@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from scipy.sparse import vstack
+
+from ..benchmarks import get_test_system
+from ..regularisation import (Tikhonov, TikhonovLsq, finite_first_d,
+                              l_curve_curvature)
+from ..solvers import DEFAULT_LSQ_SOLVER
+
+
+def lstsq_tikho(b_mat, data, t_mat, factor, estimate=None):
+    """
+    Dense least-squares solution of
+    [B; factor * T].x = [data; factor * T.estimate]
+    """
+    matrix = vstack([b_mat, factor * t_mat]).toarray()
+    result = np.concatenate([data, np.zeros(t_mat.shape[0])])
+    if estimate is not None:
+        result[len(data):] = factor * t_mat.dot(estimate)
+
+    return np.linalg.lstsq(matrix, result, rcond=None)[0]
+
+
+@pytest.fixture(scope='module')
+def lsq_system():
+    b_mat, data = get_test_system(n_k=300, n_band=10, seed=1, lsq=True)
+    grid = np.linspace(0.9, 2.8, b_mat.shape[1])
+
+    return b_mat, data, grid
+
+
+@pytest.mark.filterwarnings('ignore:PySPQR')
+@pytest.mark.parametrize('solver', [None, 'lsmr', 'qr'])
+def test_lsq_solve(lsq_system, solver):
+    b_mat, data, grid = lsq_system
+    factor = 1e-2
+
+    tikho = TikhonovLsq(b_mat, data, t_mat='first', grid=grid,
+                        verbose=False, solver=solver)
+    if solver is None:
+        assert tikho.solver == DEFAULT_LSQ_SOLVER
+    sln = tikho.solve(factor)
+
+    expected = lstsq_tikho(b_mat, data, finite_first_d(grid), factor)
+    np.testing.assert_allclose(sln, expected, rtol=1e-7, atol=1e-8)
+
+
+def test_normal_eq_vs_lsq(lsq_system):
+    # With a small factor, both the normal equations and the
+    # least-squares system give the unregularised solution
+    b_mat, data, grid = lsq_system
+    a_mat, b_vec = get_test_system(n_k=300, n_band=10, seed=1)
+    expected = np.linalg.solve(b_mat.toarray(), data)
+    factor = 1e-8
+
+    sln_normal = Tikhonov(a_mat, b_vec, grid=grid, verbose=False).solve(factor)
+    sln_lsq = TikhonovLsq(b_mat, data, grid=grid, verbose=False).solve(factor)
+
+    np.testing.assert_allclose(sln_normal, expected, rtol=0, atol=1e-8)
+    np.testing.assert_allclose(sln_lsq, expected, rtol=0, atol=1e-8)
+
+
+def test_criteria_estimate(lsq_system):
+    # The L-curve uses the regularisation term T.(x - estimate)
+    b_mat, data, grid = lsq_system
+    t_mat = finite_first_d(grid)
+    estimate = np.random.default_rng(2).random(b_mat.shape[1])
+    factors = np.logspace(-3, 1, 9)
+
+    tikho = TikhonovLsq(b_mat, data, t_mat=t_mat, grid=grid, verbose=False)
+    criteria = tikho.get_criteria(factors, estimate=estimate, seed=1)
+
+    # Same L-curve with dense solutions
+    err_norm, reg_norm = [], []
+    for factor in factors:
+        sln = lstsq_tikho(b_mat, data, t_mat, factor, estimate)
+        err_norm.append(np.sum((b_mat.dot(sln) - data)**2))
+        reg_norm.append(np.sum(t_mat.dot(sln - estimate)**2))
+    curvature = l_curve_curvature(factors, np.array(err_norm),
+                                  np.array(reg_norm))
+
+    np.testing.assert_allclose((criteria['reg']**2).sum(axis=-1), reg_norm,
+                               rtol=1e-6)
+    np.testing.assert_allclose(criteria['curvature'], curvature,
+                               rtol=1e-5, atol=1e-8)
+    i_best = np.argmax(curvature)
+    assert tikho.best_factor('lcurve', interpolate=False) == factors[i_best]
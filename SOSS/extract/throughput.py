@@ -1,6 +1,9 @@
-from scipy.interpolate import interp1d
+import numpy as np
+from scipy.interpolate import make_interp_spline, PPoly
 from astropy.io import fits
 
+from .utils import memoize
+
 ###############################################
 # Hack to get the path of module. To be changed.
 from os.path import abspath, dirname
@@ -20,10 +23,56 @@ FILE_SOSS = "NIRISS_Throughput_STScI.fits"
 DEF_PATH = get_module_path(__file__) + "Ref_files/"
 
 
-class ThroughputSOSS(interp1d):
+@memoize()
+def get_throughput_table(order=1, filename=FILE_SOSS, path=DEF_PATH):
+    """
+    Return the wavelength (in microns) and the throughput
+    of SOSS mode for a given order, read from the reference file.
+    The table is cached, so the file is read only once
+    for each order (per process).
+    The output should not be modified in place.
+    """
+    # Open file
+    with fits.open(path + filename) as hdu:
+        # Get transmission
+        key = 'SOSS_order{}'.format(order)
+        tr = np.array(hdu[1].data[key].squeeze(), dtype=float)
+
+        # Get wavelength
+        wv = np.array(hdu[1].data['LAMBDA'].squeeze(), dtype=float)
+        # nm to microns
+        wv /= 1000.
+
+    return wv, tr
+
+
+@memoize()
+def get_throughput_poly(order=1, filename=FILE_SOSS, path=DEF_PATH):
+    """
+    Return the cubic interpolation of the throughput of a given
+    order as a piecewise polynomial (scipy.interpolate.PPoly).
+    It is the same cubic spline as interp1d(kind='cubic'), which
+    also sorts the table by wavelength.
+    The output is cached, so the coefficients are computed only once.
+    """
+    wv, tr = get_throughput_table(order, filename=filename, path=path)
+
+    # The spline needs increasing wavelengths
+    i_sort = np.argsort(wv)
+
+    return PPoly.from_spline(make_interp_spline(wv[i_sort], tr[i_sort], k=3))
+
+
+class ThroughputSOSS:
     """
     Callable Throughput of SOSS mode for a given order.
     Function oof wavelength in microns.
+    The table and its interpolation coefficients are shared
+    between all objects of the same order (see `get_throughput_poly`),
+    so the reference file is read only once. A pickled object
+    (sent to a worker process) carries its table, so the workers
+    do not read the file.
+    Out of the table, the throughput is 0.
     """
     filename = FILE_SOSS
     path = DEF_PATH
@@ -34,18 +83,26 @@ class ThroughputSOSS(interp1d):
         order: int
             which order do you want? Default is the first order (1)
         """
-        # Open file
-        hdu = fits.open(self.path + self.filename)
+        self.order = order
 
-        # Get transmission
-        key = 'SOSS_order{}'.format(order)
-        tr = hdu[1].data[key].squeeze()
+        # Get the table (wavelength and throughput) ...
+        self.x, self.y = get_throughput_table(order, filename=self.filename,
+                                              path=self.path)
 
-        # Get wavelength
-        wv = hdu[1].data['LAMBDA'].squeeze()
-        # nm to microns
-        wv /= 1000.
+        # ... and the cubic interpolation
+        self.poly = get_throughput_poly(order, filename=self.filename,
+                                        path=self.path)
+
+    def __call__(self, wv):
+        """
+        Return the throughput at the wavelengths `wv` (in microns).
+        """
+        wv = np.asarray(wv, dtype=float)
+
+        # Evaluate the piecewise polynomial
+        out = self.poly(wv)
+
+        # Zero out of bounds (the breakpoints are sorted)
+        out[(wv < self.poly.x[0]) | (wv > self.poly.x[-1])] = 0.
 
-        # Interpolate
-        super().__init__(wv, tr, kind='cubic',
-                         fill_value=0, bounds_error=False)
+        return out
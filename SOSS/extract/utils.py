@@ -1,39 +1,125 @@
 import numpy as np
 from scipy.integrate._quadrature import AccuracyWarning, _romberg_diff
+from scipy.interpolate import interp1d
 from warnings import warn
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
 
 
+def array_key(arr):
+    """
+    Return a hashable key for a numpy array,
+    based on its shape, type and content.
+    """
+    arr = np.ascontiguousarray(arr)
+    digest = sha1(arr.view(np.uint8)).hexdigest()
+
+    return (arr.shape, arr.dtype.str, digest)
+
+
+def _make_key(args, kwargs):
+    """ Hashable key from function arguments (arrays are hashed). """
+    def to_key(val):
+        if np.ma.isMaskedArray(val):
+            return (array_key(val.data), array_key(np.ma.getmaskarray(val)))
+        elif isinstance(val, np.ndarray):
+            return array_key(val)
+        elif isinstance(val, (list, tuple)):
+            return tuple(to_key(v) for v in val)
+        else:
+            return val
+
+    key = tuple(to_key(arg) for arg in args)
+    key += tuple((name, to_key(val)) for name, val in sorted(kwargs.items()))
+
+    return key
+
+
+def memoize(maxsize=16):
+    """
+    Decorator to cache the output of a function, given its arguments.
+    Numpy arrays are hashed based on their content. If an argument
+    is not hashable, the function is simply called.
+    The `maxsize` last results are kept. The cache can be emptied
+    with `fct.cache_clear()`.
+    Note that the cached outputs are shared, so they
+    should not be modified in place.
+    """
+    def decorator(fct):
+        cache = OrderedDict()
+
+        @wraps(fct)
+        def wrapper(*args, **kwargs):
+            try:
+                key = _make_key(args, kwargs)
+                hash(key)
+            except (TypeError, ValueError):
+                # Not hashable, so no caching
+                return fct(*args, **kwargs)
+
+            try:
+                # Move to the end (most recently used)
+                cache.move_to_end(key)
+                return cache[key]
+            except KeyError:
+                out = fct(*args, **kwargs)
+                cache[key] = out
+                # Remove oldest result if needed
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+                return out
+
+        wrapper.cache = cache
+        wrapper.cache_clear = cache.clear
+
+        return wrapper
+
+    return decorator
+
+
+@memoize()
 def get_lam_p_or_m(lam):
     """
     Compute lambda_plus and lambda_minus of pixel map,
     given the pixel central value
 
-    lam: 2d array
-        2d map of the wavelengths.
-        The spectral axis should be the first one (I think?).
+    lam: 1d, 2d array or stack of 2d arrays
+        2d map of the wavelengths, or maps of multiple orders
+        with shape (N_ord, N, M). The spectral axis is the last
+        one (the columns). NaNs are propagated to the neighbouring
+        bounds, but are ignored to find the direction of the spectral axis.
+    The output is cached, so it should not be modified in place.
     """
-    lam = lam.T  # Simpler to use transpose
-
-    # Init
-    lam_r = np.zeros_like(lam)
-    lam_l = np.zeros_like(lam)
+    lam = np.asarray(lam)
+
+    # Def delta lambda along the spectral axis
+    d_lam = np.diff(lam, axis=-1)
+
+    # Define lambda right of each pixels ...
+    lam_r = np.concatenate([lam[..., :-1] + d_lam/2,
+                            lam[..., -1:] + d_lam[..., -1:]/2], axis=-1)
+    # ... and lambda left (same values as lam_r, shifted)
+    lam_l = np.concatenate([lam[..., :1] - d_lam[..., :1]/2,
+                            lam[..., :-1] + d_lam/2], axis=-1)
+
+    # The outputs depend on the direction of the spectral axis,
+    # which is checked for each map. NaNs are not considered.
+    axis = tuple(range(-min(lam.ndim, 2), 0))
+    is_nan = np.isnan(lam_r) | np.isnan(lam_l)
+    with np.errstate(invalid='ignore'):
+        increasing = ((lam_r >= lam_l) | is_nan).all(axis=axis)
+        decreasing = ((lam_r <= lam_l) | is_nan).all(axis=axis)
+    if not (increasing | decreasing).all():
+        raise ValueError('Bad pixel values for wavelength')
 
-    # Def delta lambda
-    d_lam = np.diff(lam, axis=0)
+    # Broadcast to the shape of the maps
+    increasing = np.reshape(increasing, increasing.shape + (1,) * len(axis))
 
-    # Define lambda left and lambda right of each pixels
-    lam_r[:-1] = lam[:-1] + d_lam/2
-    lam_r[-1] = lam[-1] + d_lam[-1]/2
-    lam_l[1:] = lam[:-1] + d_lam/2  # Same values as lam_r
-    lam_l[0] = lam[0] - d_lam[0]/2
+    lam_p = np.where(increasing, lam_r, lam_l)
+    lam_m = np.where(increasing, lam_l, lam_r)
 
-    # The outputs depend on the direction of the spectral axis
-    if (lam_r >= lam_l).all():
-        return lam_r.T, lam_l.T
-    elif (lam_r <= lam_l).all():
-        return lam_l.T, lam_r.T
-    else:
-        raise ValueError('Bad pixel values for wavelength')
+    return lam_p, lam_m
 
 
 def grid_from_map(wv, psf, wv_range=None, poly_ord=1, out_col=False, n_os=1):
@@ -113,22 +199,79 @@ def _grid_from_map(wv_map, psf, out_col=False):
     Define wavelength grid by taking the center wavelength
     at each columns at the center of mass of
     the spatial profile.
-    If out_col is True, return the columns positions
+    If out_col is True, return the columns positions.
+    If a stack of maps is given (one for each orders,
+    with shape (N_ord, N, M)), return a list of the outputs
+    for each orders.
+    """
+    # Center wavelength of all columns (all orders at once)
+    center_wv, good = get_center_wv(wv_map, psf)
+
+    # Return a list if multiple orders
+    if center_wv.ndim > 1:
+        return [_sort_center_wv(center_i, good_i, out_col=out_col)
+                for center_i, good_i in zip(center_wv, good)]
+    else:
+        return _sort_center_wv(center_wv, good, out_col=out_col)
+
+
+@memoize()
+def get_center_wv(wv_map, psf):
+    """
+    Return the center wavelength at each columns, given by the
+    center of mass of the spatial profile, and a boolean array
+    of the valid columns.
+    `wv_map` and `psf` are (N, M) arrays or stacks of maps with shape
+    (N_ord, N, M), so the outputs have the shape (M) or (N_ord, M).
+    Masked and NaN pixels are not used (a column with only
+    invalid pixels is not valid).
+    The output is cached, so it should not be modified in place.
     """
+    # Keep the precision of the inputs (float32 for the reference
+    # maps), like the previous implementation.
+    # Integers are converted to float.
+    dtype = np.result_type(np.ma.getdata(wv_map), np.ma.getdata(psf))
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.dtype(float)
+
+    # Convert masked values to NaNs
+    wv_map = np.ma.filled(np.ma.asarray(wv_map, dtype=dtype), np.nan)
+    psf = np.ma.filled(np.ma.asarray(psf, dtype=dtype), np.nan)
+
+    # Invalid pixels have no weight
+    valid = np.isfinite(wv_map) & np.isfinite(psf)
+    wv_map = np.where(valid, wv_map, 0.)
+    psf = np.where(valid, psf, 0.)
+
     # Normalisation for each column
-    col_sum = psf.sum(axis=0)
+    col_sum = psf.sum(axis=-2)
 
-    # Compute only valid columns
-    good = (psf > 0).any(axis=0)
-    good &= (wv_map > 0).any(axis=0)
+    # Valid columns
+    good = (psf > 0).any(axis=-2)
+    good &= (wv_map > 0).any(axis=-2)
+    good &= (col_sum != 0)
 
     # Get center wavelength using center of mass
-    # with psf as weights
-    center_wv = (wv_map * psf)[:, good]
-    center_wv /= col_sum[good]
-    center_wv = center_wv.sum(axis=0)
+    # with psf as weights (only for valid columns)
+    norm = np.where(good, col_sum, dtype.type(1))[..., None, :]
+    # The sum is done with the columns contiguous in memory (like
+    # the previous column-by-column implementation), so numpy uses
+    # the same (pairwise) summation.
+    center_wv = np.swapaxes(wv_map * psf / norm, -1, -2).copy()
+    center_wv = center_wv.sum(axis=-1)
+    center_wv[~good] = np.nan
+
+    return center_wv, good
 
+
+def _sort_center_wv(center_wv, good, out_col=False):
+    """
+    Return the center wavelengths (see `get_center_wv`) of the valid
+    columns, sorted. If out_col is True, also return
+    the columns positions. Otherwise, return unique values.
+    """
     # Return sorted
+    center_wv = center_wv[good]
     i_sort = np.argsort(center_wv)
     out = center_wv[i_sort]
 
@@ -144,7 +287,7 @@ def _grid_from_map(wv_map, psf, out_col=False):
 def _extrapolate_grid(grid, poly_ord, wv_range):
     """
     Extrapolate `grid` using d_grid as a function of
-    `grid` to compute iteratively the next extrapolated nodes.
+    `grid` to compute the next extrapolated nodes.
     The extapolation is done with a polynomial of order `poly_ord`.
     The extrapolation range is given by `wv_range`.
     Returns the extrapolated grid.
@@ -153,39 +296,80 @@ def _extrapolate_grid(grid, poly_ord, wv_range):
     # by fitting a polynomial
     d_grid = np.diff(grid)
     f_dgrid = np.polyfit(grid[:-1], d_grid, poly_ord)
-    f_dgrid = np.poly1d(f_dgrid)
 
     # Extrapolate values out of the wv_map if needed
     grid_left, grid_right = [], []
     if wv_range[0] < grid.min():
-        # Need the grid value to get delta_grid ...
-        grid_left = [grid.min() - f_dgrid(grid.min())]
-        # ... and iterate to get the next one until
-        # the range is reached
-        while True:
-            next_val = grid_left[-1] - f_dgrid(grid_left[-1])
-            if next_val < wv_range[0]:
-                break
-            else:
-                grid_left.append(next_val)
-        # Need to sort (and unique)
-        grid_left = np.unique(grid_left)
+        # Computed from right to left, so need to reverse
+        grid_left = _extrapolate_nodes(f_dgrid, grid.min(), wv_range[0], -1)
+        grid_left = grid_left[::-1]
     if wv_range[-1] > grid.max():
-        # Need the grid value to get delta_grid ...
-        grid_right = [grid.max() + f_dgrid(grid.max())]
-        # ... and iterate to get the next one until
-        # the range is reached
-        while True:
-            next_val = grid_right[-1] + f_dgrid(grid_right[-1])
-            if next_val > wv_range[-1]:
-                break
-            else:
-                grid_right.append(next_val)
+        grid_right = _extrapolate_nodes(f_dgrid, grid.max(), wv_range[-1], 1)
 
     # Combine to get output
     return np.concatenate([grid_left, grid, grid_right])
 
 
+def _extrapolate_nodes(coeffs, x_0, bound, sign):
+    """
+    Return the nodes given by x_n = x_(n-1) + sign * d_grid(x_(n-1)),
+    starting at `x_0`, where d_grid is the polynomial with coefficients
+    `coeffs` (see np.polyfit). The first node is always returned,
+    then the next ones until `bound` is passed.
+    If d_grid is linear (or constant), the closed-form solution
+    of the recurrence is used, so all nodes are computed at once.
+    """
+    message = "The extrapolated grid spacing is not positive."
+    message += " Cannot reach {}.".format(bound)
+
+    # Make sure the grid is increasing (decreasing if sign < 0)
+    if np.polyval(coeffs, x_0) <= 0:
+        raise ValueError(message)
+
+    # General case: iterate
+    if len(coeffs) > 2:
+        nodes = [x_0 + sign * np.polyval(coeffs, x_0)]
+        while True:
+            d_node = np.polyval(coeffs, nodes[-1])
+            if d_node <= 0:
+                raise ValueError(message)
+            next_val = nodes[-1] + sign * d_node
+            if sign * (next_val - bound) > 0:
+                break
+            nodes.append(next_val)
+
+        return np.array(nodes)
+
+    # Linear recurrence x_n = x_(n-1) + d_0 + rate * (x_(n-1) - x_0),
+    # with d_0 the first step, so the solution is
+    # x_n = x_0 + d_0 * ((1 + rate)**n - 1) / rate
+    rate = sign * coeffs[0] if len(coeffs) == 2 else 0.
+    d_0 = sign * np.polyval(coeffs, x_0)
+
+    # Number of nodes needed to reach `bound`
+    if rate == 0:
+        n_max = (bound - x_0) / d_0
+    else:
+        arg = (bound - x_0) * rate / d_0
+        # The recurrence must not oscillate or converge before `bound`
+        if rate <= -1 or arg <= -1:
+            raise ValueError(message)
+        n_max = np.log1p(arg) / np.log1p(rate)
+
+    # Compute all nodes (with some margin)
+    n = np.arange(1, np.floor(n_max) + 3)
+    if rate == 0:
+        nodes = x_0 + d_0 * n
+    else:
+        nodes = x_0 + d_0 * np.expm1(n * np.log1p(rate)) / rate
+
+    # Keep the first node and the ones before `bound`
+    keep = (sign * (nodes - bound) <= 0)
+    keep[0] = True
+
+    return nodes[keep]
+
+
 def oversample_grid(lam_grid, n_os=1):
     """
     Returns lam_grid evenly oversample at `n_os`.
@@ -212,22 +396,29 @@ def oversample_grid(lam_grid, n_os=1):
     if n_os.ndim == 0:
         n_os = np.repeat(n_os, len(lam_grid)-1)
 
+    # At least one node (the lower bound) in each intervals
+    n_os = np.clip(n_os, 1, None).astype(int)
+
     # Grid intervals
     d_lam = np.diff(lam_grid)
-    # Init grid for output
-    new_grid = lam_grid.copy()
-    # Iterate to generate nodes
-    for i_os in range(1, n_os.max()):
-        # Compute only nodes that need to be computed
-        index = (n_os > i_os)
-        # Compute the next node in each grid intervals
-        sub_grid = (lam_grid[:-1][index]
-                    + i_os * d_lam[index] / n_os[index])
-        # Add to ouput grid
-        new_grid = np.concatenate([new_grid, sub_grid])
-
-    # Return sorted and unique
-    return np.unique(new_grid)
+
+    # Interval and position inside the interval of each new node
+    i_start = np.concatenate([[0], np.cumsum(n_os)])
+    i_int = np.repeat(np.arange(len(n_os)), n_os)
+    i_os = np.arange(i_start[-1]) - i_start[i_int]
+
+    # Compute all nodes at once (add the last grid value)
+    new_grid = np.empty(i_start[-1] + 1)
+    new_grid[:-1] = (lam_grid[:-1][i_int]
+                     + i_os * d_lam[i_int] / n_os[i_int])
+    new_grid[-1] = lam_grid[-1]
+
+    # The nodes are already sorted and unique
+    # if lam_grid is strictly increasing
+    if (d_lam > 0).all():
+        return new_grid
+    else:
+        return np.unique(new_grid)
 
 
 def get_soss_grid(p_list, lam_list, lam_min=0.55, lam_max=3.0, n_os=None):
@@ -304,15 +495,22 @@ def get_soss_grid(p_list, lam_list, lam_min=0.55, lam_max=3.0, n_os=None):
 
 
 def uneven_grid(lam_grid, n_os=1, space=None):
-
+    """
+    Returns lam_grid with `n_os` - 1 nodes added around each
+    node (except the last one), alternating on the right and the left,
+    at a distance given by `space` times the grid intervals.
+    Default for `space` is 1 / `n_os`.
+    """
     if space is None:
         space = 1/n_os
 
     if n_os > 1:
         d_lam = np.diff(lam_grid) * space
-        sub_grid = [lam_grid[:-1] + (-1)**(i-1) * ((i+1)//2) * d_lam
-                    for i in range(1, n_os)]
-        new_grid = np.concatenate([lam_grid, *sub_grid])
+        # Offsets of the new nodes: 1, -1, 2, -2, ...
+        i_os = np.arange(1, n_os)
+        offset = (-1)**(i_os-1) * ((i_os+1)//2)
+        sub_grid = lam_grid[:-1] + offset[:, None] * d_lam
+        new_grid = np.concatenate([lam_grid, sub_grid.ravel()])
         return np.unique(new_grid)
     else:
         return lam_grid
@@ -334,6 +532,8 @@ def get_n_nodes(grid, fct, tol=1.48e-4,
     to deal with multiple intervals separately. It also returns the
     number of nodes needed to reached the required precision instead
     of returning the value of the integral.
+    The computations are done by a `RombergNodes` object, which can
+    be kept to re-use the function evaluations.
     Parameters
     ----------
     grid: 1D array-like
@@ -365,82 +565,164 @@ def get_n_nodes(grid, fct, tol=1.48e-4,
     ----------
     .. [1] 'Romberg's method' https://en.wikipedia.org/wiki/Romberg%27s_method
     """
-    n_intervals = len(grid)-1
-    i_bad = np.arange(n_intervals)
-    n_grid = np.repeat(-1, n_intervals)
-    residual = np.repeat(np.nan, n_intervals)
-
-    intervals = np.array([grid[:-1], grid[1:]])
-    intrange = np.diff(grid)
-    err = np.inf
-
-    # First estimate without subdivision
-    n = 1
-    ordsum = difftrap(fct, intervals, n)
-    results = intrange * ordsum
-    last_row = [results]
-
-    for i_div in range(1, divmax+1):
+    romberg = RombergNodes(grid, fct)
 
-        # Refine number of points
-        n *= 2
+    return romberg.get_n_nodes(tol=tol, rtol=rtol,
+                               divmax=divmax, out_res=out_res)
 
-        # Evaluate trpz integration for intervals
-        # that are not converged
-        ordsum += difftrap(fct, intervals[:, i_bad], n)
-        row = [intrange[i_bad] * ordsum / n]
 
-        # Compute Romberg for each computed sub grids
-        for k in range(i_div):
-            romb_k = _romberg_diff(last_row[k], row[k], k+1)
-            row = np.vstack([row, romb_k])
-
-        # Save R(n,n) and R(n-1,n-1) from Romberg method
-        results = row[i_div]
-        lastresults = last_row[i_div-1]
-
-        # Estimate error
-        err = np.abs(results - lastresults)
-
-        # Find intervals that are converged
-        conv = (err < tol) | (err < rtol * np.abs(results))
+@memoize()
+def get_romberg_nodes(grid, y_grid, kind='cubic'):
+    """
+    Return a `RombergNodes` object for the function given by the
+    interpolation (scipy.interpolate.interp1d) of `y_grid` on `grid`.
+    The output is cached, so the function evaluations are re-used
+    when called again with the same values (for example to test
+    different tolerances).
+    """
+    fct = interp1d(grid, y_grid, kind=kind)
 
-        # Save number of nodes for these intervals
-        n_grid[i_bad[conv]] = n
+    return RombergNodes(grid, fct)
 
-        # Save residuals
-        residual[i_bad] = err
 
-        # Stop if convergence
-        if conv.all():
-            # All converged!
-            break
+class RombergNodes:
+    """
+    Vectorised Romberg integration over each intervals of a grid,
+    used to find the number of nodes needed in each intervals (see
+    `get_n_nodes`). The sums of the new ordinates (see `difftrap`)
+    are saved for each interval and each level of refinement, so
+    the function is never evaluated twice at the same point when
+    `get_n_nodes` is called again (with different tolerances or `divmax`).
+    """
+    def __init__(self, grid, fct):
+        """
+        Parameters
+        ----------
+        grid: 1D array-like
+            Grid for integration. Each sections of this grid are treated
+            as separate integrals.
+        fct: callable
+            Function to be integrated (must accept vector arguments).
+        """
+        grid = np.array(grid)
+
+        self.grid = grid
+        self.fct = fct
+        self.intervals = np.array([grid[:-1], grid[1:]])
+        self.intrange = np.diff(grid)
+        self.n_intervals = len(grid) - 1
+
+        # First level (no subdivision). The bounds are shared
+        # between the intervals, so evaluate only once on the grid.
+        f_grid = fct(grid)
+        self.ordsum = [0.5 * (f_grid[:-1] + f_grid[1:])]
+        self.computed = [np.ones(self.n_intervals, dtype=bool)]
+
+    def get_ordsum(self, level, index):
+        """
+        Return the cumulated sum of the ordinates (see `difftrap`)
+        at a given `level` (2**level trapezoids) for the intervals
+        given by `index`. Only the intervals not computed yet
+        are evaluated. The previous levels must be computed.
+        """
+        # Init new level
+        if level == len(self.ordsum):
+            self.ordsum.append(np.full(self.n_intervals, np.nan))
+            self.computed.append(np.zeros(self.n_intervals, dtype=bool))
+
+        # Evaluate the intervals not computed yet
+        i_new = index[~self.computed[level][index]]
+        if i_new.size > 0:
+            new_sum = difftrap(self.fct, self.intervals[:, i_new], 2**level)
+            self.ordsum[level][i_new] = self.ordsum[level-1][i_new] + new_sum
+            self.computed[level][i_new] = True
+
+        return self.ordsum[level][index]
+
+    def get_trpz(self, level, index):
+        """
+        Return the trapezoidal integration at a given `level`
+        (2**level trapezoids) for the intervals given by `index`.
+        """
+        ordsum = self.get_ordsum(level, index)
+
+        return self.intrange[index] * ordsum / 2**level
+
+    def get_n_nodes(self, tol=1.48e-4, rtol=1.48e-4,
+                    divmax=10, out_res=False):
+        """
+        Return the number of nodes needed on each intervals of
+        the grid to reach the specified tolerance.
+        Intervals that are converged are not refined anymore.
+        See `get_n_nodes` function for the description of the parameters.
+        """
+        n_intervals = self.n_intervals
+        i_bad = np.arange(n_intervals)
+        n_grid = np.repeat(-1, n_intervals)
+        residual = np.repeat(np.nan, n_intervals)
+        err = np.inf
+
+        # First estimate without subdivision
+        n = 1
+        last_row = [self.get_trpz(0, i_bad)]
+
+        for i_div in range(1, divmax+1):
+
+            # Refine number of points
+            n *= 2
+
+            # Trpz integration for intervals that are not converged
+            row = [self.get_trpz(i_div, i_bad)]
+
+            # Compute Romberg for each computed sub grids
+            for k in range(i_div):
+                romb_k = _romberg_diff(last_row[k], row[k], k+1)
+                row = np.vstack([row, romb_k])
+
+            # Save R(n,n) and R(n-1,n-1) from Romberg method
+            results = row[i_div]
+            lastresults = last_row[i_div-1]
+
+            # Estimate error
+            err = np.abs(results - lastresults)
+
+            # Find intervals that are converged
+            conv = (err < tol) | (err < rtol * np.abs(results))
+
+            # Save number of nodes for these intervals
+            n_grid[i_bad[conv]] = n
+
+            # Save residuals
+            residual[i_bad] = err
+
+            # Stop if convergence
+            if conv.all():
+                # All converged!
+                break
 
-        # Find intervals not converged
-        i_bad = i_bad[~conv]
+            # Find intervals not converged
+            i_bad = i_bad[~conv]
 
-        # Save last_row for the next iteration
-        # but keep only non-converged intervals
-        last_row = row[:, ~conv]
-        # Same for ordsum
-        ordsum = ordsum[~conv]
+            # Save last_row for the next iteration
+            # but keep only non-converged intervals
+            last_row = row[:, ~conv]
 
-    else:
-        # Warn that convergence is not reached everywhere
-        # and print max residual.
-        message = "divmax (%d) exceeded. Latest difference = {}"
-        warn(message.format(divmax, err.max()), AccuracyWarning)
-
-    # Make sure all values of n_grid where assigned during process
-    if (n_grid == -1).any():
-        raise ValueError("Values where not assigned at grid "
-                         + "position: {}".format(np.where(n_grid == -1)))
-
-    # Return
-    if out_res:
-        return n_grid, residual
-    else:
-        return n_grid
+        else:
+            # Warn that convergence is not reached everywhere
+            # and print max residual.
+            message = "divmax ({}) exceeded. Latest difference = {}"
+            warn(message.format(divmax, err.max()), AccuracyWarning)
+
+        # Make sure all values of n_grid where assigned during process
+        if (n_grid == -1).any():
+            raise ValueError("Values where not assigned at grid "
+                             + "position: {}".format(np.where(n_grid == -1)))
+
+        # Return
+        if out_res:
+            return n_grid, residual
+        else:
+            return n_grid
 
 
 def difftrap(fct, interval, numtraps):
@@ -486,13 +486,13 @@ Outputs:
                    'pixel' input parameter.
     """
     
-    pixel = 2048-pixel/noversample            # tp.flipX(pixel)                     # Subtracting from 2048 each pixel value to ensure that the spectral axis from
-                                                     # left-to-right corresponds to decreasing wavelength values
-    #pixel = pixel / noversample              # Adjusts the pixel values based on oversampling
+    # The 'sim' frame of tracepol has the spectral axis from left-to-right corresponding to decreasing
+    # wavelength values. The inverse of the trace solution is evaluated with a lookup table (fast, and
+    # consistent with w2p within its error bound).
+    wave_MICRON = tp.specpix_to_wavelength(pixel, tracePars, m=ntrace, frame='sim', oversample=noversample,
+                                           use_lookup=True)  # From 'jwst-mtl/SOSS/trace/tracepol.py'
     
-    wave_MICRON = tp.x2wavelength(pixel,tracePars,m=ntrace) # From 'jwst-mtl/SOSS/trace/tracepol.py'
-    
-    if maskON:   # Decides whether or not to return the masking provided by the x2wavelength routine. Default is 'False' 
+    if maskON:   # Decides whether or not to return the masking provided by the specpix_to_wavelength routine. Default is 'False' 
                     # because this functionality was not present before in J Rowe's previous implementation of 'p2w'
         return wave_MICRON[0] * 10000 , wave_MICRON[1]
     
@@ -518,18 +518,17 @@ Outputs:
                    'wave_ANG' input parameter.
     """
     
-    pixel = list( tp.wavelength2x(wave_ANG/10000,tracePars,m=ntrace) )  # From 'jwst-mtl/SOSS/trace/tracepol.py'.
-                                                                           # Routine requires microns instead of Angstroms 
-    pixel[0] = pixel[0] * noversample  # Adjust pixels based on oversampling
+    # Routine requires microns instead of Angstroms. The 'sim' frame has the spectral axis from left-to-right
+    # corresponding to decreasing wavelength values.
+    specpix, spatpix, mask = tp.wavelength_to_pix(wave_ANG/10000, tracePars, m=ntrace, frame='sim',
+                                                  oversample=noversample)  # From 'jwst-mtl/SOSS/trace/tracepol.py'.
     
-    if maskON:   # Decides whether or not to return the masking provided by the wavelength2x routine. Default is 'False' 
+    if maskON:   # Decides whether or not to return the masking provided by the wavelength_to_pix routine. Default is 'False' 
                     # because this functionality was not present before in J Rowe's previous implementation of 'w2p'
-        #return tp.flipX(pixel[0]) , pixel[1]
-        return noversample*2048-pixel[0], pixel[1]
+        return specpix, mask
     
-    #return tp.flipX(pixel[0])  # Subtracting from 2048 each pixel value to ensure that the spectral axis from left-to-right
-    return noversample*2048-pixel[0]
-                             # corresponds to decreasing wavelength values
+    return specpix
+
 
 def ptrace(tracePars, pixel, noversample=1, ntrace=1 , maskON=False):
     
@@ -551,13 +550,13 @@ Outputs:
                    'pixel' input parameter.
     """
     
-    wv_ANG = p2w(tracePars, pixel,noversample=noversample , ntrace=ntrace , maskON=maskON)
+    wv_ANG, mask = p2w(tracePars, pixel, noversample=noversample, ntrace=ntrace, maskON=True)
+    _, y, _ = tp.wavelength_to_pix(wv_ANG/10000, tracePars, m=ntrace, frame='sim',
+                                   oversample=noversample)  # Need to input microns instead of Angstroms
     if maskON:
-        y , mask = tp.wavelength2y(wv_ANG[0]/10000, tracePars, m=ntrace)  # Need to input microns instead of Angstroms
-        return y*noversample , mask
+        return y, mask
     else:
-        y = tp.wavelength2y(wv_ANG/10000, tracePars, m=ntrace)
-        return y[0]*noversample
+        return y
 
 
 def addflux2pix(px,py,pixels,fmod):
@@ -4,14 +4,23 @@ Created on Mon Feb 17 13:31:58 2020
 @author: talens-irex
 """
 
+import os
+import hashlib
+from warnings import warn
+
 import numpy as np
 from numpy.polynomial import Legendre
+from numpy.polynomial.legendre import legval
 
 from astropy.io import ascii
 
 # SUBSTRIP256 keeps solumns 0:255 (0 based) in the nat frame.
 # SUBSTRIP96 keeps columns 150:245 (0 based) in the nat frame.
 
+# Version of the trace polynomial fits. Increase it when trace_polynomial or get_tracepars
+# change, so the fits cached with a previous version are not used.
+TRACEPARS_VERSION = 1
+
 
 def trace_polynomial(trace, m=1, maxorder=15):
     """Fit a polynomial to the trace of order m and return a
@@ -76,13 +85,104 @@ def trace_polynomial(trace, m=1, maxorder=15):
     return pars
 
 
-def get_tracepars(filename=None):
+def _tracepars_cache_file(filename, cache_dir=None):
+    """Return the name of the file where the fits of get_tracepars are cached.
+
+    :param filename: file containing modelled trace points.
+    :param cache_dir: directory of the cache file. Default is the directory of filename.
+
+    :type filename: str
+    :type cache_dir: str
+
+    :returns: cache_file - the name of the cache file.
+    :rtype: str
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(filename))
+
+    return os.path.join(cache_dir, os.path.basename(filename) + '.tracepars.npz')
+
+
+def save_tracepars(tracepars, cache_file, key):
+    """Write the trace polynomial fits to a cache file.
+
+    :param tracepars: the trace polynomial solutions returned by get_tracepars.
+    :param cache_file: the name of the cache file.
+    :param key: the hash of the file used to compute the fits.
+
+    :type tracepars: dict
+    :type cache_file: str
+    :type key: str
+    """
+
+    arrays = dict()
+    arrays['version'] = TRACEPARS_VERSION
+    arrays['key'] = key
+    arrays['orders'] = np.array(list(tracepars.keys()))
+    for m, pars in tracepars.items():
+        for name, value in pars.items():
+            arrays['{}_{}'.format(m, name)] = value
+
+    # Write to a temporary file first, so an interrupted write does not leave a corrupted cache.
+    tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, cache_file)
+
+    return
+
+
+def load_tracepars(cache_file, key):
+    """Read the trace polynomial fits from a cache file.
+
+    :param cache_file: the name of the cache file.
+    :param key: the hash of the file used to compute the fits.
+
+    :type cache_file: str
+    :type key: str
+
+    :returns: tracepars - the trace polynomial solutions, None if the cache file
+    does not exist or was made with another version or another trace file.
+    :rtype: dict
+    """
+
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+
+            # The cache is only valid for the same version and the same trace file.
+            if data['version'] != TRACEPARS_VERSION or str(data['key']) != key:
+                return None
+
+            tracepars = dict()
+            for m in data['orders']:
+                pars = dict()
+                for name in ['spat', 'spec', 'wave']:
+                    pars[name + '_coef'] = data['{}_{}_coef'.format(m, name)]
+                    pars[name + '_domain'] = data['{}_{}_domain'.format(m, name)]
+                tracepars[m] = pars
+
+    except (OSError, KeyError, ValueError):
+        return None
+
+    return tracepars
+
+
+def get_tracepars(filename=None, use_cache=True, cache_dir=None):
     """Read a file containing the trace profile and generate
     polynomial parameters for each order.
 
+    The fits are cached in a file (see _tracepars_cache_file) keyed by the hash of
+    the content of filename and by TRACEPARS_VERSION, so they are only computed
+    again when the trace file changes.
+
     :param filename: file containing modelled trace points.
+    :param use_cache: if True, read and write the cached fits.
+    :param cache_dir: directory of the cache file. Default is the directory of filename.
 
     :type filename: str
+    :type use_cache: bool
+    :type cache_dir: str
 
     :returns: tracepars - a dictionary containg the parameters for the polynomial fits.
     :rtype: dict
@@ -90,7 +190,19 @@ def get_tracepars(filename=None):
     
     if filename is None:
         filename = 'NIRISS_GR700_trace_extended.csv'  # TODO Switch to pkg_resources in the future.
-    
+
+    if use_cache:
+
+        # Hash of the trace file.
+        with open(filename, 'rb') as f:
+            key = hashlib.sha1(f.read()).hexdigest()
+
+        # Use the cached fits if they are valid.
+        cache_file = _tracepars_cache_file(filename, cache_dir=cache_dir)
+        tracepars = load_tracepars(cache_file, key)
+        if tracepars is not None:
+            return tracepars
+
     # Read the trace.
     trace = ascii.read(filename)  # Read the Code V trace model from file. DS9 coordinates are used.
     trace['xpos'] /= 0.018  # Convert from micron to pixels.
@@ -103,10 +215,398 @@ def get_tracepars(filename=None):
     for m in np.unique(trace['order']):
         pars = trace_polynomial(trace, m=m)
         tracepars[m] = pars
-        
+
+    if use_cache:
+
+        # Save the fits for the next call, the directory may not be writable.
+        try:
+            save_tracepars(tracepars, cache_file, key)
+        except OSError as err:
+            warn('Could not write the trace polynomial cache {}: {}'.format(cache_file, err))
+
     return tracepars
 
 
+def _compile_legendre(coef, domain):
+    """Pre-compute the quantities needed to evaluate a Legendre series
+    and its derivative.
+
+    :param coef: the coefficients of the Legendre series.
+    :param domain: the domain of the Legendre series.
+
+    :type coef: array[float]
+    :type domain: array[float]
+
+    :returns: pol - dictionary with the coefficients, the derivative coefficients
+    and the parameters (offset, scale) of the linear map from the domain to [-1, 1].
+    :rtype: dict
+    """
+
+    legpol = Legendre(coef, domain=domain)
+    off, scl = legpol.mapparms()
+
+    pol = dict()
+    pol['coef'] = legpol.coef
+    pol['dcoef'] = legpol.deriv().coef
+    pol['off'] = off
+    pol['scl'] = scl
+    pol['domain'] = legpol.domain
+
+    return pol
+
+
+def _eval_legendre(pol, x, deriv=False):
+    """Evaluate a Legendre series pre-computed by _compile_legendre.
+
+    :param pol: the output of _compile_legendre.
+    :param x: the values where the series is evaluated.
+    :param deriv: if True, evaluate the derivative instead.
+
+    :type pol: dict
+    :type x: array[float]
+    :type deriv: bool
+
+    :returns: values - the series (or derivative) evaluated at x.
+    :rtype: array[float]
+    """
+
+    if deriv:
+        coef = pol['dcoef']
+    else:
+        coef = pol['coef']
+
+    return legval(pol['off'] + pol['scl']*x, coef)
+
+
+class InverseLookup:
+    """Lookup-table inverse of the spectral trace polynomial of one order.
+
+    log(wavelength) and its derivative are tabulated on a uniform grid of spectral pixels
+    (solving the spectral polynomial with Newton's method), and the inverse is evaluated by cubic
+    Hermite interpolation of the table, so no search is needed. The table is refined until the
+    error, measured at the middle of every interval (where the Hermite interpolation error is
+    maximal), is below tol/2 pixels. The inverse is therefore consistent with the spectral
+    polynomial, unlike the separately fitted wavelength polynomial. If the polynomial is not
+    monotonic over its domain, only its longest monotonic part is used.
+    """
+
+    def __init__(self, pol, tol=1e-4, nmin=257, nmax=2**20 + 1):
+        """
+        :param pol: the spectral polynomial, as returned by _compile_legendre.
+        :param tol: the maximum error of the inverse, in pixels.
+        :param nmin: the initial number of nodes in the table.
+        :param nmax: the maximum number of nodes in the table.
+
+        :type pol: dict
+        :type tol: float
+        :type nmin: int
+        :type nmax: int
+        """
+
+        self.pol = pol
+        self.tol = tol
+
+        # Dense sampling of the longest monotonic part of the domain,
+        # used as the starting point of Newton's method.
+        logwave = np.linspace(pol['domain'][0], pol['domain'][1], 4*nmin)
+        self._guess_logwave = self._monotonic_part(logwave)
+        self._guess_specpix = _eval_legendre(pol, self._guess_logwave)
+        if self._guess_specpix[-1] < self._guess_specpix[0]:
+            self._guess_logwave = self._guess_logwave[::-1]
+            self._guess_specpix = self._guess_specpix[::-1]
+        self.bounds = self._guess_specpix[[0, -1]]
+
+        # Refine the table until the error is below tol/2.
+        n = nmin
+        while True:
+
+            self._set_table(n)
+
+            # Error (in pixels) at the middle of each interval.
+            specpix_mid = self.specpix0 + self.step*(np.arange(n - 1) + 0.5)
+            logwave_mid, dspecpix_mid = self._solve(specpix_mid)
+            error = np.abs(self._interp(specpix_mid) - logwave_mid)*np.abs(dspecpix_mid)
+            self.error = np.max(error)
+
+            if self.error < tol/2:
+                break
+
+            if 2*n - 1 > nmax:
+                raise ValueError('The inverse lookup table did not reach tol={} with {} nodes.'.format(tol, n))
+
+            # Double the number of intervals (the nodes are kept).
+            n = 2*n - 1
+
+    def _monotonic_part(self, logwave):
+        """Return the longest part of logwave where the polynomial is monotonic."""
+
+        # Sign of the derivative at each node.
+        sign = np.sign(_eval_legendre(self.pol, logwave, deriv=True))
+
+        # Limits of the parts with a constant sign.
+        edges = np.flatnonzero(sign[1:] != sign[:-1]) + 1
+        starts = np.concatenate([[0], edges])
+        ends = np.concatenate([edges, [len(logwave)]])
+
+        # Keep the longest part, inside the nodes where the sign changes.
+        i = np.argmax(ends - starts)
+        if sign[starts[i]] == 0:
+            raise ValueError('The spectral trace polynomial is not monotonic.')
+
+        return logwave[starts[i]:ends[i]]
+
+    def _solve(self, specpix, maxiter=50, xtol=1e-13):
+        """Solve the spectral polynomial for log(wavelength) with Newton's method.
+        Return log(wavelength) and the derivative of specpix at the solution."""
+
+        lower, upper = np.sort(self._guess_logwave[[0, -1]])
+
+        # Start from the linear interpolation of the dense sampling.
+        logwave = np.interp(specpix, self._guess_specpix, self._guess_logwave)
+
+        for _ in range(maxiter):
+            dspecpix = _eval_legendre(self.pol, logwave, deriv=True)
+            delta = (_eval_legendre(self.pol, logwave) - specpix)/dspecpix
+            logwave = np.clip(logwave - delta, lower, upper)
+            if np.all(np.abs(delta) <= xtol):
+                break
+
+        return logwave, _eval_legendre(self.pol, logwave, deriv=True)
+
+    def _set_table(self, n):
+        """Tabulate log(wavelength) and its derivative on n uniform spectral pixels."""
+
+        specpix = np.linspace(self.bounds[0], self.bounds[1], n)
+        logwave, dspecpix = self._solve(specpix)
+
+        self.specpix0 = specpix[0]
+        self.step = specpix[1] - specpix[0]
+        self.logwave = logwave
+
+        # Coefficients of the cubic Hermite polynomial of each interval,
+        # in powers of the position t in the interval.
+        dlogwave = self.step/dspecpix  # Derivative of the inverse, per table step.
+        y0, y1 = logwave[:-1], logwave[1:]
+        d0, d1 = dlogwave[:-1], dlogwave[1:]
+        self.coef = np.array([y0, d0, 3*(y1 - y0) - 2*d0 - d1, 2*(y0 - y1) + d0 + d1])
+
+    def _interp(self, specpix):
+        """Cubic Hermite interpolation of log(wavelength) at specpix."""
+
+        # Interval and position in the interval.
+        x = (specpix - self.specpix0)/self.step
+        index = np.clip(np.floor(x), 0, len(self.logwave) - 2).astype(int)
+        t = x - index
+
+        # Horner's method.
+        c0, c1, c2, c3 = self.coef
+
+        return c0[index] + t*(c1[index] + t*(c2[index] + t*c3[index]))
+
+    def __call__(self, specpix_nat):
+        """Return the log(wavelength) and the bounds mask at the nat spectral pixels specpix_nat."""
+
+        specpix_nat = np.asarray(specpix_nat, dtype=float)
+        logwave = self._interp(specpix_nat)
+        mask = bounds_check(specpix_nat, self.bounds[0], self.bounds[1])
+
+        return logwave, mask
+
+
+class TraceSolution:
+    """The trace polynomial solutions of all orders, compiled once for fast evaluation.
+
+    The Legendre series of get_tracepars, the mapping of their domains and their
+    derivatives are computed at initialisation, so each conversion is only a call
+    to legval. Arrays of any shape are accepted, and a list of orders can be given
+    to evaluate all of them in one call (the orders are then the first axis of the outputs).
+    """
+
+    def __init__(self, tracepars):
+        """
+        :param tracepars: the trace polynomial solutions returned by get_tracepars.
+        :type tracepars: dict
+        """
+
+        self.tracepars = tracepars
+        self.orders = list(tracepars.keys())
+
+        # Compile the polynomials of each order.
+        self.polys = dict()
+        for m in self.orders:
+            self.polys[m] = dict()
+            for key in ['spec', 'spat', 'wave']:
+                coef = tracepars[m][key + '_coef']
+                domain = tracepars[m][key + '_domain']
+                self.polys[m][key] = _compile_legendre(coef, domain)
+
+        # Inverse lookup tables, built when needed (see get_lookup).
+        self.lookups = dict()
+
+    def get_lookup(self, m, tol=1e-4):
+        """Return the inverse lookup table of order m (built once for each order and tol).
+
+        :param m: the spectral order.
+        :param tol: the maximum error of the inverse, in pixels.
+
+        :type m: int
+        :type tol: float
+
+        :returns: lookup - the inverse of the spectral polynomial of order m.
+        :rtype: InverseLookup
+        """
+
+        try:
+            lookup = self.lookups[m, tol]
+        except KeyError:
+            lookup = InverseLookup(self.polys[m]['spec'], tol=tol)
+            self.lookups[m, tol] = lookup
+
+        return lookup
+
+    def _per_order(self, fct, m, *args, **kwargs):
+        """Apply fct for a single order or stack the outputs for a list of orders."""
+
+        if np.ndim(m) == 0:
+            return fct(m, *args, **kwargs)
+
+        out = [fct(m_i, *args, **kwargs) for m_i in m]
+
+        return tuple(np.stack(out_i) for out_i in zip(*out))
+
+    def wavelength_to_pix(self, wavelength, m=1, frame='dms', subarray='SUBSTRIP256', oversample=1):
+        """Convert wavelength to pixel coordinates for order m (see wavelength_to_pix).
+        m can be a list of orders."""
+
+        return self._per_order(self._wavelength_to_pix, m, wavelength, frame=frame,
+                               subarray=subarray, oversample=oversample)
+
+    def _wavelength_to_pix(self, m, wavelength, frame='dms', subarray='SUBSTRIP256', oversample=1):
+
+        pols = self.polys[m]
+
+        # Convert wavelenght to nat pixel coordinates.
+        logwave = np.log(wavelength)
+        specpix_nat = _eval_legendre(pols['spec'], logwave)
+        spatpix_nat = _eval_legendre(pols['spat'], logwave)
+        mask = bounds_check(logwave, pols['spec']['domain'][0], pols['spec']['domain'][1])
+
+        # Convert coordinates to the requested frame.
+        specpix, spatpix = pix_ref_to_frame(specpix_nat, spatpix_nat, frame=frame, subarray=subarray)
+
+        # Oversample the coordinates.
+        specpix = specpix*oversample
+        spatpix = spatpix*oversample
+
+        return specpix, spatpix, mask
+
+    def specpix_to_wavelength(self, specpix, m=1, frame='dms', oversample=1, use_lookup=False, tol=1e-4):
+        """Convert the spectral pixel coordinate to wavelength for order m (see specpix_to_wavelength).
+        m can be a list of orders."""
+
+        return self._per_order(self._specpix_to_wavelength, m, specpix, frame=frame,
+                               oversample=oversample, use_lookup=use_lookup, tol=tol)
+
+    def _specpix_to_wavelength(self, m, specpix, frame='dms', oversample=1, use_lookup=False, tol=1e-4):
+
+        if use_lookup:
+            return self._specpix_to_wavelength_lookup(m, specpix, frame=frame, oversample=oversample, tol=tol)
+
+        pol = self.polys[m]['wave']
+
+        # Remove any oversampling.
+        specpix = specpix/oversample
+
+        # Convert the input coordinates to nat coordinates.
+        specpix_nat = specpix_frame_to_ref(specpix, frame=frame)
+
+        # Convert the specpix coordinates to wavelength.
+        with np.errstate(over='ignore'):
+            wavelength = np.exp(_eval_legendre(pol, specpix_nat))
+        mask = bounds_check(specpix_nat, pol['domain'][0], pol['domain'][1])
+
+        return wavelength, mask
+
+    def _specpix_to_wavelength_lookup(self, m, specpix, frame='dms', oversample=1, tol=1e-4):
+
+        lookup = self.get_lookup(m, tol=tol)
+
+        # Convert the input coordinates to nat coordinates.
+        specpix_nat = specpix_frame_to_ref(specpix/oversample, frame=frame)
+
+        # Invert the spectral polynomial.
+        logwave, mask = lookup(specpix_nat)
+        with np.errstate(over='ignore'):
+            wavelength = np.exp(logwave)
+
+        return wavelength, mask
+
+    def dispersion(self, wavelength, m=1, frame='dms', oversample=1):
+        """Return the derivatives of the pixel coordinates with respect to wavelength
+        (pixels per micron) for order m. m can be a list of orders.
+
+        :returns: dspecpix, dspatpix - the derivatives of the spectral and spatial pixel coordinates.
+        :rtype: Tuple(array[float], array[float])
+        """
+
+        return self._per_order(self._dispersion, m, wavelength, frame=frame, oversample=oversample)
+
+    def _dispersion(self, m, wavelength, frame='dms', oversample=1):
+
+        pols = self.polys[m]
+
+        # d(pix)/d(wave) = d(pix)/d(log(wave)) / wave
+        logwave = np.log(wavelength)
+        dspecpix = _eval_legendre(pols['spec'], logwave, deriv=True)/wavelength
+        dspatpix = _eval_legendre(pols['spat'], logwave, deriv=True)/wavelength
+
+        # The axes are flipped in the dms frame.
+        if frame == 'dms':
+            dspecpix, dspatpix = -dspecpix, -dspatpix
+        elif frame == 'sim':
+            dspecpix = -dspecpix
+        elif frame != 'nat':
+            raise ValueError('Unknown coordinate frame: {}'.format(frame))
+
+        return dspecpix*oversample, dspatpix*oversample
+
+
+# Trace solutions already compiled, see get_trace_solution.
+_TRACE_SOLUTIONS = dict()
+
+
+def get_trace_solution(tracepars):
+    """Return the TraceSolution of tracepars. The solutions are kept, so the
+    polynomials are only compiled once for a given set of parameters.
+
+    :param tracepars: the trace polynomial solutions returned by get_tracepars,
+    or directly a TraceSolution.
+
+    :type tracepars: dict or TraceSolution
+
+    :returns: solution - the compiled trace solution.
+    :rtype: TraceSolution
+    """
+
+    if isinstance(tracepars, TraceSolution):
+        return tracepars
+
+    # Key given by the values of the parameters.
+    key = tuple((m, name, np.asarray(val).tobytes()) for m in tracepars
+                for name, val in sorted(tracepars[m].items()))
+
+    try:
+        solution = _TRACE_SOLUTIONS[key]
+    except KeyError:
+        # Keep only a few solutions.
+        if len(_TRACE_SOLUTIONS) >= 16:
+            _TRACE_SOLUTIONS.clear()
+        solution = TraceSolution(tracepars)
+        _TRACE_SOLUTIONS[key] = solution
+
+    return solution
+
+
 def bounds_check(values, lower, upper):
     """Perform a simple bounds check on an array.
 
@@ -306,15 +806,15 @@ def wavelength_to_pix(wavelength, tracepars, m=1, frame='dms', subarray='SUBSTRI
     """Convert wavelength to pixel coordinates for order m.
 
     :param wavelength: wavelength values in microns.
-    :param tracepars: the trace polynomial solutions returned by get_tracepars.
-    :param m: the spectral order.
+    :param tracepars: the trace polynomial solutions returned by get_tracepars (or a TraceSolution).
+    :param m: the spectral order (or a list of orders).
     :param frame: the coordinate frame of the output coordinates (nat, dms or sim).
     :param subarray: the subarray of the output coordinates (SUBARRAY256 or SUBARRAY96).
     :param oversample: the oversampling factor of the outpur coordinates.
 
     :type wavelength: array[float]
-    :type tracepars: dict
-    :type m: int
+    :type tracepars: dict or TraceSolution
+    :type m: int or list[int]
     :type frame: str
     :type subarray: str
     :type oversample: int
@@ -324,99 +824,256 @@ def wavelength_to_pix(wavelength, tracepars, m=1, frame='dms', subarray='SUBSTRI
     :rtype: Tuple(array[float], array[float], array[bool])
     """
 
-    # Convert wavelenght to nat pixel coordinates.
-    w2spec = Legendre(tracepars[m]['spec_coef'], domain=tracepars[m]['spec_domain'])
-    w2spat = Legendre(tracepars[m]['spat_coef'], domain=tracepars[m]['spat_domain'])
+    solution = get_trace_solution(tracepars)
 
-    specpix_nat = w2spec(np.log(wavelength))
-    spatpix_nat = w2spat(np.log(wavelength))
-    mask = bounds_check(np.log(wavelength), tracepars[m]['spec_domain'][0], tracepars[m]['spec_domain'][1])
+    return solution.wavelength_to_pix(wavelength, m=m, frame=frame, subarray=subarray,
+                                      oversample=oversample)
 
-    # Convert coordinates to the requested frame.
-    specpix, spatpix = pix_ref_to_frame(specpix_nat, spatpix_nat, frame=frame, subarray=subarray)
 
-    # Oversample the coordinates.
-    specpix = specpix*oversample
-    spatpix = spatpix*oversample
-
-    return specpix, spatpix, mask
-
-
-def specpix_to_wavelength(specpix, tracepars, m=1, frame='dms', oversample=1):
+def specpix_to_wavelength(specpix, tracepars, m=1, frame='dms', oversample=1, use_lookup=False, tol=1e-4):
     """Convert the spectral pixel coordinate to wavelength for order m.
 
     :param specpix: the pixel values.
-    :param tracepars: the trace polynomial solutions returned by get_tracepars.
-    :param m: the spectral order.
+    :param tracepars: the trace polynomial solutions returned by get_tracepars (or a TraceSolution).
+    :param m: the spectral order (or a list of orders).
     :param frame: the coordinate frame of the input coordinates (nat, dms or sim).
     :param oversample: the oversampling factor of the input coordinates.
+    :param use_lookup: if True, invert the spectral polynomial with a lookup table (see InverseLookup)
+    instead of evaluating the wavelength polynomial.
+    :param tol: the maximum error of the lookup table, in pixels.
 
     :type specpix: array[float]
-    :type tracepars: dict
-    :type m: int
+    :type tracepars: dict or TraceSolution
+    :type m: int or list[int]
     :type frame: str
     :type oversample: int
+    :type use_lookup: bool
+    :type tol: float
 
     :returns: wavelength - an array containing the wavelengths corresponding to specpix,
     mask - an array that is True when the specpix values were within the valid range of the polynomial.
     :rtype: Tuple(array[float], array[bool])
     """
 
-    # Remove any oversampling.
-    specpix = specpix/oversample
+    solution = get_trace_solution(tracepars)
+
+    return solution.specpix_to_wavelength(specpix, m=m, frame=frame, oversample=oversample,
+                                          use_lookup=use_lookup, tol=tol)
+
+
+def _subarray_rows(subarray='SUBSTRIP256', oversample=1):
+    """Return the first and last (excluded) rows of the subarray in the SUBSTRIP256 dms frame.
+
+    :param subarray: the subarray (SUBARRAY256 or SUBARRAY96).
+    :param oversample: the oversampling factor of the coordinates.
+
+    :type subarray: str
+    :type oversample: int
+
+    :returns: row_min, row_max - the range of rows of the subarray.
+    :rtype: Tuple(int, int)
+    """
+
+    if subarray == 'SUBSTRIP256':
+        row_min, row_max = 0, 256*int(oversample)
+    elif subarray == 'SUBSTRIP96':
+        row_min, row_max = 10*int(oversample), 106*int(oversample)
+    else:
+        raise ValueError('Unknown subarray: {}'.format(subarray))
+
+    return row_min, row_max
+
+
+def _get_tilt_function(tilt):
+    """Return the monochromatic tilt as a function of wavelength and order.
+
+    :param tilt: the tilt in degrees, either a constant or a function tilt(wavelength, m).
+
+    :type tilt: float or callable
+
+    :returns: tilt_fct - function of (wavelength, m) giving the tilt in degrees.
+    :rtype: callable
+    """
+
+    if tilt is None:
+        raise ValueError("The tilt must be given when 'use_tilt' is True.")
+
+    if callable(tilt):
+        return tilt
+
+    def tilt_fct(wavelength, m):
+        return np.full_like(wavelength, tilt)
+
+    return tilt_fct
+
+
+def _tilted_wavelengths(solution, m, specpix, spatpix, tilt_fct, niter=10, tol=1e-10):
+    """Find the wavelengths of the monochromatic lines passing through the pixels.
+
+    The monochromatic line of a wavelength goes through the trace position of this wavelength
+    with the angle given by tilt_fct, so a pixel (specpix, spatpix) has the wavelength that
+    satisfies specpix = specpix_trace + (spatpix - spatpix_trace)*tan(tilt). The wavelengths
+    are found iteratively, starting from the wavelengths without tilt.
+
+    :param solution: the compiled trace solution.
+    :param m: the spectral order.
+    :param specpix: spectral pixel coordinates (dms frame, not oversampled).
+    :param spatpix: spatial pixel coordinates (dms frame, SUBSTRIP256, not oversampled).
+    :param tilt_fct: function of (wavelength, m) giving the tilt in degrees.
+    :param niter: maximum number of iterations.
+    :param tol: the iterations stop when the wavelengths change by less than tol (microns).
+
+    :type solution: TraceSolution
+    :type m: int
+    :type specpix: array[float]
+    :type spatpix: array[float]
+    :type tilt_fct: callable
+    :type niter: int
+    :type tol: float
+
+    :returns: wavelength - the wavelengths of the pixels, mask - True where the
+    projected spectral pixels are within the valid range of the polynomial.
+    :rtype: Tuple(array[float], array[bool])
+    """
+
+    # Start from the wavelengths without tilt.
+    wavelength, mask = solution.specpix_to_wavelength(specpix, m=m, frame='dms')
+
+    with np.errstate(invalid='ignore', over='ignore'):
 
-    # Convert the input coordinates to nat coordinates.
-    specpix_nat = specpix_frame_to_ref(specpix, frame=frame)
+        for _ in range(niter):
 
-    # Convert the specpix coordinates to wavelength.
-    spec2w = Legendre(tracepars[m]['wave_coef'], domain=tracepars[m]['wave_domain'])
+            # Position of the trace at the current wavelengths.
+            _, spatpix_trace, _ = solution.wavelength_to_pix(wavelength, m=m, frame='dms',
+                                                             subarray='SUBSTRIP256')
 
-    with np.errstate(over='ignore'):
-        wavelength = np.exp(spec2w(specpix_nat))
-    mask = bounds_check(specpix_nat, tracepars[m]['wave_domain'][0], tracepars[m]['wave_domain'][1])
+            # Project the pixels on the trace along the monochromatic lines.
+            tan_tilt = np.tan(np.deg2rad(tilt_fct(wavelength, m)))
+            specpix_proj = specpix - (spatpix - spatpix_trace)*tan_tilt
+
+            wavelength_new, mask = solution.specpix_to_wavelength(specpix_proj, m=m, frame='dms')
+
+            # Stop when the wavelengths do not change anymore.
+            converged = ~(np.abs(wavelength_new - wavelength) > tol).any()
+            wavelength = wavelength_new
+
+            if converged:
+                break
 
     return wavelength, mask
 
 
-def wavelength_map_2d(tracepars, m=1, subarray='SUBSTRIP256', oversample=1, use_tilt=False):
+def wavelength_map_tiles(tracepars, m=1, subarray='SUBSTRIP256', oversample=1, use_tilt=False,
+                         tilt=None, tile_rows=64, dtype=float):
+    """Generate the wavelength map of order m (see wavelength_map_2d) by tiles of rows,
+    so only one tile is in memory at a time.
+
+    :param tracepars: the trace polynomial solutions returned by get_tracepars (or a TraceSolution).
+    :param m: the spectral order.
+    :param subarray: the subarray of the output coordinates (SUBARRAY256 or SUBARRAY96).
+    :param oversample: the oversampling factor of the output map.
+    :param use_tilt: Include the effect of tilt in the output.
+    :param tilt: the monochromatic tilt in degrees, a constant or a function tilt(wavelength, m).
+    Positive values are rotations from the spatial axis towards increasing dms spectral pixels.
+    :param tile_rows: the number of (oversampled) rows in each tile.
+    :param dtype: the data type of the tiles.
+
+    :type tracepars: dict or TraceSolution
+    :type m: int
+    :type subarray: str
+    :type oversample: int
+    :type use_tilt: bool
+    :type tilt: float or callable
+    :type tile_rows: int
+    :type dtype: data-type
+
+    :returns: row - the first row of the tile in the output map, tile - the wavelengths of the tile.
+    :rtype: Iterator[Tuple(int, array[float])]
+    """
+
+    oversample = int(oversample)
+    solution = get_trace_solution(tracepars)
+
+    if use_tilt:
+        tilt_fct = _get_tilt_function(tilt)
+
+    # Rows and columns of the output map, in the oversampled SUBSTRIP256 dms frame.
+    row_min, row_max = _subarray_rows(subarray, oversample=oversample)
+    ncols = 2048*oversample
+    specpix_dms = np.arange(ncols)
+
+    # Without tilt, the wavelengths only depend on the column.
+    if not use_tilt:
+        wavelength_row, mask = solution.specpix_to_wavelength(specpix_dms, m=m, frame='dms',
+                                                              oversample=oversample)
+        wavelength_row[~mask] = 0
+        wavelength_row = wavelength_row.astype(dtype)
+
+    for row in range(row_min, row_max, tile_rows):
+
+        spatpix_dms = np.arange(row, min(row + tile_rows, row_max))
+
+        if use_tilt:
+            specpix = np.broadcast_to(specpix_dms/oversample, (len(spatpix_dms), ncols))
+            spatpix = spatpix_dms[:, None]/oversample
+            tile, mask = _tilted_wavelengths(solution, m, specpix, spatpix, tilt_fct)
+            tile[~mask] = 0
+            tile = tile.astype(dtype, copy=False)
+        else:
+            tile = np.tile(wavelength_row, (len(spatpix_dms), 1))
+
+        # Set the reference pixels to zero.
+        tile[spatpix_dms >= 252*oversample] = 0
+        tile[:, :4*oversample] = 0
+        tile[:, -4*oversample:] = 0
+
+        yield row - row_min, tile
+
+
+def wavelength_map_2d(tracepars, m=1, subarray='SUBSTRIP256', oversample=1, use_tilt=False,
+                      tilt=None, dtype=float, out=None, tile_rows=64):
     """Compute the wavelengths of order m in dms coordinates for the specified subarray.
 
-    :param tracepars: the trace polynomial solutions returned by get_tracepars.
+    The map is computed by tiles of rows (see wavelength_map_tiles) and written to out,
+    which can be a memory-mapped array (e.g. numpy.lib.format.open_memmap) to build
+    large oversampled maps without holding them in memory.
+
+    :param tracepars: the trace polynomial solutions returned by get_tracepars (or a TraceSolution).
     :param m: the spectral order.
     :param subarray: the subarray of the output coordinates (SUBARRAY256 or SUBARRAY96).
     :param oversample: the oversampling factor of the input coordinates.
     :param use_tilt: Include the effect of tilt in the output.
+    :param tilt: the monochromatic tilt in degrees, a constant or a function tilt(wavelength, m).
+    Positive values are rotations from the spatial axis towards increasing dms spectral pixels.
+    :param dtype: the data type of the output map, if out is not given.
+    :param out: array where the map is written, of shape (nrows*oversample, 2048*oversample).
+    :param tile_rows: the number of (oversampled) rows computed at once.
 
-    :type tracepars: dict
+    :type tracepars: dict or TraceSolution
     :type m: int
     :type subarray: str
     :type oversample: int
     :type use_tilt: bool
+    :type tilt: float or callable
+    :type dtype: data-type
+    :type out: array[float]
+    :type tile_rows: int
 
     :returns: wavelength_map - A 2D array of wavelength values across the detector.
     :rtype: array[float]
     """
-    
-    if use_tilt:
-        raise ValueError("The 'use_tilt' option has not yet been implemented.")
-        
-    # Get the coordinates of the pixels in the subarray.
-    spatpix_dms, specpix_dms = np.indices((256*int(oversample), 2048*int(oversample)))
 
-    # Convert to wavelengths using the trace polynomials.
-    wavelength_map, mask = specpix_to_wavelength(specpix_dms, tracepars, m=m, frame='dms', oversample=oversample)
-    
-    # Set out-of-bounds and reference pixels to zero.
-    wavelength_map[~mask] = 0
-    wavelength_map[-4*int(oversample):] = 0
-    wavelength_map[:, :4*int(oversample)] = 0
-    wavelength_map[:, -4*int(oversample):] = 0
+    row_min, row_max = _subarray_rows(subarray, oversample=oversample)
+    shape = (row_max - row_min, 2048*int(oversample))
 
-    if subarray == 'SUBSTRIP256':
-        pass
-    elif subarray == 'SUBSTRIP96':
-        wavelength_map = wavelength_map[10*int(oversample):106*int(oversample)]
-    else:
-        raise ValueError('Unknown subarray: {}'.format(subarray))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError('The shape of out must be {}.'.format(shape))
+
+    for row, tile in wavelength_map_tiles(tracepars, m=m, subarray=subarray, oversample=oversample,
+                                          use_tilt=use_tilt, tilt=tilt, tile_rows=tile_rows,
+                                          dtype=out.dtype):
+        out[row:row + len(tile)] = tile
 
-    return wavelength_map
+    return out